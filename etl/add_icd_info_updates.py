@@ -1,4 +1,3 @@
-import yaml
 import json
 import joblib
 import pydotplus
@@ -12,33 +11,10 @@ from sqlalchemy.sql import text
 
 from sklearn import tree
 
-from sqlalchemy import create_engine
+from db import get_engine
 
 postgres_config = '/group/dsapp-lab/luigi.yaml'
 
-def get_db_conn(postgres_config):
-    """
-    This is really bad code
-    """
-    with open(postgres_config, 'r') as f:
-        config = yaml.load(f)
-    dbtype = 'postgres'
-    
-    #previously was: user = config['postgres']['user']
-    user = config['user']
-    host = config['host']
-    port = config['port']
-    db = config['database']
-    passcode = config['password']
-    url = '{}://{}:{}@{}:{}/{}'.format(dbtype,
-                                       user,
-                                       passcode,
-                                       host,
-                                       port,
-                                       db)
-    conn = create_engine(url)
-    return conn
-
 def query_db(query, conn, params=None):
     """
     Queries DB and returns pandas df.
@@ -48,7 +24,7 @@ def query_db(query, conn, params=None):
     else:        
         return pd.read_sql(query, conn)
 
-engine = get_db_conn(postgres_config)
+engine = get_engine(postgres_config)
 connection = engine.connect()
 
 
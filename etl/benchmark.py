@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Benchmark of the pipeline on synthetic extracts. For each number of
+patients, the extracts are generated (once; later runs reuse them) and
+the load, clean, states, labels and features stages are run against the
+given database, each timed as a stage of a recorded run named
+benchmark_<patients>. The timings go to <profile-dir>/runs.jsonl with
+every other run, so a change can be compared with the runs before it.
+
+    python etl/benchmark.py --config local.yaml --patients 1000 100000
+
+The database should be a scratch one: the raw, staging and features
+tables are replaced.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import label_maker
+import synthetic_data
+from cli import execute_sql, load_command
+from db import get_postgres_config
+from instrumentation import finish_run, start_run, stage
+
+ETL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_DIRECTORY = os.path.join(ETL_DIRECTORY, os.pardir, 'pipeline')
+QUERIES_DIRECTORY = os.path.join(ETL_DIRECTORY, 'queries')
+STAGES = ('load', 'clean', 'states', 'labels', 'features')
+
+
+def build_pipeline_features(postgres_config, workers=1):
+    """
+    Run pipeline/features/*.sql. Those read events_ucm.events, which is
+    not built from the extracts by a script, so they are skipped when it
+    does not exist.
+    """
+    if not postgres_config.does_table_exist(schema='events_ucm', table='events'):
+        print("events_ucm.events does not exist; skipping pipeline/features")
+        return None
+    sys.path.insert(0, PIPELINE_DIRECTORY)
+    from build_features import build_features
+    return build_features(postgres_config,
+                          sorted(glob.glob(os.path.join(PIPELINE_DIRECTORY, 'features', '*.sql'))),
+                          workers=workers, full=True)
+
+
+def run_benchmark(config_file, patients, data_directory, workers=1, stages=STAGES,
+                  seed=0, profile_directory='profiles'):
+    """
+    Generate the extracts of patients patients and time the stages on them.
+
+    Parameter
+    ---------
+    config_file: str
+       yaml file with the connection to the scratch database
+    patients: int
+       number of MRNs in the synthetic cohort
+    data_directory: str
+       the extracts are kept in <data_directory>/<patients>_patients
+    workers: int
+       passed on to every stage
+    stages: iterable
+       stages to run, in pipeline order
+    seed: int
+       seed of the synthetic extracts
+
+    Return
+    ------
+    summary: dict
+       summary of the recorded run, with the seconds of every stage
+    """
+    directory = os.path.join(data_directory, '{}_patients'.format(patients))
+    inventory = synthetic_data.generate(directory, patients, seed=seed)
+    postgres_config = get_postgres_config(config_file)
+
+    start_run('benchmark_{}'.format(patients), profile_directory)
+    try:
+        if 'load' in stages:
+            with stage('load'):
+                load_command(config_file, inventory, schema='raw', resume=False,
+                             verbose=False, workers=workers)
+        if 'clean' in stages:
+            with stage('clean'):
+                execute_sql(config_file, os.path.join(QUERIES_DIRECTORY, 'clean_data.sql'),
+                            workers=workers)
+        if 'states' in stages:
+            with stage('states'):
+                execute_sql(config_file,
+                            os.path.join(QUERIES_DIRECTORY, 'create_states_table.sql'),
+                            workers=workers)
+        if 'labels' in stages:
+            with stage('labels'):
+                label_maker.POSTGRES_CONFIG = config_file
+                label_maker.create_events_table(workers=workers)
+                label_maker.create_outcomes_table(workers=workers)
+                label_maker.create_cohort_table()
+        if 'features' in stages:
+            with stage('features'):
+                for script in ('expert_and_demographic_features.sql',
+                               'previous_appt_count.sql'):
+                    execute_sql(config_file, os.path.join(QUERIES_DIRECTORY, script),
+                                workers=workers)
+                build_pipeline_features(postgres_config, workers)
+    finally:
+        summary = finish_run()
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True,
+                        help='yaml file with the connection to a scratch database')
+    parser.add_argument('--patients', type=int, nargs='+', default=[1000],
+                        help='cohort sizes to run, e.g. 1000 100000 1000000')
+    parser.add_argument('--data-dir', default='synthetic_data',
+                        help='where the synthetic extracts are kept')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile-dir', default='profiles')
+    args = parser.parse_args()
+
+    summaries = [run_benchmark(args.config, patients, args.data_dir, workers=args.workers,
+                               stages=args.stages, seed=args.seed,
+                               profile_directory=args.profile_dir)
+                 for patients in args.patients]
+
+    print("\n{:>10}  {}".format('patients', '  '.join('{:>10}'.format(s) for s in args.stages)))
+    for patients, summary in zip(args.patients, summaries):
+        print("{:>10}  {}".format(patients, '  '.join(
+            '{:>9.1f}s'.format(summary['stages'].get(s, 0)) for s in args.stages)))
@@ -2,57 +2,92 @@
 """
 Basic Configuration for Loading CSV files
 """
-import datetime
+import argparse
+import functools
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
-import pandas as pd
 import yaml
 from six.moves.configparser import ConfigParser
-from config import PostgresConfig
+from db import get_postgres_config
+from loader import copy_csv, copy_csv_tail
+from profiler import ProfileCache, create_table_statement
+from transforms import column_map_type
+from sql_executor import execute_script
+from incremental import rebuild_changed
+from instrumentation import recorded_run, stage
+import manifest
 
 
-def cli(files):
+def cli(files, workers=1, append_tail=False, incremental=False):
     """
     Run your pipeline
     In:
         - files: (list) of paths to sql queries
+        - workers: (int) number of inventory tables loaded, and of sql
+          statements run, at the same time
+        - append_tail: (bool) append new lines of files that only grew
+        - incremental: (bool) rebuild only the tables of the sql queries
+          whose inputs changed
     """
     config = 'luigi.yaml'
     inventory = 'inventory.yaml'
 
-    load_command(config,
-                 inventory,
-                 schema='raw',
-                 resume=True,
-                 verbose=True)
+    with stage('load raw'):
+        load_command(config,
+                     inventory,
+                     schema='raw',
+                     resume=True,
+                     verbose=True,
+                     workers=workers,
+                     append_tail=append_tail)
 
     for file in files:
-        execute_sql(config, file)
+        with stage('sql {}'.format(os.path.basename(file))):
+            execute_sql(config, file, workers=workers, incremental=incremental)
 
 
-def execute_sql(config, path_to_sql):
+def execute_sql(config, path_to_sql, workers=1, incremental=False):
     """
     Executes sql statements found in path_to_sql.
+    Statements that do not touch the same tables run concurrently on up to
+    workers connections, and the time of every statement is reported.
     In:
         config: config file
         path_to_sql: file path to sql queries
+        workers: maximum number of statements running at once
+        incremental: only rebuild the tables whose inputs or statements
+            changed since they were last built, and swap them in with a
+            rename
     """
     if config.endswith('.yaml') or config.endswith('.yml'):
-        with open(config, 'r') as f:
-            config = yaml.load(f)
-            postgres_config = PostgresConfig(**config['postgres'])
+        postgres_config = get_postgres_config(config)
     else:
         raise ValueError("--config must be either a yaml file")
 
     with open(path_to_sql, 'r') as query_file:
-        queries=query_file.read().replace('\n', '')
+        queries = query_file.read()
 
-    postgres_config.execute_in_psql(queries)
+    if incremental:
+        rebuild_changed(postgres_config, queries, workers=workers, label=path_to_sql)
+    else:
+        execute_script(postgres_config, queries, workers=workers, label=path_to_sql)
+
+
+LEADING_DIGITS = re.compile(r'^\d*(.*)$')
+NAME_SUBSTITUTIONS = [
+    (re.compile(r'[\s.]+'), '_'),  # spaces turned into underscores
+    (re.compile(r'[\[\]\(\)]'), ''),  # brackets and parenthesis replaced
+    (re.compile(r'[-:]'), '_'),
+    (re.compile(r'%'), 'pct'),
+    (re.compile(r'&'), 'and'),
+]
 
 
+@functools.lru_cache(maxsize=None)
 def basic_cleaning(to_clean):
     """
     Cleanes numbers, replace spaces with underscores
@@ -68,19 +103,14 @@ def basic_cleaning(to_clean):
     cleaned: str
        cleaned string
     """
-    cleaned = to_clean.strip()
-    cleaned = re.findall(r'^\d*(.*)$', cleaned)[0]
-    cleaned = re.sub(r'[\s.]+', '_', cleaned) #spaces turned into underscores
-    cleaned = re.sub(r'[\[\]\(\)]', '', cleaned) #brackets and parenthesis replaced
-    cleaned = re.sub(r'[-]','_',cleaned)
-    cleaned = re.sub(r':','_',cleaned)
-    cleaned = re.sub(r'%','pct',cleaned)
-    cleaned = re.sub(r'&','and',cleaned)
-    cleaned = cleaned.lower()
-    return cleaned
-
-
-def load_command(config, inventory, schema, resume, verbose):
+    cleaned = LEADING_DIGITS.match(to_clean.strip()).group(1)
+    for pattern, replacement in NAME_SUBSTITUTIONS:
+        cleaned = pattern.sub(replacement, cleaned)
+    return cleaned.lower()
+
+
+def load_command(config, inventory, schema, resume, verbose, workers=1,
+                 append_tail=False):
     """Load data from csvs into the postgres database.
 
 	config: config file
@@ -105,29 +135,45 @@ def load_command(config, inventory, schema, resume, verbose):
               "original column name":
                 name: new_column_name
                 type: date|some_python_type
+                coerce: false
+
+    A value of a column with a type that cannot be converted to it (or is
+    not a whole number, for int) fails the load, unless the column sets
+    coerce: true; such values are then loaded as nulls and counted.
+
+    Files ending in .gz or .zst are decompressed while they are streamed
+    into the database with COPY.
 
     All options *except* the `file_name` are optional, and if not specified
     will be filled in with defaults. E.g., by default, table names and columns
-    get cleaned into lower_snake_case and the type is whatever pandas guesses
-    it is after 100 rows. (Note in particular that pandas usually doesn't detect
-    dates very well from csvs.)
+    get cleaned into lower_snake_case and the type is the tightest Postgres
+    type that fits every value in the file. (Note in particular that only
+    ISO formatted dates are detected; other dates are loaded as text.) The
+    inferred types are cached in <inventory>_profiles.yaml and only inferred
+    again when a file's content changes.
 
     WARNING: If you run this, it will drop all the tables that already exist
     in the schema with the given names **unless** you call with `--resume`.
 
+    Every load is recorded in <schema>.load_manifest with the file's size,
+    mtime and content hash. With `--resume`, a table is only reloaded when
+    its file changed since it was recorded; with `append_tail`, a file that
+    only had lines appended gets just those lines copied in.
+
 	schema = 'raw'
 	resume = True
 	verbose = False
+	workers = 1, number of tables loaded at the same time
+	append_tail = False, append new lines of files that only grew
     """
     if config.endswith('.yaml') or config.endswith('.yml'):
-        with open(config, 'r') as f:
-            config = yaml.load(f)
-            postgres_config = PostgresConfig(**config['postgres'])
+        postgres_config = get_postgres_config(config)
     else:
         raise ValueError("--config must be either a yaml file")
 
+    profile_cache = ProfileCache.for_inventory(inventory)
     with open(inventory, 'r') as f:
-        inventory = yaml.load(f)
+        inventory = yaml.safe_load(f)
     inventory = inventory['inventory']
 
     if verbose:
@@ -144,85 +190,189 @@ def load_command(config, inventory, schema, resume, verbose):
         click.echo("Please fix and try again.")
         sys.exit(1)
 
-    postgres_config = PostgresConfig(**config['postgres'])
-
-    for file_description in inventory:
-        file_name = file_description['file_name']
-        basic_file_name = os.path.basename(file_name).rsplit('.', 1)[0]
-        table_name = file_description.get('table_name') or basic_cleaning(basic_file_name)
-
-        if resume and postgres_config.does_table_exist(schema=schema, table=table_name):
-            click.echo("Table {}.{} exists. Skipping.".format(schema, table_name))
-            continue
-
-        column_map = file_description.get('column_map', {})
-        df_data = pd.read_csv(file_name,
-                              nrows=10000,
-                              na_values=["NULL"])
-
-        # Redo types
-        make_big_int = {}
-        for column_name, value in column_map.items():
-            new_type = value['type']
-            if new_type == 'date':
-                df_data[column_name] = df_data[column_name].apply(pd.Timestamp)
-            elif new_type.startswith('date'):
-                fmt_str = re.findall(r'^date\((.*)\)$', new_type)[0]
-                df_data[column_name] = df_data[column_name].apply(
-                    lambda x: datetime.datetime.strftime(x, fmt_str))
-            else:
-                df_data[column_name] = df_data[column_name].astype(new_type)
-        click.echo("Column map " + str(column_map))
-        renamed_columns = {}
-
-
-        for column_name in df_data.columns:
-            if column_name in column_map and 'name' in column_map[column_name]:
-                renamed_columns[column_name] = column_map[column_name]['name']
-            else:
-                renamed_columns[column_name] = basic_cleaning(column_name)
-
-
-
-        #df_data_data = df_data.reset_index()
-        #index_column_name = df_data.columns[0]
-        #df_data_data = df_data_data.rename(columns={index_column_name: 'id'})
-        df_data.rename(columns=renamed_columns,
-                       inplace=True)
-        print(df_data.head())
-
-
-        sql_statement = pd.io.sql.get_schema(df_data, 'REPLACE ME')
-        sql_statement = sql_statement.replace(
-            '"REPLACE ME"', '"{}"."{}"'.format(schema, table_name))
-        
-        #sql_statement = sql_statement.replace('"id" INTEGER', '"id" SERIAL PRIMARY KEY')
-
-        if verbose:
-            click.echo("Creating table with statement:")
-            click.echo(sql_statement)
-
-        postgres_config.create_and_drop(table=table_name, create_statement=sql_statement,
-                                        schema=schema)
-        copy_statement = (
-            "\copy \"{schema}\".\"{table_name}\" ({column_names}) FROM '{file_name}' "
-            "WITH CSV HEADER NULL ''".format(
-                schema=schema,
-                table_name=table_name,
-                column_names=','.join(df_data.columns[:]),
-                file_name=file_name))
-        postgres_config.execute_in_psql(copy_statement)
+    # Also creates the schema up front, so concurrent loads cannot race on it.
+    manifest.ensure_manifest(postgres_config, schema)
+    catalog = _read_catalog(postgres_config, schema)
+
+    if workers > 1:
+        _load_concurrently(postgres_config, inventory, schema, resume, verbose,
+                           profile_cache, workers, append_tail, catalog)
+    else:
+        for file_description in inventory:
+            _timed_load_file(postgres_config, file_description, schema, resume,
+                             verbose, profile_cache, append_tail, catalog)
+
+
+def _read_catalog(postgres_config, schema):
+    """
+    Tables of the schema and their manifest entries, each read with a
+    single query for the whole inventory instead of one per table.
+    """
+    return {'tables': postgres_config.existing_tables(schema),
+            'entries': manifest.get_entries(postgres_config, schema)}
+
+
+def _table_name(file_description):
+    """
+    Name of the table an inventory entry is loaded into.
+    """
+    basic_file_name = re.sub(r'\.(gz|zst)$', '',
+                             os.path.basename(file_description['file_name']))
+    basic_file_name = basic_file_name.rsplit('.', 1)[0]
+    return file_description.get('table_name') or basic_cleaning(basic_file_name)
+
+
+def _load_concurrently(postgres_config, inventory, schema, resume, verbose,
+                       profile_cache, workers, append_tail=False, catalog=None):
+    """
+    Load the inventory entries with a pool of workers threads sharing a
+    pool of at most workers connections. A failing table is reported and
+    does not stop the other tables; the command exits with an error once
+    every table has been attempted.
+    """
+    postgres_config.open_pool(workers)
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_timed_load_file, postgres_config,
+                                   file_description, schema, resume,
+                                   verbose, profile_cache, append_tail, catalog):
+                   _table_name(file_description)
+                   for file_description in inventory}
+        for i, future in enumerate(as_completed(futures), 1):
+            table_name = futures[future]
+            try:
+                future.result()
+                click.echo("[{}/{}] {}.{} done".format(
+                    i, len(futures), schema, table_name))
+            except Exception as e:
+                failures[table_name] = e
+                click.echo("[{}/{}] {}.{} FAILED: {}".format(
+                    i, len(futures), schema, table_name, e))
+
+    if failures:
+        click.echo("{} of {} tables failed to load: {}".format(
+            len(failures), len(inventory), ', '.join(sorted(failures))))
+        sys.exit(1)
+
+
+def _timed_load_file(postgres_config, file_description, schema, resume, verbose,
+                     profile_cache, append_tail=False, catalog=None):
+    """_load_file, recorded as a stage with the number of lines loaded"""
+    table_name = _table_name(file_description)
+    with stage('load {}.{}'.format(schema, table_name)) as record:
+        record['rows'] = _load_file(postgres_config, file_description, schema,
+                                    resume, verbose, profile_cache, append_tail,
+                                    catalog)
+    return record['rows']
+
+
+def _load_file(postgres_config, file_description, schema, resume, verbose,
+               profile_cache, append_tail=False, catalog=None):
+    """
+    Create and fill the table of a single inventory entry. catalog, as
+    returned by _read_catalog, saves looking the table up on its own.
+
+    Return
+    ------
+    lines: int or None
+       number of lines loaded, None if the table was skipped
+    """
+    file_name = file_description['file_name']
+    table_name = _table_name(file_description)
+
+    if catalog is None:
+        catalog = _read_catalog(postgres_config, schema)
+    fingerprint = None
+    if resume and table_name in catalog['tables']:
+        entry = catalog['entries'].get(table_name)
+        if entry is None:
+            click.echo("Table {}.{} exists but is not in the manifest. "
+                       "Recording it and skipping.".format(schema, table_name))
+            manifest.record_load(postgres_config, schema, table_name, file_name,
+                                 manifest.fingerprint_file(file_name), None)
+            return None
+
+        action, fingerprint = manifest.plan_reload(file_name, entry, append_tail)
+        if action == 'skip':
+            if fingerprint is not None:
+                # Touched but identical; remember the new mtime.
+                manifest.record_load(postgres_config, schema, table_name,
+                                     file_name, fingerprint, entry['rows_loaded'])
+            click.echo("Table {}.{} is unchanged. Skipping.".format(schema, table_name))
+            return None
+        if action == 'append':
+            click.echo("File {} has grown. Appending its new rows to {}.{}.".format(
+                file_name, schema, table_name))
+            # The manifest gets the fingerprint of the bytes actually copied,
+            # which may go past the fingerprint of plan_reload
+            lines, fingerprint = copy_csv_tail(postgres_config, file_name, schema,
+                                               table_name, offset=entry['file_size'],
+                                               prefix_digest=fingerprint['prefix_digest'],
+                                               column_map=file_description.get('column_map'))
+            manifest.record_load(postgres_config, schema, table_name, file_name,
+                                 fingerprint, (entry['rows_loaded'] or 0) + lines)
+            return lines
+        click.echo("File {} changed since {}.{} was loaded. Reloading.".format(
+            file_name, schema, table_name))
+
+    column_map = file_description.get('column_map', {})
+    click.echo("Column map " + str(column_map))
+
+    # Types are inferred from the whole file, unless the column map sets them
+    columns = []
+    for column_name, column_type in profile_cache.get_columns(table_name, file_name,
+                                                              fingerprint):
+        options = column_map.get(column_name, {})
+        if 'type' in options:
+            column_type = column_map_type(options['type'])
+        columns.append((options.get('name') or basic_cleaning(column_name),
+                        column_type))
+
+    sql_statement = create_table_statement(schema, table_name, columns)
+
+    if verbose:
+        click.echo("Creating table with statement:")
+        click.echo(sql_statement)
+
+    postgres_config.create_and_drop(table=table_name, create_statement=sql_statement,
+                                    schema=schema)
+    stat = os.stat(file_name)
+    lines, content_hash = copy_csv(postgres_config, file_name, schema, table_name,
+                                   column_names=[name for name, _ in columns],
+                                   column_map=column_map)
+    manifest.record_load(postgres_config, schema, table_name, file_name,
+                         {'file_size': stat.st_size,
+                          'file_mtime': stat.st_mtime,
+                          'content_hash': content_hash},
+                         lines)
+    return lines
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of inventory tables loaded, and of sql '
+                             'statements run, at the same time')
+    parser.add_argument('--append-tail', action='store_true',
+                        help='append the new lines of files that only grew '
+                             'instead of reloading them')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rebuild the tables of the sql queries whose '
+                             'inputs changed since their last build')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory of the JSON-lines timing records and '
+                             'of the runs summary')
+    parser.add_argument('--explain-slowest', type=int, default=0,
+                        help='capture EXPLAIN (ANALYZE, BUFFERS) of this many '
+                             'of the slowest statements; their queries are run again')
+    args = parser.parse_args()
+    if len(args.files) < 2:
         print("""
                 \n\nHave you considered adding queries for the
                 staging tables, first features table, and the states
                 table?\n\n
                 """)
-    if len(sys.argv) > 0:
-        files = sys.argv[1:]
-    else:
-        files = None
-    cli(files)
+    with recorded_run('cli', args.profile_dir, args.explain_slowest):
+        cli(args.files, workers=args.workers, append_tail=args.append_tail,
+            incremental=args.incremental)
@@ -1,7 +1,13 @@
+import contextlib
 import os
 import subprocess
+import threading
 
 import psycopg2
+import psycopg2.pool
+
+# Connections a PostgresConfig keeps open unless open_pool asks for more
+DEFAULT_MAX_CONNECTIONS = 4
 
 
 def _does_table_exist(curs, table, schema='public'):
@@ -14,14 +20,59 @@ def _does_table_exist(curs, table, schema='public'):
     return curs.fetchall()[0][0]
 
 
+def _existing_tables(curs, schema):
+    curs.execute("""SELECT table_name
+                    FROM information_schema.tables
+                   WHERE table_schema = %(schema)s;
+                  """, {'schema': schema})
+    return set(row[0] for row in curs.fetchall())
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that makes getconn wait for a connection to be
+    returned when all maxconn are in use, instead of raising PoolError
+    """
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.available = threading.Semaphore(maxconn)
+        super(BlockingConnectionPool, self).__init__(minconn, maxconn, *args, **kwargs)
+
+    def grow(self, maxconn):
+        """Allow up to maxconn connections, if that is more than now"""
+        with self._lock:
+            for _ in range(maxconn - self.maxconn):
+                self.available.release()
+            self.maxconn = max(self.maxconn, maxconn)
+
+    def getconn(self, key=None):
+        self.available.acquire()
+        try:
+            return super(BlockingConnectionPool, self).getconn(key)
+        except Exception:
+            self.available.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super(BlockingConnectionPool, self).putconn(conn, key, close)
+        finally:
+            self.available.release()
+
+
 class PostgresConfig(object):
+    """
+    Connection settings with a pool of at most max_connections
+    connections, opened on the first connect and reused by every call
+    after it. Use db.get_postgres_config to share one between modules.
+    """
     def __init__(self,
                  host=None,
                  port=5432,
                  database=None,
                  user=None,
                  password=None,
-                 luigi_config=None):
+                 luigi_config=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
         if luigi_config:
             self.host = luigi_config['host']
             self.port = luigi_config['port']
@@ -34,6 +85,10 @@ class PostgresConfig(object):
             self.database = database
             self.user = user
             self.password = password
+        self.max_connections = max_connections
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.entered = threading.local()
 
     def as_env_dict(self):
         """For the purposes of setting environment variables, this returns the config
@@ -51,19 +106,63 @@ class PostgresConfig(object):
         }
         return {key: str(value) for key, value in potential.items() if value}
 
+    def open_pool(self, maxconn):
+        """Make the pool shared by all subsequent calls on this config hold up
+        to maxconn connections; it is opened now if it is not open yet
+
+        :param int maxconn: The maximum number of open connections
+        """
+        with self.pool_lock:
+            self.max_connections = max(self.max_connections, maxconn)
+            if self.pool is None:
+                self.pool = BlockingConnectionPool(1, self.max_connections,
+                                                   host=self.host,
+                                                   port=self.port,
+                                                   database=self.database,
+                                                   user=self.user,
+                                                   password=self.password)
+            else:
+                self.pool.grow(self.max_connections)
+
+    def close_pool(self):
+        """Close every connection of the pool; the next connect opens a new one"""
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Yield a connection from the pool, waiting for one if all are in
+        use. The transaction is committed on success and rolled back on
+        error. This is safe to use from several threads at once."""
+        if self.pool is None:
+            self.open_pool(self.max_connections)
+        pool = self.pool
+        conn = pool.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            # Connections go back to the pool idle and in their default mode
+            if not conn.closed:
+                conn.autocommit = False
+            pool.putconn(conn)
+
     def __enter__(self):
-        self.connection = psycopg2.connect(host=self.host,
-                                           port=self.port,
-                                           database=self.database,
-                                           user=self.user,
-                                           password=self.password)
-        return self.connection.__enter__()
+        # Connections entered with `with config as conn` are kept per
+        # thread, so threads sharing this config do not exit each other's
+        connection = self.connect()
+        conn = connection.__enter__()
+        self.entered.__dict__.setdefault('connections', []).append(connection)
+        return conn
 
     def __exit__(self, *args):
-        self.connection.__exit__(*args)
+        return self.entered.connections.pop().__exit__(*args)
 
     def execute_in_psql(self, cmd):
-        """Execute a command in psql. This is useful for using the \copy command"""
+        """Execute a command in psql. This is useful for using the \copy command.
+        As in psql, a failed statement is reported and the next ones still run"""
         env = os.environ.copy()
         env.update(self.as_env_dict())
         p = subprocess.Popen(['psql'], stdin=subprocess.PIPE, env=env)
@@ -73,9 +172,15 @@ class PostgresConfig(object):
                                                 p.returncode,
                                                 'psql')
 
+    def copy_expert(self, statement, stream, size=8192):
+        """Run a COPY ... FROM STDIN statement, reading from a file-like object
+        size bytes at a time"""
+        with self.connect() as conn, conn.cursor() as curs:
+            curs.copy_expert(statement, stream, size=size)
+
     def does_column_exist(self, table, column, schema='public'):
         """Return whether a particular column exists"""
-        with self as conn, conn.cursor() as curs:
+        with self.connect() as conn, conn.cursor() as curs:
             curs.execute("""SELECT EXISTS (
                               SELECT 1
                                 FROM information_schema.columns
@@ -87,9 +192,37 @@ class PostgresConfig(object):
 
     def does_table_exist(self, table, schema='public'):
         """Return whether a particular table exists"""
-        with self as conn, conn.cursor() as curs:
+        with self.connect() as conn, conn.cursor() as curs:
             return _does_table_exist(curs, table, schema)
 
+    def existing_tables(self, schema='public'):
+        """Return the names of all the tables of a schema, in one query
+
+        :param str schema: The name of the schema
+        :return: The table names
+        :rtype: set[str]
+        """
+        with self.connect() as conn, conn.cursor() as curs:
+            return _existing_tables(curs, schema)
+
+    def existing_columns(self, schema='public'):
+        """Return the columns of all the tables of a schema, in one query
+
+        :param str schema: The name of the schema
+        :return: Table name to its column names, in order
+        :rtype: dict[str, list[str]]
+        """
+        with self.connect() as conn, conn.cursor() as curs:
+            curs.execute("""SELECT table_name, column_name
+                              FROM information_schema.columns
+                             WHERE table_schema = %(schema)s
+                             ORDER BY table_name, ordinal_position;
+                         """, {'schema': schema})
+            columns = {}
+            for table, column in curs.fetchall():
+                columns.setdefault(table, []).append(column)
+            return columns
+
     def does_schema_exist(self, schema):
         """Return whether a particular schema exists
 
@@ -97,7 +230,7 @@ class PostgresConfig(object):
         :return: Whether it exists
         :rtype: bool
         """
-        with self as conn, conn.cursor() as curs:
+        with self.connect() as conn, conn.cursor() as curs:
             curs.execute("""SELECT EXISTS (
                               SELECT 1
                                 FROM information_schema.schemata
@@ -106,7 +239,7 @@ class PostgresConfig(object):
             return curs.fetchall()[0][0]
 
     def create_and_drop(self, table, create_statement, schema='public'):
-        with self as conn:
+        with self.connect() as conn:
             with conn.cursor() as curs:
                 curs.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
                 curs.execute("DROP TABLE IF EXISTS {}.{}".format(schema, table))
@@ -0,0 +1,96 @@
+"""
+Shared database access for the entry points: connection settings are
+read once per file, and every caller asking for the same file gets the
+same PostgresConfig (with its connection pool) or sqlalchemy engine,
+created the first time it is asked for.
+"""
+import threading
+
+import yaml
+
+from config import PostgresConfig
+from instrumentation import instrument_engine
+
+CONNECTION_KEYS = ('host', 'port', 'database', 'user', 'password')
+
+_lock = threading.Lock()
+_settings = {}
+_postgres_configs = {}
+_engines = {}
+
+
+def read_settings(config_file):
+    """
+    Connection settings of a yaml file, either flat (as luigi.yaml) or
+    under a postgres key (as cli.py's config)
+    """
+    with _lock:
+        if config_file not in _settings:
+            with open(config_file, 'r') as f:
+                config = yaml.safe_load(f)
+            config = config.get('postgres', config)
+            _settings[config_file] = dict((key, config[key]) for key in CONNECTION_KEYS
+                                          if key in config)
+        return dict(_settings[config_file])
+
+
+def get_postgres_config(config_file=None):
+    """
+    The PostgresConfig of a settings file, shared by every caller. Without
+    a file, the PG* environment variables are used, as psql does.
+    """
+    with _lock:
+        postgres_config = _postgres_configs.get(config_file)
+    if postgres_config is None:
+        settings = read_settings(config_file) if config_file else {'port': None}
+        with _lock:
+            postgres_config = _postgres_configs.setdefault(config_file,
+                                                           PostgresConfig(**settings))
+    return postgres_config
+
+
+def engine_url(config_file):
+    settings = read_settings(config_file)
+    return 'postgres://{}:{}@{}:{}/{}'.format(settings['user'],
+                                              settings['password'],
+                                              settings['host'],
+                                              settings['port'],
+                                              settings['database'])
+
+
+def get_engine(config_file, pool_size=5, poolclass=None):
+    """
+    The sqlalchemy engine of a settings file, created on the first call
+    and reused by the calls after it with the same pool options. Its
+    statements are recorded by instrumentation.
+
+    Parameter
+    ---------
+    config_file: str
+       yaml file with the connection settings
+    pool_size: int
+       connections kept open by the engine's pool
+    poolclass: sqlalchemy pool class
+       e.g. NullPool for engines whose url is handed to other processes
+
+    Return
+    ------
+    engine: sqlalchemy Engine
+    """
+    import sqlalchemy
+
+    key = (config_file, pool_size, poolclass)
+    with _lock:
+        engine = _engines.get(key)
+    if engine is None:
+        if poolclass is None:
+            engine = sqlalchemy.create_engine(engine_url(config_file), pool_size=pool_size)
+        else:
+            engine = sqlalchemy.create_engine(engine_url(config_file), poolclass=poolclass)
+        with _lock:
+            if key in _engines:
+                engine.dispose()
+                engine = _engines[key]
+            else:
+                _engines[key] = instrument_engine(engine)
+    return engine
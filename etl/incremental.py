@@ -0,0 +1,307 @@
+"""
+Rebuild only the tables of a SQL script whose inputs changed since their
+last build, and swap the rebuilt tables in with a rename
+"""
+import hashlib
+import json
+import re
+from collections import OrderedDict
+
+import click
+
+from config import _does_table_exist
+from manifest import MANIFEST_TABLE
+from sql_executor import DROP_INDEX_PATTERN, DROP_PATTERN, analyze, execute_script
+
+BUILD_MANIFEST_TABLE = 'build_manifest'
+# Tables and indexes are built under their final name plus this suffix
+NEW_SUFFIX = '__new'
+
+CREATE_INDEX_NAME = re.compile(
+    r'^(\s*create\s+(?:unique\s+)?index\s+(?:concurrently\s+)?'
+    r'(?:if\s+not\s+exists\s+)?)("?)([\w$]+)("?)(?=\s+on\s)', re.IGNORECASE)
+
+
+class Target(object):
+    """
+    A table written by a script, with the statements that build it and
+    the tables those statements read.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.statements = []
+        self.cascade = False
+        self.fingerprint = None
+
+    @property
+    def schema(self):
+        return self.name.split('.')[0]
+
+    @property
+    def table(self):
+        return self.name.split('.')[1]
+
+    @property
+    def inputs(self):
+        reads = set()
+        for statement in self.statements:
+            reads.update(statement.reads)
+        reads.discard(self.name)
+        return sorted(reads)
+
+
+def group_targets(statements):
+    """
+    Split the statements of a script into the statements that do not
+    write any table, which are run every time, and one Target per written
+    table, in the order the tables are first written.
+
+    Return
+    ------
+    setup: list
+       Statement objects that do not write a table
+    targets: OrderedDict
+       Target objects keyed by schema-qualified table name
+    """
+    setup = []
+    targets = OrderedDict()
+    for statement in statements:
+        if not statement.writes:
+            setup.append(statement)
+            continue
+        name = min(statement.writes)
+        target = targets.setdefault(name, Target(name))
+        target.statements.append(statement)
+        drop = DROP_PATTERN.match(statement.sql.lower())
+        if drop and drop.group(2) == 'cascade':
+            target.cascade = True
+    return setup, targets
+
+
+def rebuild_changed(postgres_config, sql, workers=1, manifest_schema='staging',
+                    label=''):
+    """
+    Run a script that drops and recreates its tables, rebuilding only the
+    tables whose fingerprint changed.
+
+    The fingerprint of a table hashes the statements that build it and
+    the fingerprints of the tables they read: the load manifest entry of
+    a loaded table, the fingerprint of a table built earlier in the
+    script, or else a row count and checksum of the table. A change in an
+    upstream table therefore rebuilds every table downstream of it.
+
+    Changed tables are built as <table>__new next to the live tables, with
+    the statements of the script and their DROP INDEX statements skipped,
+    and are swapped in together in one short transaction, so readers of
+    the live tables are never blocked by a rebuild. Tables are expected to
+    be schema-qualified in the script, as in clean_data.sql.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+       database to run the script in
+    sql: str
+       content of the script
+    workers: int
+       maximum number of statements running at once
+    manifest_schema: str
+       schema of the table that records the fingerprints of the last build
+    label: str
+       name of the script, used in the report
+
+    Return
+    ------
+    rebuilt: list
+       names of the tables that were rebuilt and swapped in. A table
+       with a failed statement, or built from such a table, is not
+       swapped in and keeps its old fingerprint, so it is rebuilt on the
+       next run.
+    """
+    setup, targets = group_targets(analyze(sql))
+    if setup:
+        execute_script(postgres_config, ';\n'.join(s.sql for s in setup),
+                       label=label + ' (setup)')
+    ensure_build_manifest(postgres_config, manifest_schema)
+    built = get_fingerprints(postgres_config, manifest_schema)
+
+    changed = []
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        for target in targets.values():
+            inputs = [(name, targets[name].fingerprint if name in targets
+                       else _input_fingerprint(curs, name))
+                      for name in target.inputs]
+            target.fingerprint = hashlib.sha256(json.dumps(
+                [[s.sql for s in target.statements], inputs]).encode('utf-8')).hexdigest()
+            if target.fingerprint != built.get(target.name) \
+                    or not _does_table_exist(curs, target.table, target.schema):
+                changed.append(target)
+
+    for target in targets.values():
+        click.echo("{}: {}".format(
+            target.name, 'rebuilding' if target in changed else 'unchanged'))
+    if not changed:
+        return []
+
+    names = [target.name for target in changed]
+    script = []
+    for target in changed:
+        script.append('DROP TABLE IF EXISTS {}{} CASCADE'.format(target.name, NEW_SUFFIX))
+    for statement in sorted((s for t in changed for s in t.statements),
+                            key=lambda s: s.position):
+        rewritten = _rewrite(statement, names)
+        if rewritten:
+            script.append(rewritten)
+    timings = execute_script(postgres_config, ';\n'.join(script), workers=workers,
+                             label=label)
+
+    failed = failed_targets(changed, timings)
+    if failed:
+        discard_new_tables(postgres_config, failed)
+    swapped = swap_tables(postgres_config, [t for t in changed if t not in failed])
+    for target in swapped:
+        record_fingerprint(postgres_config, manifest_schema, target.name,
+                           target.fingerprint)
+    return [target.name for target in swapped]
+
+
+def _rewrite(statement, names):
+    """
+    Point a statement at the __new tables and indexes; None for the
+    statements that must not run against them.
+    """
+    lowered = statement.sql.lower()
+    if DROP_PATTERN.match(lowered) or DROP_INDEX_PATTERN.match(lowered):
+        return None
+    sql = CREATE_INDEX_NAME.sub(r'\1\2\3' + NEW_SUFFIX + r'\4', statement.sql)
+    for name in names:
+        schema, table = name.split('.')
+        sql = re.sub(r'(?<![\w$."]){}\s*\.\s*{}(?![\w$"])'.format(
+                         re.escape(schema), re.escape(table)),
+                     name + NEW_SUFFIX, sql, flags=re.IGNORECASE)
+    return sql
+
+
+def failed_targets(targets, timings):
+    """
+    The targets with a failed statement, and the targets that read one of
+    them, whose __new tables were built from an incomplete table.
+
+    Parameter
+    ---------
+    targets: list
+       Target objects that were rebuilt, in build order
+    timings: list
+       (seconds, Statement, error or None) tuples of the rebuild script
+
+    Return
+    ------
+    failed: list
+       Target objects, in build order
+    """
+    errors = set()
+    for _, statement, error in timings:
+        if error is not None:
+            errors.update(statement.writes)
+    failed = []
+    for target in targets:
+        if target.name + NEW_SUFFIX in errors \
+                or any(other.name in target.inputs for other in failed):
+            failed.append(target)
+    return failed
+
+
+def discard_new_tables(postgres_config, targets):
+    """Drop the __new tables of targets, keeping their live tables"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        for target in targets:
+            curs.execute('DROP TABLE IF EXISTS {}{} CASCADE'.format(target.name, NEW_SUFFIX))
+    for target in targets:
+        click.echo("{}{} failed to build; keeping the live {}".format(
+            target.name, NEW_SUFFIX, target.name))
+
+
+def swap_tables(postgres_config, targets):
+    """
+    Replace the live tables with their __new tables in one transaction,
+    dropping the live tables in reverse build order and giving the indexes
+    of the new tables their final names.
+
+    Return
+    ------
+    swapped: list
+       the targets whose __new table existed and was swapped in
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        swapped = [target for target in targets
+                   if _does_table_exist(curs, target.table + NEW_SUFFIX, target.schema)]
+        for target in reversed(swapped):
+            curs.execute('DROP TABLE IF EXISTS {}{}'.format(
+                target.name, ' CASCADE' if target.cascade else ''))
+        for target in swapped:
+            curs.execute('ALTER TABLE {}{} RENAME TO {}'.format(
+                target.name, NEW_SUFFIX, target.table))
+            curs.execute("""SELECT indexname
+                              FROM pg_indexes
+                             WHERE schemaname = %s
+                               AND tablename = %s;
+                         """, (target.schema, target.table))
+            for (index_name,) in curs.fetchall():
+                final_name = index_name.replace(target.table + NEW_SUFFIX, target.table)
+                if final_name.endswith(NEW_SUFFIX):
+                    final_name = final_name[:-len(NEW_SUFFIX)]
+                if final_name != index_name:
+                    curs.execute('ALTER INDEX "{}"."{}" RENAME TO "{}"'.format(
+                        target.schema, index_name, final_name))
+    for target in [t for t in targets if t not in swapped]:
+        click.echo("{}{} was not built; keeping the live {}".format(
+            target.name, NEW_SUFFIX, target.name))
+    return swapped
+
+
+def _input_fingerprint(curs, name):
+    schema, table = name.split('.')
+    if not _does_table_exist(curs, table, schema):
+        return None
+    if _does_table_exist(curs, MANIFEST_TABLE, schema):
+        curs.execute("""SELECT content_hash, rows_loaded
+                          FROM "{}"."{}"
+                         WHERE table_name = %s;
+                     """.format(schema, MANIFEST_TABLE), (table,))
+        row = curs.fetchone()
+        if row is not None:
+            return 'manifest:{}:{}'.format(*row)
+    curs.execute("""SELECT count(*), coalesce(sum(hashtext(t::text)::bigint), 0)
+                      FROM "{}"."{}" AS t;
+                 """.format(schema, table))
+    return 'rows:{}:{}'.format(*curs.fetchone())
+
+
+def ensure_build_manifest(postgres_config, schema):
+    """Create the build manifest table in schema if it does not exist yet"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+        curs.execute("""CREATE TABLE IF NOT EXISTS "{}"."{}" (
+                          table_name text PRIMARY KEY,
+                          fingerprint text,
+                          built_at timestamp DEFAULT now());
+                     """.format(schema, BUILD_MANIFEST_TABLE))
+
+
+def get_fingerprints(postgres_config, schema):
+    """Fingerprints of the last build, keyed by schema-qualified table name"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute('SELECT table_name, fingerprint FROM "{}"."{}";'.format(
+            schema, BUILD_MANIFEST_TABLE))
+        return dict(curs.fetchall())
+
+
+def record_fingerprint(postgres_config, schema, table_name, fingerprint):
+    """Insert or replace the fingerprint of a built table"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""INSERT INTO "{}"."{}" (table_name, fingerprint, built_at)
+                        VALUES (%s, %s, now())
+                        ON CONFLICT (table_name) DO UPDATE
+                           SET fingerprint = EXCLUDED.fingerprint,
+                               built_at = EXCLUDED.built_at;
+                     """.format(schema, BUILD_MANIFEST_TABLE),
+                     (table_name, fingerprint))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Build the indexes of a file of CREATE INDEX statements that do not exist
+yet, several at a time. The index of a partitioned table is built on
+each partition on its own, concurrently (without blocking writes), and
+the partition indexes are then attached to an index created on the
+table alone; creating it on the table would build the partitions one
+after the other while holding a lock on all of them.
+
+    python etl/indexes.py etl/schemas/create_indices.sql --config luigi.yaml --workers 4
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+from db import get_postgres_config
+from instrumentation import recorded_run, stage
+from sql_executor import NAME, _normalize, analyze, execute_statements, split_statements
+
+INDEX_PATTERN = re.compile(
+    r'^\s*create\s+(unique\s+)?index\s+(?:concurrently\s+)?(?:if\s+not\s+exists\s+)?'
+    r'(?!on\s)("?[\w$]+"?)\s+on\s+(?:only\s+)?' + NAME + r'\s*(.*)$',
+    re.IGNORECASE | re.DOTALL)
+# Longer identifiers are truncated by Postgres
+MAX_NAME_LENGTH = 63
+
+
+class Index(object):
+    """A CREATE INDEX statement, split into its name, table and definition"""
+    def __init__(self, sql):
+        match = INDEX_PATTERN.match(sql)
+        if match is None:
+            raise ValueError("Not a CREATE INDEX statement with an index name "
+                             "(needed to tell whether it exists): {}".format(sql))
+        self.unique = bool(match.group(1))
+        self.name = match.group(2).replace('"', '')
+        self.table = _normalize(match.group(3))
+        # USING, columns, INCLUDE, WITH and WHERE clauses
+        self.definition = ' '.join(match.group(4).split())
+
+    @property
+    def schema(self):
+        return self.table.split('.')[0]
+
+    def create(self, name, table, concurrently=False, only=False):
+        return 'CREATE {}INDEX {}IF NOT EXISTS {} ON {}{} {}'.format(
+            'UNIQUE ' if self.unique else '', 'CONCURRENTLY ' if concurrently else '',
+            name, 'ONLY ' if only else '', table, self.definition)
+
+
+def partition_index_name(index_name, table):
+    """Name of the index of a partition: <partition>_<index>"""
+    name = '{}_{}'.format(table.split('.')[1], index_name)
+    if len(name) > MAX_NAME_LENGTH:
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+        name = '{}_{}'.format(name[:MAX_NAME_LENGTH - len(digest) - 1], digest)
+    return name
+
+
+def existing_indexes(postgres_config):
+    """
+    Every index of the database, as {schema.index: valid}. An index is
+    not valid if its concurrent build failed, or, for the index of a
+    partitioned table, until the indexes of all partitions are attached.
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""SELECT n.nspname || '.' || c.relname, i.indisvalid
+                          FROM pg_index i
+                          JOIN pg_class c ON c.oid = i.indexrelid
+                          JOIN pg_namespace n ON n.oid = c.relnamespace;""")
+        return dict(curs.fetchall())
+
+
+def partition_tree(postgres_config, table):
+    """
+    (table, parent table, is leaf) of a table and of all its partitions,
+    deepest partitions first and the table itself last. The parent of the
+    table itself is only set when the table is a partition. A table that
+    is neither partitioned nor a partition is a single leaf.
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""SELECT n.nspname || '.' || c.relname,
+                               pn.nspname || '.' || p.relname, t.isleaf
+                          FROM pg_partition_tree(%s::regclass) t
+                          JOIN pg_class c ON c.oid = t.relid
+                          JOIN pg_namespace n ON n.oid = c.relnamespace
+                          LEFT JOIN pg_class p ON p.oid = t.parentrelid
+                          LEFT JOIN pg_namespace pn ON pn.oid = p.relnamespace
+                         ORDER BY t.level DESC, 1;""", (table,))
+        # pg_partition_tree has no rows for a table outside of any partition tree
+        return curs.fetchall() or [(table, None, True)]
+
+
+def _build(index, name, table, existing):
+    qualified = '{}.{}'.format(table.split('.')[0], name)
+    if existing.get(qualified):
+        return []
+    statements = []
+    if qualified in existing:
+        # Left behind, not valid, by a concurrent build that failed
+        statements.append('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(qualified))
+    return statements + [index.create(name, table, concurrently=True)]
+
+
+def plan_indexes(postgres_config, indexes):
+    """
+    Statements building the indexes that do not exist yet, or are not
+    valid: the concurrent builds first, then, for partitioned tables, the
+    indexes on the tables alone and the statements attaching the indexes
+    of their partitions, deepest partitions first.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+    indexes: list
+       Index objects
+
+    Return
+    ------
+    statements: list
+       SQL statements, in the order they can be run one after the other
+    """
+    existing = existing_indexes(postgres_config)
+    builds = []
+    creates = []
+    attaches = []
+    for index in indexes:
+        tree = partition_tree(postgres_config, index.table)
+        if len(tree) == 1:
+            # A plain table, or a partition that is not partitioned itself
+            builds.extend(_build(index, index.name, index.table, existing))
+            continue
+        if existing.get('{}.{}'.format(index.schema, index.name)):
+            continue
+        # The table may itself be a partition; its parent is not indexed here
+        names = dict((table, index.name if table == index.table
+                      else partition_index_name(index.name, table))
+                     for table, _, _ in tree)
+        for table, parent, leaf in tree:
+            if leaf:
+                builds.extend(_build(index, names[table], table, existing))
+            else:
+                creates.append(index.create(names[table], table, only=True))
+            if table != index.table:
+                attaches.append('ALTER INDEX {}.{} ATTACH PARTITION {}.{}'.format(
+                    parent.split('.')[0], names[parent], table.split('.')[0], names[table]))
+    return builds + creates + attaches
+
+
+def build_indexes(postgres_config, path, workers=1, dry_run=False):
+    """
+    Build the missing indexes of a file, up to workers at a time. Two
+    indexes of the same table are not built at the same time.
+
+    Return
+    ------
+    timings: list
+       (seconds, Statement, error or None) tuples, as returned by
+       sql_executor.execute_statements
+    """
+    with open(path, 'r') as f:
+        indexes = [Index(sql) for sql in split_statements(f.read())]
+    statements = plan_indexes(postgres_config, indexes)
+    if not statements:
+        print("{}: all {} indexes exist".format(path, len(indexes)))
+        return []
+    if dry_run:
+        for statement in statements:
+            print(statement + ';')
+        return []
+    return execute_statements(postgres_config, analyze(';\n'.join(statements)),
+                              workers=workers, label=os.path.basename(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', help='SQL files of CREATE INDEX statements')
+    parser.add_argument('--config', default=None,
+                        help='yaml file with the database connection')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of indexes built at the same time')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the statements instead of running them')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory of the JSON-lines timing records and '
+                             'of the runs summary')
+    args = parser.parse_args()
+
+    postgres_config = get_postgres_config(args.config)
+    failed = 0
+    with recorded_run('indexes', None if args.dry_run else args.profile_dir):
+        for path in args.files:
+            with stage('indexes {}'.format(os.path.basename(path))):
+                timings = build_indexes(postgres_config, path, workers=args.workers,
+                                        dry_run=args.dry_run)
+            failed += sum(1 for timing in timings if timing[2] is not None)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,312 @@
+"""
+Structured timing records for the ETL, label and Triage runs.
+
+A run writes one JSON object per line to <directory>/<run_id>.jsonl: a
+record for every stage and every SQL statement, with its duration and
+the rows it affected, the query plans of the slowest statements if
+asked for, and a summary. The summary is also appended to
+<directory>/runs.jsonl, which holds one line per run, so runs can be
+compared from one night to the next.
+"""
+import contextlib
+import datetime
+import heapq
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+QUERY_PATTERN = re.compile(r'^\s*(?:(?:select|with|values|table)\b|\()', re.IGNORECASE)
+CREATE_AS_PATTERN = re.compile(
+    r'^\s*create\s+(?:(?:global\s+|local\s+)?(?:temporary|temp)\s+|unlogged\s+)?table\s+'
+    r'(?:if\s+not\s+exists\s+)?[\w$."]+\s*(?:\([^()]*\)\s*)?as\s+(.*?)'
+    r'(?:\s+with\s+(?:no\s+)?data)?\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+INSERT_PATTERN = re.compile(
+    r'^\s*insert\s+into\s+[\w$."]+(?:\s+as\s+[\w$]+)?\s*(?:\([^()]*\)\s*)?(.*)$',
+    re.IGNORECASE | re.DOTALL)
+# Queries that write, whose plan would be captured by running them again
+WRITING_PATTERN = re.compile(r'\b(?:insert|update|delete|merge|into)\b|\bon\s+conflict\b',
+                             re.IGNORECASE)
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+def explained_query(sql):
+    """
+    The query of a statement that EXPLAIN ANALYZE can run again without
+    side effects: a SELECT, or the query of a CREATE TABLE AS or of an
+    INSERT ... SELECT. None for the statements that only write, such as
+    UPDATE and DELETE, and for queries that write themselves.
+    """
+    create = CREATE_AS_PATTERN.match(sql)
+    insert = INSERT_PATTERN.match(sql)
+    query = (create or insert).group(1) if (create or insert) else sql
+    if not QUERY_PATTERN.match(query) or WRITING_PATTERN.search(query):
+        return None
+    return query
+
+
+class NullRecorder(object):
+    """Recorder used when no run was started; records nothing"""
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        yield fields
+
+    def statement(self, sql, seconds, rows=None, error=None, source=None,
+                  explain=None, parameters=None):
+        pass
+
+
+class Recorder(object):
+    """
+    Collects the stage and statement records of one run.
+
+    Parameter
+    ---------
+    name: str
+       name of the entry point, e.g. 'cli' or 'label_maker'
+    directory: str
+       where the records and the runs summary are written
+    explain_slowest: int
+       number of slowest statements whose plan is captured with
+       EXPLAIN (ANALYZE, BUFFERS) at the end of the run. Only the query
+       of a statement is explained, as given by explained_query: the
+       SELECT of a CREATE TABLE AS or INSERT, whose table may exist by
+       then or be gone, is run again without writing anything. Each
+       captured plan therefore adds about the time of its query to the
+       run, and the plan of a query reading a table dropped later in the
+       run is recorded with its error instead.
+    """
+    def __init__(self, name, directory='profiles', explain_slowest=0):
+        self.name = name
+        self.directory = directory
+        self.explain_slowest = explain_slowest
+        self.run_id = '{}_{}_{}'.format(
+            name, datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:6])
+        self.started = time.time()
+        self.started_at = _now()
+        self.lock = threading.Lock()
+        self.stages = []
+        self.statements = 0
+        self.statement_seconds = 0.0
+        self.failed_statements = 0
+        self.slowest = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, self.run_id + '.jsonl')
+        self.file = open(self.path, 'a')
+        self.write({'type': 'run', 'name': name, 'host': socket.gethostname(),
+                    'started_at': self.started_at})
+
+    def write(self, record):
+        record = dict(record, run_id=self.run_id)
+        with self.lock:
+            self.file.write(json.dumps(record, default=str) + '\n')
+            self.file.flush()
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the body of a with block as a stage. The yielded dict can be
+        filled with more fields for the record, such as rows.
+        """
+        started = time.time()
+        status = 'ok'
+        try:
+            yield fields
+        except BaseException as e:
+            status = 'error: {}'.format(e)
+            raise
+        finally:
+            seconds = time.time() - started
+            with self.lock:
+                self.stages.append((name, seconds, status))
+            self.write(dict(fields, type='stage', name=name, started_at=datetime.datetime
+                            .fromtimestamp(started).isoformat(),
+                            seconds=round(seconds, 3), status=status))
+
+    def statement(self, sql, seconds, rows=None, error=None, source=None,
+                  explain=None, parameters=None):
+        """
+        Record a statement. explain, if given, is a function that runs
+        EXPLAIN (ANALYZE, BUFFERS) for it and returns the plan.
+        """
+        with self.lock:
+            self.statements += 1
+            self.statement_seconds += seconds
+            self.failed_statements += error is not None
+            query = None
+            if explain is not None and error is None and self.explain_slowest:
+                query = explained_query(sql)
+            if query is not None:
+                entry = (seconds, self.statements, sql, query, parameters, explain)
+                if len(self.slowest) < self.explain_slowest:
+                    heapq.heappush(self.slowest, entry)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+        self.write({'type': 'statement', 'source': source, 'sql': ' '.join(sql.split()),
+                    'seconds': round(seconds, 3), 'rows': rows,
+                    'error': None if error is None else str(error).strip()})
+
+    def explain(self):
+        """Capture the plans of the slowest statements"""
+        for seconds, _, sql, query, parameters, explain in sorted(self.slowest, reverse=True):
+            started = time.time()
+            try:
+                plan = explain(query, parameters)
+                error = None
+            except Exception as e:
+                plan = None
+                error = str(e).strip()
+            self.write({'type': 'explain', 'sql': ' '.join(sql.split()),
+                        'query': ' '.join(query.split()), 'seconds': round(seconds, 3),
+                        'explain_seconds': round(time.time() - started, 3),
+                        'plan': plan, 'error': error})
+
+    def finish(self):
+        """Write the summary of the run and return it"""
+        if self.slowest:
+            self.explain()
+        stages = {}
+        for name, seconds, status in self.stages:
+            stages[name] = round(stages.get(name, 0) + seconds, 3)
+        summary = {'type': 'summary', 'name': self.name, 'run_id': self.run_id,
+                   'started_at': self.started_at, 'finished_at': _now(),
+                   'seconds': round(time.time() - self.started, 3),
+                   'stages': stages,
+                   'failed_stages': [name for name, _, status in self.stages if status != 'ok'],
+                   'statements': self.statements,
+                   'statement_seconds': round(self.statement_seconds, 3),
+                   'failed_statements': self.failed_statements}
+        self.write(summary)
+        self.file.close()
+        previous = last_summary(self.directory, self.name)
+        with open(os.path.join(self.directory, 'runs.jsonl'), 'a') as f:
+            f.write(json.dumps(summary, default=str) + '\n')
+        print_summary(summary, previous)
+        return summary
+
+
+def last_summary(directory, name):
+    """The last summary in runs.jsonl of a run with the same name"""
+    path = os.path.join(directory, 'runs.jsonl')
+    if not os.path.isfile(path):
+        return None
+    previous = None
+    with open(path, 'r') as f:
+        for line in f:
+            summary = json.loads(line)
+            if summary.get('name') == name:
+                previous = summary
+    return previous
+
+
+def print_summary(summary, previous=None):
+    print("{}: {:.1f}s, {} statements ({:.1f}s), {} failed".format(
+        summary['run_id'], summary['seconds'], summary['statements'],
+        summary['statement_seconds'], summary['failed_statements']))
+    for name, seconds in sorted(summary['stages'].items(), key=lambda item: -item[1]):
+        before = (previous or {}).get('stages', {}).get(name)
+        change = '' if not before else ' ({:+.0f}% vs {})'.format(
+            100.0 * (seconds - before) / before, previous['run_id'])
+        print("  {:10.1f}s  {}{}".format(seconds, name, change))
+
+
+_recorder = NullRecorder()
+
+
+def start_run(name, directory='profiles', explain_slowest=0):
+    """Start recording a run; stages and statements go to this run until finish_run"""
+    global _recorder
+    _recorder = Recorder(name, directory, explain_slowest)
+    return _recorder
+
+
+def finish_run():
+    global _recorder
+    recorder, _recorder = _recorder, NullRecorder()
+    if isinstance(recorder, Recorder):
+        return recorder.finish()
+    return None
+
+
+def get_recorder():
+    return _recorder
+
+
+def stage(name, **fields):
+    """Time a stage of the current run: `with stage('load raw'): ...`"""
+    return _recorder.stage(name, **fields)
+
+
+@contextlib.contextmanager
+def recorded_run(name, directory='profiles', explain_slowest=0):
+    """Record everything in the with block as one run; a None directory disables it"""
+    if directory is None:
+        yield None
+        return
+    recorder = start_run(name, directory, explain_slowest)
+    try:
+        yield recorder
+    finally:
+        finish_run()
+
+
+def record_statement(sql, seconds, rows=None, error=None, source=None, explain=None,
+                     parameters=None):
+    _recorder.statement(sql, seconds, rows=rows, error=error, source=source,
+                        explain=explain, parameters=parameters)
+
+
+def psycopg2_explainer(postgres_config):
+    """Function capturing the plan of a statement on a PostgresConfig connection"""
+    def explain(sql, parameters=None):
+        with postgres_config.connect() as conn, conn.cursor() as curs:
+            try:
+                curs.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, parameters)
+                return curs.fetchone()[0]
+            finally:
+                conn.rollback()
+    return explain
+
+
+def instrument_engine(engine):
+    """
+    Record every statement run through a sqlalchemy engine, with the rows
+    it affected, as a statement of the current run.
+    """
+    from sqlalchemy import event
+
+    def explain(sql, parameters=None):
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, parameters)
+            return cursor.fetchone()[0]
+        finally:
+            connection.rollback()
+            connection.close()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.time() - conn.info['query_start_time'].pop()
+        record_statement(statement, seconds, rows=cursor.rowcount, source='sqlalchemy',
+                         explain=None if executemany else explain, parameters=parameters)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('query_start_time') if context.connection else None
+        if starts:
+            record_statement(context.statement or '', time.time() - starts.pop(),
+                             error=context.original_exception, source='sqlalchemy')
+
+    return engine
@@ -5,46 +5,62 @@ Create cohort table for each time period
 # coding: utf-8
 
 import sys
-import yaml
+import time
+import argparse
 import sqlalchemy
-import logging
 import pandas as pd
 
+from concurrent.futures import ThreadPoolExecutor
+
 from sqlalchemy.sql import text
 
-logging.basicConfig(filename='events_table.log')
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+from db import get_engine
+from instrumentation import recorded_run, stage
 
+# Connection settings of every engine made here
+POSTGRES_CONFIG = '/group/dsapp-lab/luigi.yaml'
 
-def get_db_conn(postgres_config):
-    with open(postgres_config, 'r') as f:
-        config = yaml.load(f)
-    dbtype = 'postgres'
+# First and last as-of date of the study period
+STUDY_START_DATE = '2008-01-01'
+STUDY_END_DATE = '2016-12-31'
 
-    user = config['user']
-    host = config['host']
-    port = config['port']
-    db = config['database']
-    passcode = config['password']
-    url = '{}://{}:{}@{}:{}/{}'.format(dbtype,
-                                       user,
-                                       passcode,
-                                       host,
-                                       port,
-                                       db)
-    return sqlalchemy.create_engine(url, echo=False)
+# Days after the last appointment an mrn stays in the cohort
+COHORT_DAYS = 730
 
+EVENTS_COLUMNS = """
+                        entity_id integer,
+                        outcome_date date,
+                        outcome boolean"""
+OUTCOMES_COLUMNS = """
+                        entity_id integer,
+                        outcome_start_date date,
+                        outcome_end_date date,
+                        outcome boolean"""
 
-def create_events_table(table_name=None):
+
+def create_events_table(table_name=None, chunk_months=12, workers=1,
+                        retries=2):
     """
     Create events table with name table_name.
+    The as-of dates are inserted in chunks of chunk_months months, one
+    statement per chunk.
     In:
         - table_name: (str) optional, default is events
+        - chunk_months: (int) optional, months of as-of dates per statement
+        - workers: (int) optional, number of chunks built concurrently
+        - retries: (int) optional, times a failed chunk is retried when
+          workers > 1
     """
     if not table_name:
         table_name = 'events'
 
-    engine = get_db_conn('/group/dsapp-lab/luigi.yaml')
+    engine = get_engine(POSTGRES_CONFIG, pool_size=workers)
+    chunks = _as_of_date_chunks(STUDY_START_DATE, STUDY_END_DATE, chunk_months)
+    if workers > 1:
+        _build_in_parallel(engine, table_name, EVENTS_COLUMNS, _events_query,
+                           chunks, workers, retries)
+        return
+
     connection = engine.connect()
 
     drop_query = text("drop table if exists public.{};"
@@ -52,35 +68,57 @@ def create_events_table(table_name=None):
     connection.execute(drop_query)
 
     create_query = text("""
-                    CREATE TABLE IF NOT EXISTS public.{} (
-                        entity_id integer,
-                        outcome_date date,
-                        outcome boolean);
-                    """.format(table_name)).execution_options(autocommit=True)
+                    CREATE TABLE IF NOT EXISTS public.{} ({});
+                    """.format(table_name, EVENTS_COLUMNS)).execution_options(autocommit=True)
 
     connection.execute(create_query, table_name=table_name)
 
-    query = text("""
-                with observed_status as (
+    _execute_in_chunks(connection, _events_query(table_name), table_name, chunks)
+
+
+def _events_query(table_name):
+    """
+    Set-based events query for every as-of date between :chunk_start and
+    :chunk_end. The as-of dates come from generate_series, so only real
+    calendar dates are generated.
+    In:
+        - table_name: (str) table the events are inserted into
+    Out:
+        - (sqlalchemy TextClause) query taking chunk_start and chunk_end
+    """
+    return text("""
+                with as_of_dates as (
                                     select
+                                          as_of_date::date as outcome_date,
+                                          (as_of_date + '12 months'::interval)::date as window_end_date
+                                    from generate_series(cast(:chunk_start as timestamp),
+                                                         cast(:chunk_end as timestamp),
+                                                         '1 day'::interval) as as_of_date),
+                qualifying_visits as (
+                                    select distinct
                                           mrn,
+                                          start_date
+                                    from staging.id_visits
+                                    where source = 'encounter_diagnoses' and
+                                            qualifying),
+                observed_status as (
+                                    select
+                                          mrn,
+                                          outcome_date,
                                           case
                                             when max(start_date) - min(start_date) >= 90
                                                 then false --is adherent; gets turned into 0
                                             else true -- not adherent; gets turned into 1
                                           end as flag
-                                    from staging.encounter_diagnoses
-                                    where id_provider = 1 and
-                                            enc_eio_o = 1 and
-                                            attending_service in ('Infectious Diseases', 'Ped Infectious Diseases',
-                                                                    'Internal Medicine', 'Hematology/Oncology') and
-                                            start_date between :as_of_date and :as_of_date + '12 months'::interval
-                                    group by mrn)
+                                    from as_of_dates
+                                    join qualifying_visits
+                                        on start_date between outcome_date and window_end_date
+                                    group by mrn, outcome_date)
 
                 insert into public.{}
                 (entity_id, outcome_date, outcome)
                 select mrn as entity_id,
-                        :as_of_date as outcome_date,
+                        outcome_date,
                         case when flag = true
                                 then true
                             when flag is null
@@ -89,25 +127,159 @@ def create_events_table(table_name=None):
                         end as outcome
 
                 from staging.cohort_diagnoses
-                left join observed_status using (mrn);
+                cross join as_of_dates
+                left join observed_status using (mrn, outcome_date);
                 """.format(table_name)).execution_options(autocommit=True)
 
-    for year in range(2008, 2017):
-        for month in range(1, 13):
-            for day in range(1, 32):
-                try:
-                    connection.execute(query, as_of_date=pd.datetime(year, month, day, 0, 0))
-                except:
-                    continue
+
+def _as_of_date_chunks(start_date, end_date, chunk_months=12):
+    """
+    Split the as-of dates between start_date and end_date into consecutive
+    chunks of chunk_months calendar months.
+    In:
+        - start_date: (str) first as-of date
+        - end_date: (str) last as-of date, inclusive
+        - chunk_months: (int) optional, number of months per chunk
+    Out:
+        - (list) of (chunk_start, chunk_end) date tuples, both inclusive
+    """
+    chunks = []
+    chunk_start = pd.Timestamp(start_date)
+    end_date = pd.Timestamp(end_date)
+    while chunk_start <= end_date:
+        next_start = chunk_start + pd.DateOffset(months=chunk_months)
+        chunk_end = min(next_start - pd.Timedelta(days=1), end_date)
+        chunks.append((chunk_start.date(), chunk_end.date()))
+        chunk_start = next_start
+    return chunks
 
 
-def create_outcomes_table(table_name=None):
+def _execute_in_chunks(connection, query, table_name, chunks, **params):
+    """
+    Run query once per as-of date chunk and report the rows inserted and
+    the time taken by each chunk. Errors are raised, not skipped.
+    In:
+        - connection: sqlalchemy connection
+        - query: (sqlalchemy TextClause) taking chunk_start and chunk_end
+        - table_name: (str) table being built, only used for reporting
+        - chunks: (list) of (chunk_start, chunk_end) tuples
+        - params: additional query parameters
+    Out:
+        - (int) total number of rows inserted
+    """
+    total_rows = 0
+    for chunk_start, chunk_end in chunks:
+        total_rows += _execute_chunk(connection, query, table_name,
+                                     chunk_start, chunk_end, **params)
+    print("{}: {} rows in total".format(table_name, total_rows))
+    return total_rows
+
+
+def _execute_chunk(connection, query, table_name, chunk_start, chunk_end,
+                   **params):
+    """
+    Run query for a single as-of date chunk and report its row count and
+    timing.
+    Out:
+        - (int) number of rows inserted
+    """
+    started = time.time()
+    result = connection.execute(query,
+                                chunk_start=chunk_start,
+                                chunk_end=chunk_end,
+                                **params)
+    print("{}: {} to {}: {} rows in {:.1f}s".format(
+        table_name, chunk_start, chunk_end, result.rowcount,
+        time.time() - started))
+    return result.rowcount
+
+
+def _build_in_parallel(engine, table_name, columns, query_builder, chunks,
+                       workers, retries, **params):
+    """
+    Build table_name by running every as-of date chunk on its own pooled
+    connection. Each chunk writes into its own unlogged staging table
+    public.<table_name>_chunk_<n>; a failed chunk is retried on its own up
+    to retries times. Once every chunk succeeded, the staging tables are
+    combined into public.<table_name> in a single transaction, so readers
+    see either the old table or the complete new one.
+    In:
+        - engine: sqlalchemy engine with a pool of at least workers
+        - table_name: (str) table to build
+        - columns: (str) column definitions of the table
+        - query_builder: (function) returns the chunk query for a table name
+        - chunks: (list) of (chunk_start, chunk_end) tuples
+        - workers: (int) number of chunks built concurrently
+        - retries: (int) times a failed chunk is retried
+        - params: additional query parameters
+    Out:
+        - (int) total number of rows inserted
+    """
+    chunk_tables = ['{}_chunk_{}'.format(table_name, i)
+                    for i in range(len(chunks))]
+
+    def build_chunk(chunk_table, chunk_start, chunk_end):
+        for attempt in range(retries + 1):
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        "drop table if exists public.{};".format(chunk_table))
+                    connection.execute(
+                        "create unlogged table public.{} ({});"
+                        .format(chunk_table, columns))
+                    return _execute_chunk(connection,
+                                          query_builder(chunk_table),
+                                          table_name, chunk_start, chunk_end,
+                                          **params)
+            except sqlalchemy.exc.DBAPIError as e:
+                if attempt == retries:
+                    raise
+                print("{}: {} to {} failed (attempt {} of {}), retrying: {}"
+                      .format(table_name, chunk_start, chunk_end,
+                              attempt + 1, retries + 1, e))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build_chunk, chunk_table, *chunk)
+                       for chunk_table, chunk in zip(chunk_tables, chunks)]
+            total_rows = sum(future.result() for future in futures)
+
+        with engine.begin() as connection:
+            # cascade: views on the table, e.g. <cohort>_by_date, are
+            # created again by their own build
+            connection.execute(
+                "drop table if exists public.{} cascade;".format(table_name))
+            connection.execute(
+                "create table public.{} ({});".format(table_name, columns))
+            for chunk_table in chunk_tables:
+                connection.execute(
+                    "insert into public.{} select * from public.{};"
+                    .format(table_name, chunk_table))
+    finally:
+        with engine.begin() as connection:
+            for chunk_table in chunk_tables:
+                connection.execute(
+                    "drop table if exists public.{};".format(chunk_table))
+    print("{}: {} rows in total".format(table_name, total_rows))
+    return total_rows
+
+
+def create_outcomes_table(table_name=None, set_based=True, workers=1,
+                          chunk_months=12, retries=2):
     """
     Create outcomes table with name table_name.
     Outcomes table has the label (not-adherent(T) or adherent(F))
         for every mrn for every date range in the study
     In:
         - table_name: (str) optional, default is outcomes
+        - set_based: (bool) optional, build every as-of date in a single
+          statement (default) instead of one statement per day
+        - workers: (int) optional, when greater than 1 the set-based build
+          is split into chunks of chunk_months months built concurrently
+        - chunk_months: (int) optional, months of as-of dates per chunk
+        - retries: (int) optional, times a failed chunk is retried
+    Drops the <cohort>_by_date view of create_cohort_table, which
+        depends on the outcomes table; run create_cohort_table after it.
     Still todo:
         - add the count of visits in the interval as a parameter
           (default now is 2)
@@ -118,19 +290,35 @@ def create_outcomes_table(table_name=None):
     # This is the gap between appointments for them to count towards adherence
     prediction_horizon_time = 1
     prediction_horizon_unit = 'year'
-    engine = get_db_conn('/group/dsapp-lab/luigi.yaml')
+    engine = get_engine(POSTGRES_CONFIG, pool_size=workers)
+    if set_based and workers > 1:
+        _build_in_parallel(engine, table_name, OUTCOMES_COLUMNS,
+                           _outcomes_query,
+                           _as_of_date_chunks(STUDY_START_DATE,
+                                              STUDY_END_DATE, chunk_months),
+                           workers, retries,
+                           valid_appt_gap=valid_appt_gap,
+                           prediction_horizon_time=prediction_horizon_time,
+                           prediction_horizon_unit=prediction_horizon_unit)
+        return
     connection = engine.connect()
-    drop_query = text("drop table if exists public.{};"
+    # cascade: the <cohort>_by_date view depends on the outcomes table
+    drop_query = text("drop table if exists public.{} cascade;"
                       .format(table_name)).execution_options(autocommit=True)
     connection.execute(drop_query)
     create_query = text("""
-                        CREATE TABLE IF NOT EXISTS public.{} (
-                            entity_id integer,
-                            outcome_start_date date,
-                            outcome_end_date date,
-                            outcome boolean);
-                    """.format(table_name)).execution_options(autocommit=True)
+                        CREATE TABLE IF NOT EXISTS public.{} ({});
+                    """.format(table_name, OUTCOMES_COLUMNS)).execution_options(autocommit=True)
     connection.execute(create_query, table_name=table_name)
+    if set_based:
+        _execute_in_chunks(connection,
+                           _outcomes_query(table_name),
+                           table_name,
+                           [(STUDY_START_DATE, STUDY_END_DATE)],
+                           valid_appt_gap=valid_appt_gap,
+                           prediction_horizon_time=prediction_horizon_time,
+                           prediction_horizon_unit=prediction_horizon_unit)
+        return
     query = text("""
         with observed_status as (
             select
@@ -140,12 +328,9 @@ def create_outcomes_table(table_name=None):
                     then false --is adherent; gets turned into 0
                     else true -- not adherent; gets turned into 1
                     end as flag
-            from staging.encounter_diagnoses
-            where id_provider = 1
-                and enc_eio_o = 1 -- outpatient visit
-                and attending_service in ('Infectious Diseases',
-                    'Ped Infectious Diseases', 'Internal Medicine',
-                    'Hematology/Oncology')
+            from staging.id_visits
+            where source = 'encounter_diagnoses'
+                and qualifying -- outpatient visit to an ID provider
                 and start_date between :as_of_date
                     and :as_of_date
                         + cast(:prediction_horizon_time||' '||
@@ -156,12 +341,9 @@ def create_outcomes_table(table_name=None):
             select
                 mrn,
                 min(start_date) as min_start_date
-                from staging.encounter_diagnoses
-                where id_provider = 1
-                    and enc_eio_o = 1
-                    and attending_service in ('Infectious Diseases',
-                        'Ped Infectious Diseases', 'Internal Medicine',
-                        'Hematology/Oncology')
+                from staging.id_visits
+                where source = 'encounter_diagnoses'
+                    and qualifying
                 group by mrn )
         insert into public.{}
             (entity_id, outcome_start_date, outcome_end_date, outcome)
@@ -182,7 +364,7 @@ def create_outcomes_table(table_name=None):
         left join observed_status using (mrn)
         left join min_start_date x using (mrn);
         """.format(table_name)).execution_options(autocommit=True)
-    for d in pd.date_range('1-1-2008', '12-31-2016'):
+    for d in pd.date_range(STUDY_START_DATE, STUDY_END_DATE):
         connection.execute(query,
                            as_of_date=pd.datetime(d.year,
                                                   d.month, d.day, 0, 0),
@@ -191,63 +373,204 @@ def create_outcomes_table(table_name=None):
                            prediction_horizon_unit=prediction_horizon_unit)
 
 
-def create_cohort_table(table_name=None):
+def _outcomes_query(table_name):
+    """
+    Set-based version of the per-day outcomes query.
+    Every as-of date comes from generate_series and each qualifying visit
+    is range-joined to the as-of dates whose window contains it, so
+    staging.id_visits is scanned once instead of once per day.
+    In:
+        - table_name: (str) table the outcomes are inserted into
+    Out:
+        - (sqlalchemy TextClause) query taking chunk_start, chunk_end,
+          valid_appt_gap, prediction_horizon_time and prediction_horizon_unit
+    """
+    return text("""
+        with as_of_dates as (
+            select
+                as_of_date::date as outcome_start_date,
+                (as_of_date
+                    + cast(:prediction_horizon_time||' '||
+                        :prediction_horizon_unit as interval)
+                    - '1 day'::interval)::date as outcome_end_date
+            from generate_series(cast(:chunk_start as timestamp),
+                                 cast(:chunk_end as timestamp),
+                                 '1 day'::interval) as as_of_date ),
+        qualifying_visits as (
+            select distinct
+                mrn,
+                start_date
+            from staging.id_visits
+            where source = 'encounter_diagnoses'
+                and qualifying -- outpatient visit to an ID provider
+            ),
+        observed_status as (
+            select
+                mrn,
+                outcome_start_date,
+                case
+                    when max(start_date) - min(start_date) >= :valid_appt_gap
+                    then false --is adherent; gets turned into 0
+                    else true -- not adherent; gets turned into 1
+                    end as flag
+            from as_of_dates
+            join qualifying_visits
+                on start_date between outcome_start_date
+                    and outcome_end_date
+            group by mrn, outcome_start_date )
+        insert into public.{}
+            (entity_id, outcome_start_date, outcome_end_date, outcome)
+        select mrn as entity_id,
+            outcome_start_date,
+            outcome_end_date,
+            case
+                when flag = true
+                    then true
+                when flag is null
+                    then true
+                else false
+            end as outcome
+        from staging.cohort_diagnoses
+        cross join as_of_dates
+        left join observed_status using (mrn, outcome_start_date);
+        """.format(table_name)).execution_options(autocommit=True)
+
+
+def check_outcomes_parity(table_name=None, reference_table_name=None):
+    """
+    Build the outcomes table with both the set-based query and the
+    original per-day loop and compare them row for row.
+    In:
+        - table_name: (str) optional, default is outcomes
+        - reference_table_name: (str) optional, default is
+          <table_name>_reference
+    Out:
+        - (int) number of rows that are in only one of the two tables
+    """
+    if not table_name:
+        table_name = 'outcomes'
+    if not reference_table_name:
+        reference_table_name = '{}_reference'.format(table_name)
+    create_outcomes_table(table_name, set_based=True)
+    create_outcomes_table(reference_table_name, set_based=False)
+
+    engine = get_engine(POSTGRES_CONFIG)
+    query = """
+            select count(*)
+            from (
+                (select * from public.{a} except all
+                 select * from public.{b})
+                union all
+                (select * from public.{b} except all
+                 select * from public.{a})
+            ) as mismatches;
+    """.format(a=table_name, b=reference_table_name)
+    mismatches = engine.execute(query).scalar()
+    if mismatches:
+        print("Parity check failed: {} rows differ between {} and {}"
+              .format(mismatches, table_name, reference_table_name))
+    else:
+        print("Parity check passed: {} and {} are identical"
+              .format(table_name, reference_table_name))
+    return mismatches
+
+
+def create_cohort_table(table_name=None, outcomes_table_name=None):
     """
     Create cohort table with name table_name.
-    Cohort table has the whether an mrn is in the cohort or not for
-        every date range in the study
+    Cohort table has, for every mrn, the dates it is in the cohort as one
+        daterange, from its first appointment until COHORT_DAYS days after
+        its last one. The ranges are GiST-indexed, so the members at a
+        date are an index lookup, through the SQL function
+        <table_name>_as_of(date) or cohort_as_of. The view
+        <table_name>_by_date has the former form of the table: whether an
+        mrn is in the cohort for every date range of the outcomes table.
     In:
         - table_name: (str) optional, default is cohort
+        - outcomes_table_name: (str) optional, default is outcomes
     """
     if not table_name:
         table_name = 'cohort'
-    engine = get_db_conn('/group/dsapp-lab/luigi.yaml')
+    if not outcomes_table_name:
+        outcomes_table_name = 'outcomes'
+    engine = get_engine(POSTGRES_CONFIG)
     connection = engine.connect()
-    drop_query = text("drop table if exists public.{};"
+    drop_query = text("drop table if exists public.{} cascade;"
                       .format(table_name)).execution_options(autocommit=True)
     connection.execute(drop_query)
-    query = """
-            create temp table last_appt as
-            select distinct on (mrn)
-                mrn, start_date as last_appt_date
-            from staging.encounter_diagnoses
-            where mrn in (select distinct(mrn) from public.events)
+    create_query = """
+    create table public.{table} as
+        with last_appt as (
+            select mrn, max(start_date) as last_appt_date
+            from staging.id_visits
+            where source = 'encounter_diagnoses'
+                and mrn in (select distinct(mrn) from public.events)
                 and attending_service in ('Hematology/Oncology',
                     'Infectious Diseases', 'Ped Infectious Disease',
                     'Internal Medicine')
-            order by 1, 2 desc;
-    """
-    connection.execute(query)
-    query = """
-            create temp table first_appt as
-            select distinct on (mrn)
-                mrn, start_date as first_appt_date
-            from staging.appt_status
-            where mrn in (select distinct(mrn) from public.events)
+            group by mrn ),
+        first_appt as (
+            select mrn, min(start_date) as first_appt_date
+            from staging.id_visits
+            where source = 'appt_status'
+                and mrn in (select distinct(mrn) from public.events)
                 and attending_service in ('Hematology/Oncology',
                     'Infectious Diseases', 'Ped Infectious Disease',
                     'Internal Medicine')
-            order by 1, 2 asc;
-    """
-    connection.execute(query)
-    # every mrn, every date, in or out of cohort
-    create_query = """
-    create table cohort as
-        with appts as (
-            select x.mrn, first_appt_date, last_appt_date
-            from last_appt x
-            join first_appt y on x.mrn=y.mrn
-        )
+            group by mrn )
         select mrn, first_appt_date, last_appt_date,
-            outcome_start_date, outcome_end_date,
-            outcome_end_date - last_appt_date as days_since_last_appt,
-            (outcome_start_date - last_appt_date) < 730
-                AND (outcome_start_date - first_appt_date) >= 0 as in_cohort
-        from appts a
-        join outcomes y
-        on a.mrn = y.entity_id;
-    """
+            -- empty when the last appointment is too long before the first
+            daterange(first_appt_date,
+                      greatest(first_appt_date, last_appt_date + {days}))
+                as in_cohort
+        from last_appt
+        join first_appt using (mrn);
+    """.format(table=table_name, days=COHORT_DAYS)
     connection.execute(create_query)
+    connection.execute("""
+        create unique index {table}_mrn_idx on public.{table} (mrn);
+        create index {table}_in_cohort_idx on public.{table} using gist (in_cohort);
+        analyze public.{table};
+    """.format(table=table_name))
+    # Members at a date, e.g. as a Triage cohort query:
+    # select entity_id from cohort_as_of('{as_of_date}'::date)
+    connection.execute("""
+        create or replace function public.{table}_as_of(as_of_date date)
+        returns table (entity_id integer, first_appt_date date,
+                       last_appt_date date) as $$
+            select c.mrn, c.first_appt_date, c.last_appt_date
+            from public.{table} c
+            where c.in_cohort @> $1;
+        $$ language sql stable;
+    """.format(table=table_name))
+    # every mrn, every date, in or out of cohort
+    connection.execute("""
+        create view public.{table}_by_date as
+            select mrn, first_appt_date, last_appt_date,
+                outcome_start_date, outcome_end_date,
+                outcome_end_date - last_appt_date as days_since_last_appt,
+                in_cohort @> outcome_start_date as in_cohort
+            from public.{table} c
+            join public.{outcomes} y
+            on c.mrn = y.entity_id;
+    """.format(table=table_name, outcomes=outcomes_table_name))
+
+
+def cohort_as_of(as_of_date, table_name=None):
+    """
+    MRNs in the cohort at a date, looked up in the cohort table's index.
+    In:
+        - as_of_date: (str or date) e.g. '2012-06-01'
+        - table_name: (str) optional, default is cohort
+    Out:
+        - (list) mrns, in ascending order
+    """
+    if not table_name:
+        table_name = 'cohort'
+    engine = get_engine(POSTGRES_CONFIG)
+    query = text("select entity_id from public.{}_as_of(cast(:as_of_date as date)) "
+                 "order by 1;".format(table_name))
+    return [row[0] for row in engine.execute(query, as_of_date=as_of_date)]
 
 
 if __name__ == '__main__':
@@ -262,18 +585,48 @@ if __name__ == '__main__':
     To use option b, use:
     python label_maker.py 'some_other_string' outcome_table_name cohort_table_name
 
+    To check that the set-based outcomes table matches the per-day loop, use:
+    python label_maker.py 'outcomes_parity' outcome_table_name
+
     If options are used without passing table names, the functions still run, but tables
     are created with default names.
+
+    Pass --workers N to build the events or outcomes table in chunks of
+    --chunk-months months on N concurrent connections.
     """
-    if sys.argv[1] == 'triage_events':
-        if len(sys.argv) == 3:
-            create_events_table(sys.argv[2])
-        else:
-            create_events_table()
-    else:
-        if len(sys.argv) == 4:
-            create_outcomes_table(sys.argv[2])
-            create_cohort_table(sys.argv[3])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('option')
+    parser.add_argument('table_names', nargs='*')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-months', type=int, default=12)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--config', default=POSTGRES_CONFIG,
+                        help='yaml file with the database connection')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--explain-slowest', type=int, default=0)
+    args = parser.parse_args()
+    POSTGRES_CONFIG = args.config
+
+    with recorded_run('label_maker', args.profile_dir, args.explain_slowest):
+        if args.option == 'triage_events':
+            with stage('events table'):
+                create_events_table(*args.table_names[:1],
+                                    chunk_months=args.chunk_months,
+                                    workers=args.workers,
+                                    retries=args.retries)
+        elif args.option == 'outcomes_parity':
+            with stage('outcomes parity'):
+                mismatches = check_outcomes_parity(*args.table_names[:1])
+            sys.exit(1 if mismatches else 0)
         else:
-            create_outcomes_table()
-            create_cohort_table()
+            if len(args.table_names) == 2:
+                outcome_table_name, cohort_table_name = args.table_names
+            else:
+                outcome_table_name, cohort_table_name = None, None
+            with stage('outcomes table'):
+                create_outcomes_table(outcome_table_name,
+                                      workers=args.workers,
+                                      chunk_months=args.chunk_months,
+                                      retries=args.retries)
+            with stage('cohort table'):
+                create_cohort_table(cohort_table_name, outcome_table_name)
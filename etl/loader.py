@@ -0,0 +1,269 @@
+"""
+Stream CSV files into Postgres with COPY ... FROM STDIN
+"""
+import gzip
+import hashlib
+import os
+import time
+from collections import deque
+
+import click
+import pandas as pd
+
+from transforms import has_transforms, to_csv_bytes, transform_chunk
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bytes handed to the server per read; copy_expert pulls the next buffer
+# only after the previous one was sent, so memory use stays bounded.
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# Rows parsed at a time when columns have to be converted before COPY
+DEFAULT_CHUNK_ROWS = 100000
+
+
+def open_csv(file_name):
+    """
+    Open a CSV file for binary reading, decompressing .gz and .zst files
+    on the fly.
+
+    Parameter
+    ---------
+    file_name: str
+       path to the (optionally compressed) CSV file
+
+    Return
+    ------
+    stream: file-like object
+       binary stream of the uncompressed CSV
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    if file_name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("The zstandard package is needed to load {}"
+                              .format(file_name))
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'),
+                                                          closefd=True)
+    return open(file_name, 'rb')
+
+
+class ChunkStream(object):
+    """
+    File-like object reading from an iterator of byte strings, so chunks
+    converted in Python can be streamed into copy_expert one at a time.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # Chunks not handed out yet; the first one from offset on
+        self.pending = deque()
+        self.offset = 0
+        self.available = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.available < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                self.pending.append(chunk)
+                self.available += len(chunk)
+        if size < 0 or size > self.available:
+            size = self.available
+        parts = []
+        remaining = size
+        while remaining:
+            chunk = self.pending[0]
+            end = min(self.offset + remaining, len(chunk))
+            parts.append(chunk[self.offset:end])
+            remaining -= end - self.offset
+            if end == len(chunk):
+                self.pending.popleft()
+                self.offset = 0
+            else:
+                self.offset = end
+        self.available -= size
+        return b''.join(parts)
+
+
+class ProgressReader(object):
+    """
+    File-like wrapper that counts and hashes the bytes read through it and
+    periodically echoes the throughput. The hash continues digest, if
+    given, e.g. the hash of the bytes before the stream's position.
+    """
+    def __init__(self, stream, label, report_every=10.0, digest=None):
+        self.stream = stream
+        self.digest = digest or hashlib.sha256()
+        self.label = label
+        self.report_every = report_every
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.ends_line = True
+        self.started = time.time()
+        self.last_report = self.started
+
+    def readable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.bytes_read += len(data)
+        self.lines_read += data.count(b'\n')
+        if data:
+            self.ends_line = data.endswith(b'\n')
+        elif not self.ends_line:
+            # A last line without a newline still counts once the end is read
+            self.lines_read += 1
+            self.ends_line = True
+        now = time.time()
+        if now - self.last_report >= self.report_every:
+            self.report()
+            self.last_report = now
+        return data
+
+    read1 = read
+
+    def report(self, done=False):
+        elapsed = max(time.time() - self.started, 1e-6)
+        click.echo("{}: {}{} rows, {:.1f} MB in {:.0f}s ({:.0f} rows/s)".format(
+            self.label,
+            'loaded ' if done else '',
+            self.lines_read,
+            self.bytes_read / 1e6,
+            elapsed,
+            self.lines_read / elapsed))
+
+
+def copy_csv(postgres_config, file_name, schema, table_name, column_names,
+             column_map=None, buffer_size=DEFAULT_BUFFER_SIZE,
+             chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Stream a CSV file with a header row into schema.table_name.
+
+    If the column map converts any column, the file is parsed in chunks of
+    chunk_rows rows, the columns are converted with transform_chunk and the
+    converted chunks are streamed into COPY; otherwise the file's bytes are
+    copied as they are.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+       database to load into
+    file_name: str
+       path to the (optionally compressed) CSV file
+    schema: str
+       schema of the target table
+    table_name: str
+       name of the target table
+    column_names: list
+       target column names, in the order of the CSV columns
+    column_map: dict
+       column_map of the inventory entry
+    buffer_size: int
+       bytes sent to the server per round trip
+    chunk_rows: int
+       rows converted at a time
+
+    Return
+    ------
+    lines: int
+       number of lines read from the file, excluding the header
+    content_hash: str
+       sha256 of the uncompressed file content
+    """
+    transform = has_transforms(column_map or {})
+    copy_statement = (
+        "COPY \"{schema}\".\"{table_name}\" ({column_names}) FROM STDIN "
+        "WITH CSV {header}NULL ''".format(
+            schema=schema,
+            table_name=table_name,
+            column_names=','.join('"{}"'.format(name) for name in column_names),
+            header='' if transform else 'HEADER '))
+    with open_csv(file_name) as stream:
+        reader = ProgressReader(stream, '{}.{}'.format(schema, table_name))
+        coerced = {}
+        if transform:
+            source = _converted_chunks(reader, column_map, coerced, chunk_rows)
+        else:
+            source = reader
+        postgres_config.copy_expert(copy_statement, source, size=buffer_size)
+        reader.lines_read = max(reader.lines_read - 1, 0)
+        reader.report(done=True)
+        _report_coerced(schema, table_name, coerced)
+    return reader.lines_read, reader.digest.hexdigest()
+
+
+def copy_csv_tail(postgres_config, file_name, schema, table_name, offset,
+                  prefix_digest, column_map=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                  chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Stream the part of an uncompressed CSV file after byte offset, which
+    must be the start of a line, into schema.table_name. The columns are
+    matched by position, as the table was created from the same file, and
+    converted with the column map as copy_csv does, the column names being
+    read from the file's header.
+
+    The bytes streamed are hashed as they are read, following
+    prefix_digest, the sha256 object of the bytes before offset, so the
+    returned fingerprint describes exactly the part of the file that is
+    loaded, even if the file grew again in the meantime.
+
+    Return
+    ------
+    lines: int
+       number of lines streamed
+    fingerprint: dict
+       file_size (the offset after the last byte streamed), file_mtime
+       and content_hash of the loaded part of the file
+    """
+    transform = has_transforms(column_map or {})
+    copy_statement = (
+        "COPY \"{schema}\".\"{table_name}\" FROM STDIN "
+        "WITH CSV NULL ''".format(schema=schema, table_name=table_name))
+    with open(file_name, 'rb') as stream:
+        coerced = {}
+        if transform:
+            header = pd.read_csv(stream, dtype=str, nrows=0).columns
+        stream.seek(offset)
+        reader = ProgressReader(stream, '{}.{} (appended rows)'.format(
+            schema, table_name), digest=prefix_digest.copy())
+        if transform:
+            source = _converted_chunks(reader, column_map, coerced, chunk_rows,
+                                       names=list(header))
+        else:
+            source = reader
+        postgres_config.copy_expert(copy_statement, source, size=buffer_size)
+        reader.report(done=True)
+        _report_coerced(schema, table_name, coerced)
+        file_mtime = os.fstat(stream.fileno()).st_mtime
+    return reader.lines_read, {'file_size': offset + reader.bytes_read,
+                               'file_mtime': file_mtime,
+                               'content_hash': reader.digest.hexdigest()}
+
+
+def _converted_chunks(reader, column_map, coerced, chunk_rows, names=None):
+    """
+    Parse a CSV stream in chunks of chunk_rows rows and stream them back
+    as headerless CSV once converted with transform_chunk. names are the
+    column names of a stream without a header.
+    """
+    # Only empty fields are nulls, as in a plain COPY
+    chunks = pd.read_csv(reader, dtype=str, keep_default_na=False,
+                         na_values=[''], chunksize=chunk_rows,
+                         header=None if names else 'infer', names=names)
+    return ChunkStream(to_csv_bytes(transform_chunk(chunk, column_map, coerced))
+                       for chunk in chunks)
+
+
+def _report_coerced(schema, table_name, coerced):
+    for column_name, count in sorted(coerced.items()):
+        click.echo("{}.{}: {} values of column {} could not be converted and "
+                   "were loaded as nulls".format(schema, table_name, count, column_name))
@@ -0,0 +1,181 @@
+"""
+Manifest of the files loaded into the raw schema, used to reload only
+the inventory entries whose file changed since the last load
+"""
+import hashlib
+import os
+
+from loader import DEFAULT_BUFFER_SIZE, open_csv
+
+MANIFEST_TABLE = 'load_manifest'
+
+
+def is_compressed(file_name):
+    return file_name.endswith('.gz') or file_name.endswith('.zst')
+
+
+def fingerprint_file(file_name, prefix_size=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Hash the uncompressed content of a file in a single streaming pass.
+
+    Parameter
+    ---------
+    file_name: str
+       path to the (optionally compressed) CSV file
+    prefix_size: int
+       if given, also hash the first prefix_size bytes, so a file that has
+       only grown can be recognised
+
+    Return
+    ------
+    fingerprint: dict
+       file_size, file_mtime, content_hash and prefix_hash (None if no
+       prefix_size was given or the file is shorter than prefix_size),
+       and prefix_digest, the sha256 object of the prefix, from which the
+       hash of the prefix followed by other bytes can be computed
+    """
+    stat = os.stat(file_name)
+    digest = hashlib.sha256()
+    prefix_hash = None
+    prefix_digest = None
+    bytes_read = 0
+    with open_csv(file_name) as stream:
+        while True:
+            size = buffer_size
+            if prefix_size is not None and prefix_hash is None:
+                size = min(size, prefix_size - bytes_read)
+            data = stream.read(size) if size else b''
+            digest.update(data)
+            bytes_read += len(data)
+            if prefix_size is not None and prefix_hash is None \
+                    and bytes_read == prefix_size:
+                prefix_hash = digest.hexdigest()
+                prefix_digest = digest.copy()
+                continue
+            if not data:
+                break
+    return {'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'content_hash': digest.hexdigest(),
+            'prefix_hash': prefix_hash,
+            'prefix_digest': prefix_digest}
+
+
+def ensure_manifest(postgres_config, schema):
+    """Create the manifest table in schema if it does not exist yet"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+        curs.execute("""CREATE TABLE IF NOT EXISTS "{}"."{}" (
+                          table_name text PRIMARY KEY,
+                          file_name text,
+                          file_size bigint,
+                          file_mtime double precision,
+                          content_hash text,
+                          rows_loaded bigint,
+                          loaded_at timestamp DEFAULT now());
+                     """.format(schema, MANIFEST_TABLE))
+
+
+def get_entry(postgres_config, schema, table_name):
+    """
+    Return the manifest entry of a table as a dict, or None if the table
+    has not been recorded
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""SELECT file_name, file_size, file_mtime, content_hash,
+                               rows_loaded
+                          FROM "{}"."{}"
+                         WHERE table_name = %s;
+                     """.format(schema, MANIFEST_TABLE), (table_name,))
+        row = curs.fetchone()
+    if row is None:
+        return None
+    return dict(zip(['file_name', 'file_size', 'file_mtime', 'content_hash',
+                     'rows_loaded'], row))
+
+
+def get_entries(postgres_config, schema):
+    """
+    Return the manifest entries of every recorded table of a schema as a
+    dict of dicts keyed by table name, with a single query
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""SELECT table_name, file_name, file_size, file_mtime,
+                               content_hash, rows_loaded
+                          FROM "{}"."{}";
+                     """.format(schema, MANIFEST_TABLE))
+        rows = curs.fetchall()
+    return dict((row[0], dict(zip(['file_name', 'file_size', 'file_mtime',
+                                   'content_hash', 'rows_loaded'], row[1:])))
+                for row in rows)
+
+
+def record_load(postgres_config, schema, table_name, file_name, fingerprint,
+                rows_loaded):
+    """Insert or replace the manifest entry of a table"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""INSERT INTO "{}"."{}"
+                            (table_name, file_name, file_size, file_mtime,
+                             content_hash, rows_loaded, loaded_at)
+                        VALUES (%(table_name)s, %(file_name)s, %(file_size)s,
+                                %(file_mtime)s, %(content_hash)s,
+                                %(rows_loaded)s, now())
+                        ON CONFLICT (table_name) DO UPDATE
+                           SET file_name = EXCLUDED.file_name,
+                               file_size = EXCLUDED.file_size,
+                               file_mtime = EXCLUDED.file_mtime,
+                               content_hash = EXCLUDED.content_hash,
+                               rows_loaded = EXCLUDED.rows_loaded,
+                               loaded_at = EXCLUDED.loaded_at;
+                     """.format(schema, MANIFEST_TABLE),
+                     {'table_name': table_name,
+                      'file_name': file_name,
+                      'file_size': fingerprint['file_size'],
+                      'file_mtime': fingerprint['file_mtime'],
+                      'content_hash': fingerprint['content_hash'],
+                      'rows_loaded': rows_loaded})
+
+
+def plan_reload(file_name, entry, append_tail=False):
+    """
+    Decide what to do with an inventory file whose table already exists.
+
+    Parameter
+    ---------
+    file_name: str
+       path to the CSV file
+    entry: dict
+       manifest entry of the table, as returned by get_entry
+    append_tail: bool
+       whether a file that has only grown may be loaded by appending its
+       new lines instead of reloading it
+
+    Return
+    ------
+    action: str
+       'skip', 'append' or 'reload'
+    fingerprint: dict
+       fingerprint of the file, None if size and mtime did not change
+    """
+    stat = os.stat(file_name)
+    if stat.st_size == entry['file_size'] and stat.st_mtime == entry['file_mtime']:
+        return 'skip', None
+
+    can_append = (append_tail
+                  and not is_compressed(file_name)
+                  and stat.st_size > entry['file_size'] > 0)
+    fingerprint = fingerprint_file(
+        file_name, prefix_size=entry['file_size'] if can_append else None)
+    if fingerprint['content_hash'] == entry['content_hash']:
+        return 'skip', fingerprint
+    if can_append and fingerprint['prefix_hash'] == entry['content_hash'] \
+            and _ends_line(file_name, entry['file_size']):
+        return 'append', fingerprint
+    return 'reload', fingerprint
+
+
+def _ends_line(file_name, offset):
+    """Whether the byte before offset is a newline"""
+    with open(file_name, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
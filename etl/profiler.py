@@ -0,0 +1,192 @@
+"""
+Infer Postgres column types from a whole CSV file and cache the result
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from loader import open_csv
+from manifest import fingerprint_file
+
+INT_PATTERN = r'^[+-]?\d+$'
+DATE_PATTERN = r'^\d{4}-\d{2}-\d{2}$'
+TIMESTAMP_PATTERN = r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?$'
+
+
+class ColumnProfile(object):
+    """
+    Running summary of the values seen in a single column. Every check is
+    done on a whole chunk at once and a check is dropped as soon as one
+    value fails it.
+    """
+    def __init__(self):
+        self.non_null = 0
+        self.is_numeric = True
+        self.is_integer = True
+        self.is_date = True
+        self.is_timestamp = True
+        self.min_value = None
+        self.max_value = None
+
+    def update(self, values):
+        values = values.dropna()
+        if values.empty:
+            return
+        values = values.str.strip()
+        self.non_null += len(values)
+
+        if self.is_numeric:
+            numbers = pd.to_numeric(values, errors='coerce')
+            if numbers.isna().any():
+                self.is_numeric = self.is_integer = False
+            elif self.is_integer:
+                self.is_integer = bool(values.str.match(INT_PATTERN).all())
+                if self.is_integer:
+                    low, high = int(numbers.min()), int(numbers.max())
+                    self.min_value = low if self.min_value is None else min(self.min_value, low)
+                    self.max_value = high if self.max_value is None else max(self.max_value, high)
+
+        if self.is_date:
+            self.is_date = (bool(values.str.match(DATE_PATTERN).all())
+                            and pd.to_datetime(values, format='%Y-%m-%d',
+                                               errors='coerce').notna().all())
+        if self.is_timestamp and not self.is_date:
+            self.is_timestamp = (bool(values.str.match(TIMESTAMP_PATTERN).all())
+                                 and pd.to_datetime(values, errors='coerce').notna().all())
+
+    def postgres_type(self):
+        if self.non_null == 0:
+            return 'text'
+        if self.is_integer:
+            if -2 ** 15 <= self.min_value and self.max_value < 2 ** 15:
+                return 'smallint'
+            if -2 ** 31 <= self.min_value and self.max_value < 2 ** 31:
+                return 'integer'
+            if -2 ** 63 <= self.min_value and self.max_value < 2 ** 63:
+                return 'bigint'
+            return 'numeric'
+        if self.is_numeric:
+            return 'double precision'
+        if self.is_date:
+            return 'date'
+        if self.is_timestamp:
+            return 'timestamp'
+        return 'text'
+
+
+def profile_csv(file_name, chunksize=100000, sample_rows=None, seed=0):
+    """
+    Infer the tightest Postgres type of every column of a CSV file.
+
+    Dates are only recognised in ISO format (YYYY-MM-DD). Locale-formatted
+    dates such as MM/DD/YYYY stay text, because the staging queries
+    convert those with to_date and an explicit format.
+
+    Parameter
+    ---------
+    file_name: str
+       path to the (optionally compressed) CSV file
+    chunksize: int
+       rows parsed at a time
+    sample_rows: int
+       if given, profile a uniform random sample of this many rows drawn
+       across the whole file instead of every row
+
+    Return
+    ------
+    columns: list
+       (column name, postgres type) tuples in file order
+    """
+    with open_csv(file_name) as stream:
+        # Only empty fields are nulls, as in the COPY that loads the file
+        reader = pd.read_csv(stream, dtype=str, keep_default_na=False,
+                             na_values=[''], chunksize=chunksize)
+        profiles = None
+        reservoir = None
+        random_state = np.random.RandomState(seed)
+        for chunk in reader:
+            if profiles is None:
+                profiles = [(column, ColumnProfile()) for column in chunk.columns]
+            if sample_rows:
+                # Bottom-k sampling: keep the rows with the smallest random keys.
+                chunk = chunk.assign(_sample_key=random_state.random_sample(len(chunk)))
+                if reservoir is not None:
+                    chunk = pd.concat([reservoir, chunk])
+                reservoir = chunk.nsmallest(sample_rows, '_sample_key')
+                continue
+            for column, profile in profiles:
+                profile.update(chunk[column])
+
+    if profiles is None:
+        return []
+    if reservoir is not None:
+        for column, profile in profiles:
+            profile.update(reservoir[column])
+    return [(column, profile.postgres_type()) for column, profile in profiles]
+
+
+def create_table_statement(schema, table_name, columns):
+    """CREATE TABLE statement for a list of (column name, type) tuples"""
+    return 'CREATE TABLE "{}"."{}" (\n{}\n)'.format(
+        schema, table_name,
+        ',\n'.join('"{}" {}'.format(name, column_type)
+                   for name, column_type in columns))
+
+
+class ProfileCache(object):
+    """
+    Inferred column types of the inventory files, stored in a YAML file
+    next to the inventory and keyed by table name. An entry is reused as
+    long as its file has the same size and mtime, or the same content
+    hash. Safe to share between loader threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.profiles = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.profiles = yaml.safe_load(f) or {}
+
+    @classmethod
+    def for_inventory(cls, inventory_path):
+        return cls(os.path.splitext(inventory_path)[0] + '_profiles.yaml')
+
+    def get_columns(self, table_name, file_name, fingerprint=None, **profile_options):
+        """
+        Return the cached (column name, postgres type) tuples of a file,
+        profiling it first if it is new or its content changed. fingerprint
+        is the file's fingerprint_file result, if the caller already took
+        it; the file is then not hashed again.
+        """
+        with self.lock:
+            entry = self.profiles.get(table_name)
+        stat = os.stat(file_name)
+        if entry and entry['file_name'] == file_name:
+            if entry['file_size'] == stat.st_size and entry['file_mtime'] == stat.st_mtime:
+                return [tuple(column) for column in entry['columns']]
+            fingerprint = fingerprint or fingerprint_file(file_name)
+            if fingerprint['content_hash'] == entry['content_hash']:
+                self._put(table_name, file_name, fingerprint, entry['columns'])
+                return [tuple(column) for column in entry['columns']]
+        else:
+            fingerprint = fingerprint or fingerprint_file(file_name)
+
+        columns = profile_csv(file_name, **profile_options)
+        self._put(table_name, file_name, fingerprint, columns)
+        return columns
+
+    def _put(self, table_name, file_name, fingerprint, columns):
+        with self.lock:
+            self.profiles[table_name] = {
+                'file_name': file_name,
+                'file_size': fingerprint['file_size'],
+                'file_mtime': fingerprint['file_mtime'],
+                'content_hash': fingerprint['content_hash'],
+                'columns': [list(column) for column in columns],
+            }
+            with open(self.path, 'w') as f:
+                yaml.safe_dump(self.profiles, f, default_flow_style=False)
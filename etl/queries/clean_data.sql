@@ -1223,3 +1223,57 @@ CREATE INDEX rw_mrns_mrn
 #####################
 #####################
 */
+
+
+/*
+Visits to the Infectious Diseases clinic, from both the encounter and the
+appointment status tables, filtered once here for the states table, the
+labels and the previous appointment count. qualifying marks the
+outpatient visits (enc_eio_o = 1) with an ID provider (id_provider = 1)
+in one of the four ID clinic services. 'Ped Infectious Disease' is kept
+as well, because the cohort table of label_maker.py selects visits by
+that name.
+*/
+DROP TABLE IF EXISTS
+     staging.id_visits;
+
+CREATE TABLE staging.id_visits AS(
+  SELECT
+      source,
+      mrn,
+      start_date,
+      end_date,
+      attending_service,
+      encounter_type,
+      appt_status,
+      coalesce(id_provider = 1 AND enc_eio_o = 1
+               AND attending_service IN ('Infectious Diseases', 'Ped Infectious Diseases',
+                                         'Internal Medicine', 'Hematology/Oncology'),
+               false) AS qualifying
+  FROM
+    (SELECT 'encounter_diagnoses'::text AS source, mrn, start_date, end_date,
+            attending_service, id_provider, enc_eio_o,
+            NULL::text AS encounter_type, NULL::text AS appt_status
+       FROM staging.encounter_diagnoses
+     UNION ALL
+     SELECT 'appt_status'::text AS source, mrn, start_date, end_date,
+            attending_service, id_provider, enc_eio_o,
+            encounter_type::text, appt_status::text
+       FROM staging.appt_status) AS visits
+  WHERE
+    attending_service IN ('Infectious Diseases', 'Ped Infectious Diseases',
+                          'Ped Infectious Disease', 'Internal Medicine',
+                          'Hematology/Oncology')
+  ORDER BY source, mrn, start_date);
+
+/*
+Adding indexes on important columns.
+*/
+DROP INDEX IF EXISTS id_visits_mrn_start_date;
+CREATE INDEX id_visits_mrn_start_date ON staging.id_visits (mrn, start_date);
+
+DROP INDEX IF EXISTS id_visits_qualifying_start_date;
+CREATE INDEX id_visits_qualifying_start_date
+  ON staging.id_visits (source, start_date) WHERE qualifying;
+
+ANALYZE staging.id_visits;
@@ -10,12 +10,10 @@ CREATE TABLE states AS(
 		select
 			mrn,
 			min(start_date) as earliest_appt_date
-		from staging.appt_status
+		from staging.id_visits
 		where
-			enc_eio_o = 1 and
-			id_provider = 1 and
-			attending_service in ('Infectious Diseases', 'Ped Infectious Diseases',
-									'Internal Medicine', 'Hematology/Oncology') and
+			source = 'appt_status' and
+			qualifying and
 			encounter_type in ('Appointment', 'Office Visit', 'Hospital Encounter',
 								'Nurse-Only visit', 'Procedure') and
 			appt_status in ('Completed', 'Canceled', 'No Show',
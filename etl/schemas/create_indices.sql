@@ -1,49 +1,44 @@
-CREATE INDEX ON patients_ucm.main (patient_id);
-CREATE INDEX ON patients_ucm.names (entity_id);
-CREATE INDEX ON patients_ucm.demographics (entity_id);
+/*
+ * Every index is named and created only if it does not exist yet. Build
+ * the missing ones in parallel with:
+ *
+ *     python etl/indexes.py etl/schemas/create_indices.sql --workers 4
+ *
+ * which builds the index of every partition of a partitioned table on
+ * its own, concurrently, and attaches them to the index of the table.
+ */
+CREATE INDEX IF NOT EXISTS main_patient_id_idx ON patients_ucm.main (patient_id);
+CREATE INDEX IF NOT EXISTS names_entity_id_idx ON patients_ucm.names (entity_id);
+CREATE INDEX IF NOT EXISTS demographics_entity_id_idx ON patients_ucm.demographics (entity_id);
 
 
 
 /*
  * Indices on the events table
+ *
+ * events_ucm.events is partitioned by event_type, so queries on a single
+ * event type only scan its partition and need no event_type index. The
+ * visit, lab and treatment partitions are partitioned again by year; the
+ * BRIN indices narrow the scans within a year, and stay small.
  */
 /* Basic indices */
-DROP INDEX events_ucm.idx_event_type;
-CREATE INDEX CONCURRENTLY idx_event_type ON events_ucm.events (event_type);
-DROP INDEX events_ucm.idx_entity_id;
-CREATE INDEX CONCURRENTLY idx_entity_id ON events_ucm.events (entity_id);
-DROP INDEX events_ucm.idx_batch_id;
-CREATE INDEX CONCURRENTLY idx_batch_id ON events_ucm.events (batch_id);
-DROP INDEX events_ucm.idx_update_date;
-CREATE INDEX CONCURRENTLY idx_update_date ON events_ucm.events (update_date);
-DROP INDEX events_ucm.idx_visit_date;
-CREATE INDEX CONCURRENTLY idx_visit_date ON events_ucm.events (visit_date);
+CREATE INDEX IF NOT EXISTS idx_event_id ON events_ucm.events (event_id);
+CREATE INDEX IF NOT EXISTS idx_entity_id ON events_ucm.events (entity_id);
+CREATE INDEX IF NOT EXISTS idx_batch_id ON events_ucm.events (batch_id);
+CREATE INDEX IF NOT EXISTS idx_update_date ON events_ucm.events USING brin (update_date);
+CREATE INDEX IF NOT EXISTS idx_visit_date ON events_ucm.events_visit USING brin (visit_date);
+CREATE INDEX IF NOT EXISTS idx_lab_result_date
+       ON events_ucm.events_lab USING brin (lab_result_date);
+CREATE INDEX IF NOT EXISTS idx_treatment_start_date
+       ON events_ucm.events_treatment USING brin (treatment_start_date);
 
 
 /* Indices specific to the queries */
--- Visits
-DROP INDEX events_ucm.idx_event_visit;
-CREATE INDEX CONCURRENTLY idx_event_visit ON events_ucm.events (event_type) WHERE (event_type = 'visit');
-DROP INDEX events_ucm.idx_event_id_visit;
-CREATE INDEX CONCURRENTLY idx_event_id_visit ON events_ucm.events(event_type, id_provider_flag) WHERE (event_type = 'visit' AND id_provider_flag = 1);
-
-DROP INDEX events_ucm.idx_event_id_visit_completed;
-CREATE INDEX CONCURRENTLY idx_event_id_visit_completed
-       ON events_ucm.events(event_type, id_provider_flag, visit_status_id) WHERE (event_type = 'visit' AND id_provider_flag = 1 AND visit_status_id = 5);
-DROP INDEX events_ucm.idx_event_visit_completed;
-CREATE INDEX CONCURRENTLY idx_event_visit_completed
-       ON events_ucm.events(event_type, visit_status_id) WHERE (event_type = 'visit' AND visit_status_id = 5);
-
-DROP INDEX events_ucm.idx_event_id_visit_cancelled;
-CREATE INDEX CONCURRENTLY idx_event_id_visit_cancelled
-       ON events_ucm.events(event_type, id_provider_flag, visit_status_id) WHERE (event_type = 'visit' AND id_provider_flag = 1 AND visit_status_id = 7);
-DROP INDEX events_ucm.idx_event_visit_cancelled;
-CREATE INDEX CONCURRENTLY idx_event_visit_cancelled
-       ON events_ucm.events(event_type, visit_status_id) WHERE (event_type = 'visit' AND visit_status_id = 7);
+-- Visits (completed: visit_status_id = 5, cancelled: visit_status_id = 7)
+CREATE INDEX IF NOT EXISTS idx_event_id_visit_status
+       ON events_ucm.events_visit (visit_status_id) WHERE (id_provider_flag = 1);
+CREATE INDEX IF NOT EXISTS idx_event_visit_status
+       ON events_ucm.events_visit (visit_status_id);
 
 -- Gender
-DROP INDEX events_ucm.idx_event_gender;
-CREATE INDEX CONCURRENTLY idx_event_gender ON events_ucm.events (event_type) WHERE (event_type = 'gender');
-DROP INDEX events_ucm.idx_gender;
-CREATE INDEX CONCURRENTLY idx_gender ON events_ucm.gender (event_id);
-
+CREATE INDEX IF NOT EXISTS idx_gender ON events_ucm.gender (event_id);
@@ -6,13 +6,13 @@ CREATE TABLE events_ucm.main (
 
 DROP TABLE IF EXISTS events_ucm.gender;
 CREATE TABLE events_ucm.gender (
-       event_id	   INT REFERENCES events_ucm.events (event_id),
+       event_id	   INT, -- events_ucm.events is partitioned, so event_id cannot be referenced
        gender_id   gender_enum
 );
 
 DROP TABLE IF EXISTS events_ucm.address;
 CREATE TABLE events_ucm.address (
-       event_id		    INT REFERENCES events_ucm.events (event_id),
+       event_id		    INT, -- events_ucm.events is partitioned, so event_id cannot be referenced
        update_date     	    DATE,
        address_type_id	    INT REFERENCES lookup_ucm.address_type (address_type_id),
        address_json	    TEXT,
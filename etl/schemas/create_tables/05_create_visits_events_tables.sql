@@ -1,6 +1,12 @@
 DROP TABLE IF EXISTS events_ucm.events;
+/*
+ * Partitioned by event_type, and the visit, lab and treatment events by
+ * the year of their date, so the feature queries only scan the partitions
+ * of their event type and dates. A primary key would have to include the
+ * partition keys; event_id is unique through its sequence instead.
+ */
 CREATE TABLE events_ucm.events (
-       event_id			SERIAL PRIMARY KEY,
+       event_id			SERIAL,
        event_type		VARCHAR,
        entity_id   		INT REFERENCES patients_ucm.main (entity_id),
        update_date     	    	DATE,
@@ -49,4 +55,77 @@ CREATE TABLE events_ucm.events (
        lab_test_result_descr    VARCHAR,
        lab_anonymous 	    	INT,
        lab_id 		    	INT REFERENCES lookup_ucm.labs (lab_id)
-);
+) PARTITION BY LIST (event_type);
+
+CREATE TABLE events_ucm.events_visit PARTITION OF events_ucm.events
+       FOR VALUES IN ('visit') PARTITION BY RANGE (visit_date);
+CREATE TABLE events_ucm.events_lab PARTITION OF events_ucm.events
+       FOR VALUES IN ('lab') PARTITION BY RANGE (lab_result_date);
+CREATE TABLE events_ucm.events_treatment PARTITION OF events_ucm.events
+       FOR VALUES IN ('treatment') PARTITION BY RANGE (treatment_start_date);
+CREATE TABLE events_ucm.events_address PARTITION OF events_ucm.events
+       FOR VALUES IN ('address');
+CREATE TABLE events_ucm.events_gender PARTITION OF events_ucm.events
+       FOR VALUES IN ('gender');
+CREATE TABLE events_ucm.events_other PARTITION OF events_ucm.events DEFAULT;
+
+/*
+ * Number of statements that updated or deleted events, counted by a
+ * statement trigger on the events table and on each of its partitions,
+ * so statements run on a partition directly are counted too. The feature
+ * tables built incrementally from the new events by
+ * pipeline/build_features.py are built in full again when it changed.
+ * Recreating or truncating the tables is seen from their data files.
+ */
+CREATE TABLE IF NOT EXISTS events_ucm.events_changes (changes bigint NOT NULL);
+INSERT INTO events_ucm.events_changes
+       SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM events_ucm.events_changes);
+
+CREATE OR REPLACE FUNCTION events_ucm.count_events_changes()
+RETURNS trigger AS $$
+BEGIN
+    UPDATE events_ucm.events_changes SET changes = changes + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Run again after adding partitions, as create_year_partitions does
+CREATE OR REPLACE FUNCTION events_ucm.track_events_changes()
+RETURNS void AS $$
+DECLARE
+    part regclass;
+BEGIN
+    FOR part IN SELECT relid FROM pg_partition_tree('events_ucm.events') LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS count_events_changes ON %s', part);
+        EXECUTE format('CREATE TRIGGER count_events_changes AFTER UPDATE OR DELETE ON %s '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION events_ucm.count_events_changes()',
+                       part);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+/*
+ * One partition per year, <parent>_<year>, and a <parent>_default
+ * partition for the dates outside of the years and the missing dates.
+ * Run again with later years to add partitions; the rows of those years
+ * must not be in the default partition yet.
+ */
+CREATE OR REPLACE FUNCTION events_ucm.create_year_partitions(parent text, first_year int,
+                                                             last_year int)
+RETURNS void AS $$
+DECLARE
+    year int;
+BEGIN
+    FOR year IN first_year..last_year LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %s_%s PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+                       parent, year, parent, make_date(year, 1, 1), make_date(year + 1, 1, 1));
+    END LOOP;
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %s_default PARTITION OF %s DEFAULT',
+                   parent, parent);
+    PERFORM events_ucm.track_events_changes();
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT events_ucm.create_year_partitions('events_ucm.events_visit', 2000, 2030);
+SELECT events_ucm.create_year_partitions('events_ucm.events_lab', 2000, 2030);
+SELECT events_ucm.create_year_partitions('events_ucm.events_treatment', 2000, 2030);
@@ -0,0 +1,23 @@
+/*
+ * Move an existing, unpartitioned events_ucm.events into the partitioned
+ * table of create_tables/05_create_visits_events_tables.sql, keeping the
+ * event_ids. Run from etl/schemas with psql:
+ *
+ *     psql -f partition_events_table.sql
+ *
+ * The rows are inserted in date order, so the BRIN indices of
+ * create_indices.sql summarize narrow date ranges.
+ */
+\set ON_ERROR_STOP on
+BEGIN;
+ALTER TABLE events_ucm.events RENAME TO events_unpartitioned;
+\ir create_tables/05_create_visits_events_tables.sql
+INSERT INTO events_ucm.events
+       SELECT * FROM events_ucm.events_unpartitioned
+       ORDER BY event_type, coalesce(visit_date, lab_result_date, treatment_start_date, update_date);
+SELECT setval(pg_get_serial_sequence('events_ucm.events', 'event_id'),
+              (SELECT coalesce(max(event_id), 0) + 1 FROM events_ucm.events_unpartitioned),
+              false);
+DROP TABLE events_ucm.events_unpartitioned CASCADE;
+COMMIT;
+ANALYZE events_ucm.events;
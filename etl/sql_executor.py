@@ -0,0 +1,382 @@
+"""
+Split SQL scripts into statements, work out which tables every statement
+reads and writes, and run independent statements concurrently
+"""
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+
+from instrumentation import psycopg2_explainer, record_statement
+
+NAME = r'((?:"[^"]+"|[a-z_][\w$]*)(?:\s*\.\s*(?:"[^"]+"|[a-z_][\w$]*))?)'
+
+WRITE_PATTERNS = [
+    re.compile(r'^\s*create\s+(?:(?:global|local)\s+)?(?:temp|temporary|unlogged)?\s*table\s+'
+               r'(?:if\s+not\s+exists\s+)?' + NAME),
+    re.compile(r'^\s*create\s+(?:or\s+replace\s+)?(?:materialized\s+)?view\s+'
+               r'(?:if\s+not\s+exists\s+)?' + NAME),
+    re.compile(r'^\s*alter\s+(?:table|materialized\s+view|view)\s+(?:if\s+exists\s+)?'
+               r'(?:only\s+)?' + NAME),
+    re.compile(r'^\s*create\s+(?:unique\s+)?index\s+(?:concurrently\s+)?'
+               r'(?:if\s+not\s+exists\s+)?(?:[\w$"]+\s+)?on\s+(?:only\s+)?' + NAME),
+    re.compile(r'^\s*insert\s+into\s+' + NAME),
+    re.compile(r'^\s*update\s+(?:only\s+)?' + NAME),
+    re.compile(r'^\s*delete\s+from\s+(?:only\s+)?' + NAME),
+    re.compile(r'^\s*truncate\s+(?:table\s+)?(?:only\s+)?' + NAME),
+    re.compile(r'^\s*refresh\s+materialized\s+view\s+(?:concurrently\s+)?' + NAME),
+    re.compile(r'^\s*cluster\s+(?:verbose\s+)?' + NAME),
+    re.compile(r'^\s*(?:vacuum|analyze)\s+(?:\([^)]*\)\s+|(?:full|freeze|verbose|analyze)\s+)*' + NAME),
+]
+DROP_PATTERN = re.compile(r'^\s*drop\s+(?:table|view|materialized\s+view)\s+'
+                          r'(?:if\s+exists\s+)?([^;]*?)(?:\s+(cascade|restrict))?\s*$')
+DROP_INDEX_PATTERN = re.compile(r'^\s*drop\s+index\s+(?:concurrently\s+)?'
+                                r'(?:if\s+exists\s+)?' + NAME)
+CREATE_INDEX_NAME_PATTERN = re.compile(
+    r'^\s*create\s+(?:unique\s+)?index\s+(?:concurrently\s+)?'
+    r'(?:if\s+not\s+exists\s+)?([\w$"]+)\s+on\s+(?:only\s+)?' + NAME)
+# A name followed by a parenthesis after FROM is a function call, not a table
+READ_PATTERN = re.compile(r'\b(?:from|join)\s+(?:only\s+)?' + NAME + r'(?![\w$"])(?!\s*\()'
+                          r'|\breferences\s+' + NAME)
+# Tokens of a statement: string literals, possibly qualified names, and
+# single characters
+TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|" + NAME + r'|\S')
+# Keywords ending a FROM (or USING) list; the list goes on after the
+# joins of its items, as in FROM a JOIN b ON a.id = b.id, c
+FROM_LIST_END = frozenset(['where', 'group', 'having', 'window', 'order', 'limit',
+                           'offset', 'fetch', 'for', 'union', 'except', 'intersect',
+                           'returning', 'using', 'set', 'values'])
+WITH_PATTERN = re.compile(r'(?:\bwith|,)\s+(?:recursive\s+)?([a-z_][\w$]*)\s+as\s*\(')
+TEMP_PATTERN = re.compile(r'^\s*create\s+(?:(?:global|local)\s+)?(?:temp|temporary)\s+table')
+
+
+def split_statements(sql):
+    """
+    Split a SQL script into statements on top-level semicolons. Quoted
+    strings, quoted identifiers, dollar-quoted bodies and comments are
+    respected; comments are removed from the returned statements.
+
+    Parameter
+    ---------
+    sql: str
+       content of a SQL script
+
+    Return
+    ------
+    statements: list
+       the non-empty statements, without their trailing semicolon
+    """
+    statements = []
+    current = []
+    i = 0
+    length = len(sql)
+    while i < length:
+        char = sql[i]
+        if sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = length if end < 0 else end
+            continue
+        if sql.startswith('/*', i):
+            depth = 0
+            while i < length:
+                if sql.startswith('/*', i):
+                    depth += 1
+                    i += 2
+                elif sql.startswith('*/', i):
+                    depth -= 1
+                    i += 2
+                    if depth == 0:
+                        break
+                else:
+                    i += 1
+            current.append(' ')
+            continue
+        if char in ("'", '"'):
+            end = i + 1
+            while end < length:
+                if sql[end] == char:
+                    if sql.startswith(char * 2, end):
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(sql[i:end + 1])
+            i = end + 1
+            continue
+        if char == '$':
+            match = re.match(r'\$([a-z_]\w*)?\$', sql[i:], re.IGNORECASE)
+            if match:
+                tag = match.group(0)
+                end = sql.find(tag, i + len(tag))
+                end = length if end < 0 else end + len(tag)
+                current.append(sql[i:end])
+                i = end
+                continue
+        if char == ';':
+            statements.append(''.join(current).strip())
+            current = []
+            i += 1
+            continue
+        current.append(char)
+        i += 1
+    statements.append(''.join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def _from_list_reads(lowered):
+    """
+    Tables of the comma-separated items of FROM lists after the first one,
+    which READ_PATTERN finds, and of every item of the USING list of a
+    DELETE: the b and c of FROM a, b x, c. Subqueries, LATERAL items and
+    function calls in the lists are skipped; the tables of subqueries are
+    found on their own.
+    """
+    tokens = [match.group(0) for match in TOKEN_PATTERN.finditer(lowered)]
+
+    def table_at(item):
+        if item < len(tokens) and tokens[item] == 'only':
+            item += 1
+        if item < len(tokens) and tokens[item] not in ('(', 'lateral') \
+                and TOKEN_PATTERN.match(tokens[item]).group(1) \
+                and (item + 1 == len(tokens) or tokens[item + 1] != '('):
+            return tokens[item]
+        return None
+
+    tables = []
+    for start, token in enumerate(tokens):
+        if token not in ('from', 'using'):
+            continue
+        # The USING of a join is followed by a parenthesis, and skipped
+        if token == 'using':
+            tables.append(table_at(start + 1))
+        depth = 0
+        i = start + 1
+        while i < len(tokens):
+            token = tokens[i]
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    break
+            elif depth == 0 and (token == ';' or token in FROM_LIST_END):
+                break
+            elif depth == 0 and token == ',':
+                tables.append(table_at(i + 1))
+            i += 1
+    return [table for table in tables if table]
+
+
+def _normalize(name):
+    name = re.sub(r'\s+', '', name).replace('"', '')
+    return name if '.' in name else 'public.' + name
+
+
+class Statement(object):
+    """
+    A single statement of a script with the tables it reads and writes.
+    A statement whose tables cannot be determined is a barrier: it runs
+    after every statement before it and before every statement after it.
+    """
+    def __init__(self, position, sql, index_tables):
+        self.position = position
+        self.sql = sql
+        lowered = sql.lower()
+        self.writes = set()
+        self.reads = set()
+        self.barrier = False
+        self.uses_temp_table = bool(TEMP_PATTERN.match(lowered))
+
+        drop = DROP_PATTERN.match(lowered)
+        drop_index = DROP_INDEX_PATTERN.match(lowered)
+        if drop:
+            self.writes.update(_normalize(name) for name in drop.group(1).split(','))
+            # CASCADE also drops objects of other tables, such as foreign keys
+            self.barrier = drop.group(2) == 'cascade'
+        elif drop_index:
+            table = index_tables.get(_normalize(drop_index.group(1)))
+            if table:
+                self.writes.add(table)
+            else:
+                self.barrier = True
+        else:
+            for pattern in WRITE_PATTERNS:
+                match = pattern.match(lowered)
+                if match:
+                    self.writes.add(_normalize(match.group(1)))
+                    break
+            else:
+                self.barrier = not lowered.startswith('select')
+
+        ctes = set(_normalize(name) for name in WITH_PATTERN.findall(lowered))
+        self.reads = set(_normalize(name) for match in READ_PATTERN.findall(lowered)
+                         for name in match if name)
+        self.reads.update(_normalize(name) for name in _from_list_reads(lowered))
+        self.reads -= ctes
+        self.dependencies = set()
+
+    def conflicts_with(self, other):
+        return bool(self.writes & (other.reads | other.writes)
+                    or self.reads & other.writes)
+
+    def summary(self, width=70):
+        line = ' '.join(self.sql.split())
+        return line if len(line) <= width else line[:width - 3] + '...'
+
+
+def analyze(sql):
+    """
+    Parse a script into statements and link every statement to the
+    earlier statements it has to wait for.
+
+    Return
+    ------
+    statements: list
+       Statement objects in script order
+    """
+    texts = split_statements(sql)
+    index_tables = {}
+    for text in texts:
+        match = CREATE_INDEX_NAME_PATTERN.match(text.lower())
+        if match:
+            schema = _normalize(match.group(2)).split('.')[0]
+            index_tables[_normalize(schema + '.' + match.group(1))] = _normalize(match.group(2))
+            index_tables.setdefault(_normalize(match.group(1)), _normalize(match.group(2)))
+
+    statements = [Statement(i, text, index_tables) for i, text in enumerate(texts)]
+    last_barrier = None
+    for statement in statements:
+        earlier = statements[:statement.position]
+        if statement.barrier:
+            statement.dependencies = set(s.position for s in earlier)
+            last_barrier = statement.position
+            continue
+        if last_barrier is not None:
+            statement.dependencies.add(last_barrier)
+        statement.dependencies.update(s.position for s in earlier
+                                      if s.position > (last_barrier or -1)
+                                      and statement.conflicts_with(s))
+    return statements
+
+
+def execute_script(postgres_config, sql, workers=1, stop_on_error=False,
+                   label=''):
+    """
+    Run the statements of a script, up to workers at a time, each as soon
+    as the statements it depends on have finished. Scripts that create
+    temporary tables run one statement at a time on a single connection,
+    because temporary tables are only visible to their own session.
+
+    Like psql, a failed statement is reported and the script goes on,
+    unless stop_on_error is set.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+       database to run the script in
+    sql: str
+       content of the script
+    workers: int
+       maximum number of statements running at once
+    stop_on_error: bool
+       stop scheduling statements after the first failure
+    label: str
+       name of the script, used in the report
+
+    Return
+    ------
+    timings: list
+       (seconds, Statement, error or None) tuples in completion order
+    """
+    return execute_statements(postgres_config, analyze(sql), workers=workers,
+                              stop_on_error=stop_on_error, label=label)
+
+
+def execute_statements(postgres_config, statements, workers=1,
+                       stop_on_error=False, label=''):
+    """
+    Run Statement objects, as returned by analyze, the same way as
+    execute_script.
+    """
+    if any(statement.uses_temp_table for statement in statements):
+        workers = 1
+    timings = []
+    started = time.time()
+    explain = psycopg2_explainer(postgres_config)
+
+    if workers == 1:
+        with postgres_config.connect() as conn:
+            conn.autocommit = True
+            for statement in statements:
+                result = _run_statement(conn, statement, label, explain)
+                timings.append(result)
+                _report(label, len(timings), len(statements), *result)
+                if result[2] is not None and stop_on_error:
+                    break
+    else:
+        postgres_config.open_pool(workers)
+        _run_concurrently(postgres_config, statements, workers,
+                          stop_on_error, label, timings, explain)
+
+    failures = [t for t in timings if t[2] is not None]
+    click.echo("{}: {} statements in {:.1f}s, {} failed".format(
+        label, len(timings), time.time() - started, len(failures)))
+    for seconds, statement, _ in sorted(timings, key=lambda t: t[0], reverse=True)[:10]:
+        click.echo("  {:8.1f}s  {}".format(seconds, statement.summary()))
+    return timings
+
+
+def _run_statement(conn, statement, label='', explain=None):
+    started = time.time()
+    error = None
+    rows = None
+    try:
+        with conn.cursor() as curs:
+            curs.execute(statement.sql)
+            rows = curs.rowcount
+    except Exception as e:
+        error = e
+    seconds = time.time() - started
+    record_statement(statement.sql, seconds, rows=rows, error=error, source=label,
+                     explain=explain)
+    return seconds, statement, error
+
+
+def _run_pooled(postgres_config, statement, label='', explain=None):
+    with postgres_config.connect() as conn:
+        conn.autocommit = True
+        return _run_statement(conn, statement, label, explain)
+
+
+def _run_concurrently(postgres_config, statements, workers, stop_on_error,
+                      label, timings, explain=None):
+    pending = {statement.position: statement for statement in statements}
+    done = set()
+    running = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if not failed:
+                for position in sorted(pending):
+                    statement = pending[position]
+                    if statement.dependencies <= done and len(running) < workers:
+                        running[executor.submit(_run_pooled, postgres_config,
+                                                statement, label, explain)] = statement
+                        del pending[position]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                statement = running.pop(future)
+                result = future.result()
+                timings.append(result)
+                done.add(statement.position)
+                _report(label, len(timings), len(statements), *result)
+                failed = failed or (result[2] is not None and stop_on_error)
+
+
+def _report(label, count, total, seconds, statement, error):
+    click.echo("{} [{}/{}] {:.1f}s {}{}".format(
+        label, count, total, seconds, statement.summary(),
+        '' if error is None else '\n  ERROR: {}'.format(str(error).strip())))
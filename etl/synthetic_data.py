@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""
+Synthetic EHR extracts shaped like the CSVs of inventory.yaml (cohort,
+encounters, appointments, labs, diagnoses, medications and the regex
+note tables), for any number of patients. The values are random but
+use the same columns, formats and codes as the real extracts, so
+clean_data.sql and everything after it runs on them unchanged. The same
+patients and seed always give the same files.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import yaml
+
+# Bump when the generated files change, so old copies are made again
+GENERATOR_VERSION = 1
+FIRST_MRN = 10000000
+FIRST_BILL_NUM = 100000000
+# A little wider than the study period, so the date filters have work to do
+FIRST_DAY = '2007-01-01'
+LAST_DAY = '2017-06-30'
+CHUNK_PATIENTS = 50000
+
+SERVICES = ['Infectious Diseases', 'Ped Infectious Diseases', 'Internal Medicine',
+            'Hematology/Oncology', 'Psychiatry', 'Emergency Medicine',
+            'Obstetrics/Gynecology', 'Radiology']
+SERVICE_WEIGHTS = [0.35, 0.02, 0.2, 0.05, 0.1, 0.12, 0.08, 0.08]
+ENCOUNTER_TYPES = ['Appointment', 'Office Visit', 'Hospital Encounter',
+                   'Nurse-Only visit', 'Procedure', 'Telephone']
+APPT_STATUSES = ['Completed', 'Canceled', 'No Show', 'Left without seen', 'Arrived', '']
+APPT_STATUS_WEIGHTS = [0.6, 0.15, 0.15, 0.02, 0.03, 0.05]
+ENC_EIO = ['O', 'O', 'O', 'I', 'E', 'IO', '']
+FIN_CLASSES = ['Medicaid', 'Medicare', 'Commercial', 'Self-pay', 'Medicaid Managed Care']
+RACES = ['Black or African-American', 'White', 'Asian', 'Other', 'Patient Declined']
+ETHNICITIES = ['Not Hispanic or Latino', 'Hispanic or Latino', 'Patient Declined']
+CITIES = ['CHICAGO', 'EVANSTON', 'OAK PARK', 'CICERO', 'GARY']
+PHARMACIES = ['WALGREENS', 'CVS', 'UCM PHARMACY', 'OSCO', 'MAIL ORDER']
+NOTE_TYPES = ['Progress Notes', 'Telephone Encounter', 'Scanned Progress Notes',
+              'Patient Instructions', 'Discharge Summary']
+LAB_TESTS = [('CD4 PANEL', 'ABSOLUTE CD4'),
+             ('CD4 PANEL', 'CD4 %'),
+             ('TOXICOLOGY SCREEN, URINE', 'COCAINE'),
+             ('TOXICOLOGY SCREEN, URINE', 'OPIATES'),
+             ('HEPATITIS C ANTIBODY', 'HEPATITIS C AB'),
+             ('BASIC METABOLIC PANEL', 'CREATININE')]
+DIAGNOSES = [('042', 'B20', 'HIV DISEASE', 0),
+             ('304.20', 'F14.20', 'COCAINE DEPENDENCE', 1),
+             ('305.00', 'F10.10', 'ALCOHOL ABUSE', 1),
+             ('311', 'F32.9', 'DEPRESSIVE DISORDER', 0),
+             ('401.9', 'I10', 'ESSENTIAL HYPERTENSION', 0),
+             ('070.54', 'B18.2', 'CHRONIC HEPATITIS C', 0),
+             ('V08', 'Z21', 'ASYMPTOMATIC HIV INFECTION', 0)]
+MEDICATIONS = ['EMTRICITABINE-TENOFOVIR', 'EFAVIRENZ', 'RALTEGRAVIR', 'DARUNAVIR',
+               'RITONAVIR', 'SULFAMETHOXAZOLE-TRIMETHOPRIM', 'SERTRALINE']
+NOTE_TERMS = ['housing', 'homeless', 'transportation', 'insurance', 'depression',
+              'alcohol', 'cocaine', 'heroin', 'incarceration', 'adherence']
+REGEX_TABLES = ['{}data_regex_{}_{}_{}'.format(family, case, stem, neg)
+                for family in ('ancillary', 'infectious')
+                for case in ('casesensitive', 'nocasesensitive')
+                for stem in ('stem', 'nostem')
+                for neg in ('neg', 'noneg')]
+REGEX_FILE_NAMES = {table: table.replace('data_regex_', 'Data_regex_')
+                    .replace('nocasesensitive', 'noCaseSensitive')
+                    .replace('casesensitive', 'CaseSensitive')
+                    .replace('_stem', '_Stem').replace('_nostem', '_noStem')
+                    .replace('_neg', '_Neg').replace('_noneg', '_noNeg')
+                    for table in REGEX_TABLES}
+
+DAYS = pd.date_range(FIRST_DAY, LAST_DAY)
+LONG_DATES = np.array(DAYS.strftime('%m/%d/%Y'), dtype=object)
+SHORT_DATES = np.array(DAYS.strftime('%m/%d/%y'), dtype=object)
+
+
+class _CsvWriter(object):
+    """Append chunks of rows to a CSV, writing the header with the first one"""
+    def __init__(self, path):
+        self.path = path
+        self.started = False
+
+    def write(self, frame):
+        frame.to_csv(self.path, mode='a' if self.started else 'w',
+                     header=not self.started, index=False)
+        self.started = True
+
+
+def _choice(rng, values, size, p=None):
+    return np.array(values, dtype=object)[rng.choice(len(values), size=size, p=p)]
+
+
+def _sometimes(rng, values, fraction):
+    """Blank out a fraction of values; empty fields are loaded as nulls"""
+    values = values.copy()
+    values[rng.random_sample(len(values)) < fraction] = ''
+    return values
+
+
+def _times(rng, size):
+    hours = rng.randint(1, 13, size)
+    minutes = rng.randint(0, 60, size)
+    halves = _choice(rng, ['AM', 'PM'], size)
+    return np.array(['{:02d}:{:02d} {}'.format(h, m, half)
+                     for h, m, half in zip(hours, minutes, halves)], dtype=object)
+
+
+def make_providers(rng, count=200):
+    """
+    Providers with one id_provider flag each, so that encounters join
+    their appointments' id_provider on (attending_name, attending_service)
+    """
+    services = _choice(rng, SERVICES, count, p=SERVICE_WEIGHTS)
+    id_services = set(SERVICES[:4])
+    return pd.DataFrame({
+        'attending_name': ['PROVIDER, {:04d}'.format(i) for i in range(count)],
+        'attending_service': services,
+        'id_provider': [int(service in id_services and rng.random_sample() < 0.8)
+                        for service in services]})
+
+
+class SyntheticExtracts(object):
+    """
+    Generator of the extracts, a chunk of patients at a time. Bill numbers
+    are unique across chunks, as in the real extracts.
+    """
+    def __init__(self, seed=0, visits_per_patient=24):
+        self.rng = np.random.RandomState(seed)
+        self.visits_per_patient = visits_per_patient
+        self.providers = make_providers(self.rng)
+        self.next_bill_num = FIRST_BILL_NUM
+
+    def bill_nums(self, count):
+        start = self.next_bill_num
+        self.next_bill_num += count
+        return np.arange(start, start + count)
+
+    def chunk(self, mrns):
+        """Rows of every extract for the patients mrns, by table name"""
+        rng = self.rng
+        visits_per_patient = self.visits_per_patient
+        providers = self.providers
+        n = len(mrns)
+        days = len(DAYS)
+        tables = {}
+
+        first_visit = rng.randint(0, days - 365, n)
+        dob = pd.to_datetime('1950-01-01') + pd.to_timedelta(rng.randint(0, 60 * 365, n),
+                                                             unit='D')
+        died = rng.random_sample(n) < 0.03
+        death = np.where(died, rng.randint(0, days, n), 0)
+        tables['final_mrns'] = pd.DataFrame({
+            'MRN': mrns,
+            'ENROLL_DATE': SHORT_DATES[first_visit],
+            'YEARFIRSTVISIT': DAYS[first_visit].year,
+            'FIRSTVISITDT': SHORT_DATES[first_visit],
+            'N_POP': (rng.random_sample(n) < 0.9).astype(int)})
+        address = np.array(['{} S TEST AVE'.format(i) for i in rng.randint(1, 9999, n)],
+                           dtype=object)
+        city = _choice(rng, CITIES, n)
+        zipcode = rng.randint(60601, 60660, n)
+        pharmacy = _choice(rng, PHARMACIES, n)
+        tables['cohort_diagnoses'] = pd.DataFrame({
+            'MRN': mrns,
+            'DOB': dob.strftime('%m/%d/%Y'),
+            'DATE_OF_DEATH': np.where(died, LONG_DATES[death], ''),
+            'SEX': _choice(rng, ['Male', 'Female'], n, p=[0.7, 0.3]),
+            'RACE': _choice(rng, RACES, n),
+            'ETHNICITY': _choice(rng, ETHNICITIES, n),
+            'ADDRESS_LINE1': address,
+            'ADDRESS_LINE2': _sometimes(rng, np.array(['APT 1'] * n, dtype=object), 0.8),
+            'CITY': city,
+            'POSTAL_CODE': zipcode,
+            'PHARMACY_NAME': _sometimes(rng, pharmacy, 0.2)})
+        in_rw = rng.random_sample(n) < 0.3
+        tables['rw_mrns'] = pd.DataFrame({
+            'MRN': mrns[in_rw], 'FIRST_NAME': 'FIRST', 'LAST_NAME': 'LAST',
+            'DOB': np.asarray(dob.strftime('%m/%d/%Y'))[in_rw]})
+        tables['gis_final'] = pd.DataFrame({
+            'MRN': mrns, 'ADDRESS_1': address, 'ADDRESS_2': '', 'CITY': city,
+            'ZIPCODE': zipcode, 'PHARMACY_NAME': pharmacy,
+            'PHARM_MAIL_IN': (pharmacy == 'MAIL ORDER').astype(int),
+            'PHARMACY_NAME_2': _sometimes(rng, _choice(rng, PHARMACIES, n), 0.7),
+            'PHARM_MAIL_IN_2': 0, 'PHARMACY_NAME_3': '', 'PHARM_MAIL_IN_3': '',
+            'PHARMACY_NAME_4': '', 'PHARM_MAIL_IN_4': ''})
+        tables['social_diagnoses'] = pd.DataFrame({
+            'MRN': mrns,
+            'TOBACCO_USER': _choice(rng, ['Yes', 'Never', 'Quit', ''], n),
+            'ALCOHOL_USER': _choice(rng, ['Yes', 'No', ''], n),
+            'ILL_DRUG_USER': _choice(rng, ['Yes', 'No', ''], n),
+            'SEXUALLY_ACTIVE': _choice(rng, ['Yes', 'No', 'Not Currently', ''], n)})
+
+        # Visits: one encounter and one appointment each, after the first visit
+        visits = rng.poisson(visits_per_patient, n)
+        visit_mrns = np.repeat(mrns, visits)
+        visit_start = np.repeat(first_visit, visits)
+        visit_day = visit_start + (rng.random_sample(len(visit_mrns))
+                                   * (days - visit_start)).astype(int)
+        visit_end = np.minimum(visit_day + (rng.random_sample(len(visit_day)) < 0.1)
+                               * rng.randint(1, 10, len(visit_day)), days - 1)
+        providers = providers.iloc[rng.randint(0, len(providers), len(visit_mrns))]
+        bill_nums = self.bill_nums(len(visit_mrns))
+        enc_eio = _choice(rng, ENC_EIO, len(visit_mrns))
+        fin_class = _choice(rng, FIN_CLASSES, len(visit_mrns))
+        tables['encounter_diagnoses'] = pd.DataFrame({
+            'MRN': visit_mrns, 'BILL_NUM': bill_nums, 'INDEX_ENC': 1, 'ENC_EIO': enc_eio,
+            'START_DATE': LONG_DATES[visit_day], 'END_DATE': LONG_DATES[visit_end],
+            'ATTENDING_NAME': providers['attending_name'].values,
+            'ATTENDING_SERVICE': providers['attending_service'].values,
+            'FIN_CLASS': fin_class})
+        tables['appt_status'] = pd.DataFrame({
+            'MRN': visit_mrns, 'BILL_NUM': bill_nums, 'INDEX_ENC': 1, 'ENC_EIO': enc_eio,
+            'START_DATE': LONG_DATES[visit_day], 'END_DATE': LONG_DATES[visit_end],
+            'ATTENDING_NAME': providers['attending_name'].values,
+            'ID_PROVIDER': providers['id_provider'].values,
+            'ATTENDING_SERVICE': providers['attending_service'].values,
+            'ENCOUNTER_TYPE': _choice(rng, ENCOUNTER_TYPES, len(visit_mrns)),
+            'APPT_STATUS': _choice(rng, APPT_STATUSES, len(visit_mrns), p=APPT_STATUS_WEIGHTS),
+            'FIN_CLASS': fin_class})
+
+        # Diagnoses, labs and notes of the visits
+        picks = np.repeat(np.arange(len(visit_mrns)), rng.poisson(1.5, len(visit_mrns)))
+        diagnoses = [DIAGNOSES[i] for i in rng.randint(0, len(DIAGNOSES), len(picks))]
+        tables['diagnosis_diagnoses'] = pd.DataFrame({
+            'MRN': visit_mrns[picks], 'BILL_NUM': bill_nums[picks],
+            'ICD9_DX': _sometimes(rng, np.array([d[0] for d in diagnoses], dtype=object), 0.3),
+            'ICD10_DX': _sometimes(rng, np.array([d[1] for d in diagnoses], dtype=object), 0.6),
+            'DX_NAME': [d[2] for d in diagnoses],
+            'DX_RANK': rng.randint(1, 10, len(picks)),
+            'SUBSTANCE_USE': [d[3] for d in diagnoses]})
+
+        picks = np.repeat(np.arange(len(visit_mrns)), rng.poisson(2, len(visit_mrns)))
+        tests = rng.randint(0, len(LAB_TESTS), len(picks))
+        counts = rng.randint(20, 1200, len(picks)).astype(str)
+        percents = rng.randint(5, 50, len(picks)).astype(str)
+        screens = _choice(rng, ['Negative', 'Positive'], len(picks), p=[0.85, 0.15])
+        others = _choice(rng, ['NONREACTIVE', 'REACTIVE', '0.9', '1.1'], len(picks))
+        values = np.where(tests == 0, counts,
+                          np.where(tests == 1, percents,
+                                   np.where(tests < 4, screens, others)))
+        values = np.where((tests == 0) & (rng.random_sample(len(picks)) < 0.01),
+                          'REQUEST CREDITED', values)
+        tables['lab_diagnoses'] = pd.DataFrame({
+            'MRN': visit_mrns[picks], 'BILL_NUM': bill_nums[picks],
+            'RESULT_TIME': SHORT_DATES[visit_day[picks]] + ' '
+                           + np.array(['{:02d}:{:02d}'.format(h, m) for h, m in zip(
+                               rng.randint(0, 24, len(picks)), rng.randint(0, 60, len(picks)))],
+                                      dtype=object),
+            'PROC_NAME': [LAB_TESTS[t][0] for t in tests],
+            'COMPONENT_NAME': [LAB_TESTS[t][1] for t in tests],
+            'ORD_VALUE': values})
+
+        notes = np.flatnonzero(rng.random_sample(len(visit_mrns)) < 0.3)
+        for table in REGEX_TABLES:
+            frame = pd.DataFrame({
+                'MRN': visit_mrns[notes], 'BILL_NUM': bill_nums[notes],
+                'NOTE_ID': (bill_nums[notes] - FIRST_BILL_NUM),
+                'NOTE_TYPE': _choice(rng, NOTE_TYPES, len(notes))})
+            for term in NOTE_TERMS:
+                frame[term.upper()] = (rng.random_sample(len(notes)) < 0.05) \
+                    * rng.randint(1, 4, len(notes))
+            frame['100%'] = (rng.random_sample(len(notes)) < 0.02).astype(int)
+            tables[table] = frame
+
+        # Patient-level series
+        picks = np.repeat(np.arange(n), rng.poisson(visits_per_patient / 3.0, n))
+        days_of = np.minimum(first_visit[picks] + rng.randint(0, days, len(picks)) // 2, days - 1)
+        tables['viral_loads'] = pd.DataFrame({
+            'MRN': mrns[picks], 'SEQ_VL': np.arange(len(picks)) % 50 + 1,
+            'BILL_NUM': self.bill_nums(len(picks)),
+            'RESULT_VL_DATE': SHORT_DATES[days_of], 'RESULT_VL_TIME': _times(rng, len(picks)),
+            'PROC_NAME': 'HIV-1 RNA QUANT', 'COMPONENT_NAME': 'HIV-1 RNA COPIES/ML',
+            'VL_RESULT': np.where(rng.random_sample(len(picks)) < 0.6, 20,
+                                  10 ** rng.uniform(1.3, 6, len(picks))).astype(int)})
+
+        picks = np.repeat(np.arange(n), rng.poisson(visits_per_patient / 6.0, n))
+        days_of = np.minimum(first_visit[picks] + rng.randint(0, days, len(picks)) // 2, days - 1)
+        tables['nadir_cd4s'] = pd.DataFrame({
+            'MRN': mrns[picks], 'SEQ_CD4': np.arange(len(picks)) % 50 + 1,
+            'BILL_NUM': self.bill_nums(len(picks)),
+            'RESULT_CD4_DATE': LONG_DATES[days_of], 'PROC_NAME': 'CD4 PANEL',
+            'CD4_RESULT': np.where(rng.random_sample(len(picks)) < 0.01, 'REQUEST CREDITED',
+                                   rng.randint(5, 1500, len(picks)).astype(str))})
+
+        picks = np.repeat(np.arange(n), rng.poisson(visits_per_patient / 4.0, n))
+        start = np.minimum(first_visit[picks] + rng.randint(0, days, len(picks)) // 2, days - 1)
+        tables['medication_diagnoses'] = pd.DataFrame({
+            'MRN': mrns[picks], 'BILL_NUM': self.bill_nums(len(picks)),
+            'START_DATE': LONG_DATES[start],
+            'END_DATE': LONG_DATES[np.minimum(start + rng.randint(30, 720, len(picks)), days - 1)],
+            'MEDICATION_NAME': _choice(rng, MEDICATIONS, len(picks)),
+            'DOSE': _choice(rng, ['1 TABLET', '2 TABLETS', '600 MG'], len(picks))})
+
+        picks = np.repeat(np.arange(n), rng.poisson(visits_per_patient / 8.0, n))
+        noted = np.minimum(first_visit[picks] + rng.randint(0, days, len(picks)) // 2, days - 1)
+        diagnoses = [DIAGNOSES[i] for i in rng.randint(0, len(DIAGNOSES), len(picks))]
+        tables['problem_diagnoses'] = pd.DataFrame({
+            'MRN': mrns[picks],
+            'BILL_NUM': _sometimes(rng, self.bill_nums(len(picks)).astype(object), 0.3),
+            'NOTED_DATE': LONG_DATES[noted],
+            'RESOLVED_DATE': LONG_DATES[np.minimum(noted + rng.randint(1, 900, len(picks)),
+                                                   days - 1)],
+            'PROBLEM_NAME': [d[2] for d in diagnoses], 'ICD9_CODE': [d[0] for d in diagnoses]})
+        tables['dx_history'] = pd.DataFrame({
+            'MRN': mrns[picks], 'DX_NAME': [d[2] for d in diagnoses],
+            'ICD9_CODE': [d[0] for d in diagnoses], 'DX_DATE': LONG_DATES[noted]})
+        return tables
+
+
+
+
+def file_names(directory):
+    """CSV path of every generated table, named like the real extracts"""
+    names = {'final_mrns': 'final_mrns.csv',
+             'cohort_diagnoses': 'dr_10986_coded_diagnoses_cohort.csv',
+             'diagnosis_diagnoses': 'dr_10986_coded_diagnoses_diagnosis.csv',
+             'encounter_diagnoses': 'dr_10986_coded_diagnoses_encounter.csv',
+             'lab_diagnoses': 'dr_10986_coded_diagnoses_lab.csv',
+             'problem_diagnoses': 'dr_10986_coded_diagnoses_problem.csv',
+             'medication_diagnoses': 'dr_10986_coded_diagnoses_problem_medication.csv',
+             'social_diagnoses': 'dr_10986_coded_diagnoses_social.csv',
+             'appt_status': 'dr_10986_appt_status.csv',
+             'viral_loads': 'viral_loads.csv',
+             'nadir_cd4s': 'nadir_cd4s.csv',
+             'dx_history': 'dx_history.csv',
+             'gis_final': 'gis_final.csv',
+             'rw_mrns': 'rw_mrns.csv'}
+    names.update((table, name + '.csv') for table, name in REGEX_FILE_NAMES.items())
+    return {table: os.path.join(directory, name) for table, name in names.items()}
+
+
+def write_inventory(directory):
+    """Inventory of the generated files, in the format of inventory.yaml"""
+    inventory = []
+    for table, path in sorted(file_names(directory).items()):
+        entry = {'file_name': os.path.abspath(path), 'table_name': table}
+        if table in REGEX_TABLES:
+            entry['column_map'] = {'100%': {'name': 'hundredpct', 'type': 'int'}}
+        inventory.append(entry)
+    path = os.path.join(directory, 'inventory.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump({'inventory': inventory}, f, default_flow_style=False)
+    return path
+
+
+def generate(directory, patients, seed=0, visits_per_patient=24):
+    """
+    Write the synthetic extracts of patients patients to directory, with
+    an inventory.yaml listing them. Nothing is written when the directory
+    already holds the files of the same patients, seed and generator.
+
+    Parameter
+    ---------
+    directory: str
+       where the CSVs and the inventory are written
+    patients: int
+       number of MRNs in the cohort
+    seed: int
+       seed of the random values
+    visits_per_patient: float
+       mean number of encounters of a patient; the other extracts scale
+       with it
+
+    Return
+    ------
+    inventory: str
+       path to the inventory of the generated files
+    """
+    settings = {'patients': patients, 'seed': seed, 'visits_per_patient': visits_per_patient,
+                'version': GENERATOR_VERSION}
+    settings_path = os.path.join(directory, 'synthetic.yaml')
+    if os.path.isfile(settings_path):
+        with open(settings_path, 'r') as f:
+            if yaml.safe_load(f) == settings:
+                print("Synthetic data for {} patients already in {}".format(patients, directory))
+                return os.path.join(directory, 'inventory.yaml')
+        os.remove(settings_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    generator = SyntheticExtracts(seed, visits_per_patient)
+    writers = {table: _CsvWriter(path) for table, path in file_names(directory).items()}
+    for start in range(0, patients, CHUNK_PATIENTS):
+        mrns = np.arange(FIRST_MRN + start, FIRST_MRN + min(start + CHUNK_PATIENTS, patients))
+        for table, frame in generator.chunk(mrns).items():
+            writers[table].write(frame)
+        print("{}/{} patients written".format(start + len(mrns), patients))
+
+    inventory = write_inventory(directory)
+    with open(settings_path, 'w') as f:
+        yaml.safe_dump(settings, f, default_flow_style=False)
+    return inventory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--visits-per-patient', type=float, default=24)
+    args = parser.parse_args()
+    generate(args.directory, args.patients, seed=args.seed,
+             visits_per_patient=args.visits_per_patient)
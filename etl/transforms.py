@@ -0,0 +1,115 @@
+"""
+Vectorized column transforms for the inventory column_map
+"""
+import re
+
+import pandas as pd
+
+DATE_TYPE = re.compile(r'^date\((.*)\)$')
+
+# Python types allowed in the inventory column_map and their Postgres types
+COLUMN_MAP_TYPES = {
+    'int': 'bigint',
+    'float': 'double precision',
+    'str': 'text',
+    'bool': 'boolean',
+    'date': 'timestamp',
+}
+
+# Values of a `bool` column, compared case-insensitively
+BOOL_VALUES = {
+    'true': True, 't': True, '1': True, 'yes': True, 'y': True,
+    'false': False, 'f': False, '0': False, 'no': False, 'n': False,
+}
+
+# Format of converted dates in the CSV handed to COPY
+COPY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def column_map_type(new_type):
+    """Postgres type of a type given in the inventory column_map"""
+    if DATE_TYPE.match(new_type):
+        return 'date'
+    return COLUMN_MAP_TYPES.get(new_type, new_type)
+
+
+def has_transforms(column_map):
+    """Whether any column of the column map needs its values converted"""
+    return any('type' in options for options in column_map.values())
+
+
+def transform_chunk(df_data, column_map, coerced=None):
+    """
+    Convert the columns of a chunk of raw (string) values in place, a whole
+    column at a time.
+
+    A type of `date(<format>)` parses the values with that strftime format,
+    `date` parses ISO-like dates, `bool` reads the values of BOOL_VALUES,
+    and any other type is a pandas dtype.
+    A value that does not parse, or that is not a whole number in an `int`
+    column, raises a ValueError, unless the column sets `coerce: true` in
+    the column map; it is then loaded as a null and counted in coerced.
+
+    Parameter
+    ---------
+    df_data: DataFrame
+       chunk read with dtype=str
+    column_map: dict
+       column_map of the inventory entry
+    coerced: dict
+       number of values loaded as nulls, keyed by column name; updated
+
+    Return
+    ------
+    df_data: DataFrame
+       the converted chunk
+    """
+    if coerced is None:
+        coerced = {}
+    for column_name, options in column_map.items():
+        if 'type' not in options or column_name not in df_data:
+            continue
+        new_type = options['type']
+        values = df_data[column_name]
+        date_type = DATE_TYPE.match(new_type)
+        if date_type:
+            converted = pd.to_datetime(values, format=date_type.group(1), errors='coerce')
+        elif new_type == 'date':
+            converted = pd.to_datetime(values, errors='coerce')
+        elif new_type == 'int':
+            converted = pd.to_numeric(values, errors='coerce')
+            converted = converted.where(converted % 1 == 0)
+        elif new_type == 'float':
+            converted = pd.to_numeric(values, errors='coerce')
+        elif new_type == 'bool':
+            converted = values.str.strip().str.lower().map(BOOL_VALUES).astype('boolean')
+        elif new_type != 'str':
+            df_data[column_name] = values.astype(new_type)
+            continue
+        else:
+            continue
+        _check_coerced(column_name, new_type, values, converted,
+                       options.get('coerce', False), coerced)
+        if new_type == 'int':
+            converted = converted.astype('Int64')
+        df_data[column_name] = converted
+    return df_data
+
+
+def _check_coerced(column_name, new_type, values, converted, coerce, coerced):
+    invalid = values.notna() & converted.isna()
+    count = int(invalid.sum())
+    if not count:
+        return
+    if not coerce:
+        raise ValueError(
+            "{} values of column {} are not {}, e.g. {!r}; set coerce: true in "
+            "its column_map entry to load them as nulls".format(
+                count, column_name, new_type, values[invalid].iloc[0]))
+    coerced[column_name] = coerced.get(column_name, 0) + count
+
+
+def to_csv_bytes(df_data):
+    """Encode a converted chunk as headerless CSV for COPY"""
+    return df_data.to_csv(index=False, header=False, na_rep='',
+                          date_format=COPY_DATE_FORMAT).encode('utf-8')
@@ -1,17 +1,31 @@
 
 #!/usr/bin/env python
+import argparse
 import sys
 import os
 import yaml
 import logging
-import sqlalchemy
 from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import text
 
 from catwalk.storage import FSModelStorageEngine
-from triage.experiments import SingleThreadedExperiment
+from triage.experiments import MultiCoreExperiment, SingleThreadedExperiment
 
 from architect.label_generators import BinaryLabelGenerator
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'etl'))
+
+from feature_config import assemble_experiment_config
+from db import get_engine
+from instrumentation import recorded_run, stage
+from matrix_store import use_arrow_matrix_store
+
+# Steps of Experiment.run timed as stages, when the experiment has them
+EXPERIMENT_STAGES = ('generate_labels', 'generate_sparse_states',
+                     'generate_preimputation_features', 'impute_missingness',
+                     'build_matrices', 'train_and_test_models')
+
 
 class HIVLabelGenerator(BinaryLabelGenerator):
     """
@@ -49,50 +63,127 @@ class HIVLabelGenerator(BinaryLabelGenerator):
         self.db_engine.execute(query)
         return labels_table
 
-def get_db_conn(postgres_config):
-    with open(postgres_config, 'r') as f:
-        config = yaml.load(f)
-    dbtype = 'postgres'
-
-    user = config['user']
-    host = config['host']
-    port = config['port']
-    db = config['database']
-    passcode = config['password']
-    url = '{}://{}:{}@{}:{}/{}'.format(dbtype,
-                                       user,
-                                       passcode,
-                                       host,
-                                       port,
-                                       db)
-    print(url)
-    return sqlalchemy.create_engine(url, poolclass=NullPool)
-
+    def generate_all_labels(self, labels_table, as_of_dates, label_windows):
+        """
+        Write the labels of every as-of date and label window with a single
+        INSERT, instead of one INSERT (and scan of the events table) per
+        as-of date. The rows are the same as calling generate for each
+        as-of date and label window.
+        """
+        self._create_labels_table(labels_table)
+        self._index_events_table()
+        logging.info('Creating labels for %s as of dates and %s label windows',
+                     len(as_of_dates), len(label_windows))
+        query = """insert into {labels_table} (
+            select
+                {events_table}.entity_id,
+                as_of_dates.as_of_date,
+                label_windows.label_window,
+                'outcome' as label_name,
+                'binary' as label_type,
+                bool_or(outcome::bool)::int as label
+            from unnest(:as_of_dates ::date[]) as as_of_dates (as_of_date)
+            join {events_table}
+                on {events_table}.outcome_date = as_of_dates.as_of_date
+            cross join unnest(:label_windows ::interval[]) as label_windows (label_window)
+            group by 1, 2, 3, 4, 5
+        )""".format(
+            events_table=self.events_table,
+            labels_table=labels_table,
+        )
+        logging.debug('Running label generation query: %s', query)
+        self.db_engine.execute(text(query),
+                               as_of_dates=[str(as_of_date) for as_of_date in as_of_dates],
+                               label_windows=[str(label_window) for label_window in label_windows])
+        nrows = self.db_engine.execute(
+            'select count(*) from {}'.format(labels_table)).scalar()
+        logging.info('Labels table generated at %s with %s rows', labels_table, nrows)
+
+    def _index_events_table(self):
+        """Index the events table on (outcome_date, entity_id) unless it already is"""
+        table_name = self.events_table.split('.')[-1]
+        self.db_engine.execute(
+            'create index if not exists {}_outcome_date_entity_id_idx '
+            'on {} (outcome_date, entity_id)'.format(table_name, self.events_table))
+
+def create_experiment(experiment_config, engine, mode='singlethreaded', workers=1,
+                      db_workers=1, **kwargs):
+    """
+    Build the Triage experiment for the given mode. In multicore mode,
+    matrices are built and models trained in workers processes, with at
+    most db_workers of them querying the database at once. Every process
+    makes its own NullPool engine from the url of engine, so no connection
+    is shared across processes. Both modes write the same tables and
+    model files.
+    """
+    if mode == 'multicore':
+        return MultiCoreExperiment(config=experiment_config,
+                                   db_engine=engine,
+                                   n_processes=workers,
+                                   n_db_processes=db_workers,
+                                   **kwargs)
+    return SingleThreadedExperiment(config=experiment_config,
+                                    db_engine=engine,
+                                    **kwargs)
+
+def time_experiment_stages(experiment):
+    """Record every step of experiment.run as a stage of the current run"""
+    def timed(name, step):
+        def run_step(*args, **kwargs):
+            with stage('triage {}'.format(name)):
+                return step(*args, **kwargs)
+        return run_step
+
+    for name in EXPERIMENT_STAGES:
+        if hasattr(experiment, name):
+            setattr(experiment, name, timed(name, getattr(experiment, name)))
+    return experiment
 
 
 if __name__ == "__main__":
-    config_file = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file')
+    parser.add_argument('--mode', choices=['singlethreaded', 'multicore'], default=None,
+                        help='multicore by default when --workers is above 1')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes building matrices and training models')
+    parser.add_argument('--db-workers', type=int, default=None,
+                        help='processes querying the database at the same time '
+                             '(default: min(workers, 4))')
+    parser.add_argument('--arrow-matrices', action='store_true',
+                        help='read matrices from memory-mapped Arrow copies, '
+                             'keeping the most recent ones in memory')
+    parser.add_argument('--matrix-cache-gb', type=float, default=8,
+                        help='memory kept for recent matrices, per process')
+    parser.add_argument('--matrix-compression', choices=['zstd', 'lz4'], default=None,
+                        help='compress the Arrow copies; they are then '
+                             'decompressed instead of memory-mapped')
+    parser.add_argument('--compact-matrices', action='store_true',
+                        help='with --arrow-matrices, store features as uint8, '
+                             'uint16 or float32 instead of float64')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory of the JSON-lines timing records and '
+                             'of the runs summary')
+    parser.add_argument('--explain-slowest', type=int, default=0,
+                        help='capture EXPLAIN (ANALYZE, BUFFERS) of this many '
+                             'of the slowest statements; their queries are run again')
+    args = parser.parse_args()
+    mode = args.mode or ('multicore' if args.workers > 1 else 'singlethreaded')
+    db_workers = args.db_workers or min(args.workers, 4)
+    config_file = args.config_file
     #add_regex_features = sys.argv[2].lower() == 'true'
     #print("add regex features: ", str(add_regex_features))
     print(config_file)
 
     features_directory = 'features'
     try:
-        # load main experiment config
-        with open(config_file) as f:
-            experiment_config = yaml.load(f)
-
-        # load feature configs and update experiment config with their contents
-        all_feature_aggregations = []
-        for filename in os.listdir('{}/'.format(features_directory)):
-            if filename.endswith(".yaml"):
-                with open('{}/{}'.format(features_directory, filename)) as f:
-                    feature_aggregations = yaml.load(f)
-                    for aggregation in feature_aggregations['feature_aggregations']:
-                        all_feature_aggregations.append(aggregation)
-        experiment_config['feature_aggregations'] = all_feature_aggregations
-
-    except yaml.parser.ParserError as e:
+        # load main experiment config and add the feature configs, sorted
+        # so the same files always give the same config
+        experiment_config, config_hash = assemble_experiment_config(
+            config_file, features_directory)
+        print("Config hash: {}".format(config_hash))
+
+    except yaml.YAMLError as e:
         print('{} config cannot be parsed.'.format(config_file))
         print(e)
         exit(1)
@@ -107,15 +198,27 @@ if __name__ == "__main__":
 
     print(os.getcwd())
     print(os.path.dirname("~"))
-    engine = get_db_conn('./luigi.yaml')
+    engine = get_engine('./luigi.yaml', poolclass=NullPool)
 
     print("Experiment config:\n", experiment_config)
-    experiment = SingleThreadedExperiment(config=experiment_config,
-                                          db_engine=engine,
-                                          model_storage_class=FSModelStorageEngine,
-                                          project_path='/group/dsapp-lab/triage_files/',
-                                          label_generator_class=HIVLabelGenerator, replace=False)
+    print("Running the experiment {} with {} workers".format(mode, args.workers))
+    experiment = create_experiment(experiment_config, engine,
+                                   mode=mode,
+                                   workers=args.workers,
+                                   db_workers=db_workers,
+                                   model_storage_class=FSModelStorageEngine,
+                                   project_path='/group/dsapp-lab/triage_files/',
+                                   label_generator_class=HIVLabelGenerator, replace=False)
+    if args.arrow_matrices:
+        use_arrow_matrix_store(experiment,
+                               max_bytes=int(args.matrix_cache_gb * 1024 ** 3),
+                               compression=args.matrix_compression,
+                               compact=args.compact_matrices)
 
 
     logging.basicConfig(level=logging.INFO)
-    experiment.run()
+    time_experiment_stages(experiment)
+    with recorded_run('triage', args.profile_dir, args.explain_slowest):
+        with stage('triage experiment', config_hash=config_hash, mode=mode,
+                   workers=args.workers):
+            experiment.run()
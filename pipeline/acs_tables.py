@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Build lookup_acs.all_years, the ACS 5-year estimates of every census
+tract, from the acs<year>_5yr schemas. The table is partitioned by
+knowledge_date, with one partition per year, lookup_acs.acs<year>_5yr.
+The years are built at the same time, each on a connection of its own,
+and a year is only built again when its source tables or its query
+changed since its last build.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'etl'))
+import db
+from incremental import (NEW_SUFFIX, _input_fingerprint, ensure_build_manifest,
+                         get_fingerprints, record_fingerprint)
+from instrumentation import recorded_run, stage
+
+ACS_SCHEMA = 'lookup_acs'
+ACS_TABLE = 'lookup_acs.all_years'
+YEARS = list(range(2009, 2016))
+
+# Tables of the acs<year>_5yr schema joined on geoid
+SOURCE_TABLES = [
+    ('b01003', 'total population'),
+    ('b02009', 'black population'),
+    ('b05012', 'nativity'),
+    ('b07003', 'geographic mobility'),
+    ('b09010', 'SSI/Food stamps/SNAP/etc'),
+    ('b17022', 'ratio of income to poverty level'),
+    ('b19001', 'household income'),
+    ('b08013', 'aggregate travel time to work'),
+    ('b08015', 'number of vehicles to travel to work'),
+    ('b08303', 'travel time to work'),
+    ('b12007', 'med age at first marriage'),
+    ('b15002', 'educational attainment'),
+]
+
+# Columns of lookup_acs.all_years after knowledge_date and geoid
+COLUMNS = [
+    ('total_population', 'b01003001'),
+    ('total_black', 'b02009001'),
+    ('native_born', 'b05012002'),
+    ('foreign_born', 'b05012003'),
+    ('mobility_same_house', 'b07003004'),
+    ('mobility_moved_same_county', 'b07003007'),
+    ('mobility_moved_diff_county_same_state', 'b07003010'),
+    ('mobility_moved_diff_state', 'b07003013'),
+    ('mobility_moved_abroad', 'b07003016'),
+    ('with_ssisnap', 'b09010002'),
+    ('ratio_lt_1_3', 'b17022002'),
+    ('ratio_1_3_to_1_49', 'b17022022'),
+    ('ratio_1_5_to_1_84', 'b17022042'),
+    ('ratio_gte_1_85', 'b17022062'),
+    ('income_lt_10k', 'b19001002'),
+    ('income_10_to_15k', 'b19001003'),
+    ('income_15_to_20k', 'b19001004'),
+    ('income_20_to_25k', 'b19001005'),
+    ('income_25_to_30k', 'b19001006'),
+    ('income_30_to_35k', 'b19001007'),
+    ('income_35_to_40k', 'b19001008'),
+    ('income_40_to_45k', 'b19001009'),
+    ('income_45_to_50k', 'b19001010'),
+    ('income_50_to_60k', 'b19001011'),
+    ('income_60_to_75k', 'b19001012'),
+    ('income_75_to_100k', 'b19001013'),
+    ('income_100_to_125k', 'b19001014'),
+    ('income_125_to_150k', 'b19001015'),
+    ('income_150_to_200k', 'b19001016'),
+    ('income_gt_200k', 'b19001017'),
+    ('travel_time_work', 'b08013001'),
+    ('num_vehicles_to_work', 'b08015001'),
+    ('travel_lt_5', 'b08303002/(b08303001+1)'),
+    ('travel_5_to_30', '(b08303003+b08303004+b08303005+b08303006+b08303007)/(b08303001+1)'),
+    ('travel_30_to_60', '(b08303008+b08303009+b08303010+b08303011)/(b08303001+1)'),
+    ('travel_gt_60', '(b08303012+b08303013)/(b08303001+1)'),
+    ('age_at_first_marriage_male', 'b12007001'),
+    ('age_at_first_marriage_female', 'b12007002'),
+    ('no_schooling', '(b15002003+b15002020)/(b15002001+1)'),
+    ('elementary_school', '(b15002004+b15002021)/(b15002001+1)'),
+    ('middle_school', '(b15002005+b15002006+b15002022+b15002023)/(b15002001+1)'),
+    ('high_school', '(b15002007+b15002008+b15002009+b15002010+b15002011'
+                    '+b15002024+b15002025+b15002026+b15002027+b15002028)/(b15002001+1)'),
+    ('lt_1yr_college', '(b15002012+b15002029)/(b15002001+1)'),
+    ('some_college', '(b15002013+b15002030)/(b15002001+1)'),
+    ('associates', '(b15002014+b15002031)/(b15002001+1)'),
+    ('bachelors', '(b15002015+b15002032)/(b15002001+1)'),
+    ('masters', '(b15002016+b15002033)/(b15002001+1)'),
+    ('prof_degree', '(b15002017+b15002034)/(b15002001+1)'),
+    ('phd', '(b15002018+b15002035)/(b15002001+1)'),
+]
+
+
+def knowledge_date(year):
+    return '{}-12-31'.format(year)
+
+
+def year_query(year, types=None):
+    """
+    SELECT of the rows of one year. With types, the Postgres types of the
+    columns keyed by name, the columns are cast to them after they are
+    computed, so that every year's partition has the column types of
+    lookup_acs.all_years; without, they have the types they get from the
+    source tables.
+    """
+    source = 'acs{}_5yr'.format(year)
+    columns = ',\n       '.join(
+        '({})::{} AS {}'.format(expression, types[name], name) if types
+        else '{} AS {}'.format(expression, name)
+        for name, expression in COLUMNS)
+    joins = ''.join('\n  JOIN {}.{} USING (geoid) -- {}'.format(source, table, description)
+                    for table, description in SOURCE_TABLES[1:])
+    return ("SELECT DISTINCT DATE '{}' AS knowledge_date,\n"
+            "       geoid::text AS geoid,\n"
+            "       {}\n"
+            "  FROM {}.{} -- {}{}").format(knowledge_date(year), columns, source,
+                                           SOURCE_TABLES[0][0], SOURCE_TABLES[0][1], joins)
+
+
+def _column_types(curs, table):
+    """Types of the COLUMNS of a table, keyed by column name"""
+    curs.execute("""SELECT attname, format_type(atttypid, atttypmod)
+                      FROM pg_attribute
+                     WHERE attrelid = %s::regclass
+                       AND attnum > 0
+                       AND NOT attisdropped;
+                 """, (table,))
+    types = dict(curs.fetchall())
+    return dict((name, types.get(name)) for name, _ in COLUMNS)
+
+
+def ensure_acs_table(postgres_config, year):
+    """
+    Create lookup_acs.all_years, partitioned by knowledge_date, if it does
+    not exist yet, with the column types the source tables of year give
+    the columns, as the former unpartitioned table had: the integer and
+    float columns downstream features divide keep their types. An
+    all_years table that is not partitioned, as built by the former
+    create_acs_tables.sh, or whose column types differ, is dropped first.
+
+    Return
+    ------
+    types: dict
+       the Postgres types of the columns, keyed by name
+    """
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("CREATE SCHEMA IF NOT EXISTS " + ACS_SCHEMA)
+        curs.execute("CREATE TEMP TABLE acs_columns ON COMMIT DROP AS\n{}\nWITH NO DATA"
+                     .format(year_query(year)))
+        types = _column_types(curs, 'pg_temp.acs_columns')
+        curs.execute("""SELECT c.relkind
+                          FROM pg_class c
+                          JOIN pg_namespace n ON n.oid = c.relnamespace
+                         WHERE n.nspname = %s AND c.relname = %s;
+                     """, tuple(ACS_TABLE.split('.')))
+        row = curs.fetchone()
+        if row is not None and (row[0] != 'p' or _column_types(curs, ACS_TABLE) != types):
+            print("{}: not partitioned or with other column types than acs{}_5yr; "
+                  "dropping it with its partitions".format(ACS_TABLE, year))
+            curs.execute("DROP TABLE {}".format(ACS_TABLE))
+        curs.execute("""CREATE TABLE IF NOT EXISTS {} (
+                          knowledge_date date NOT NULL,
+                          geoid text,
+                          {})
+                        PARTITION BY LIST (knowledge_date);
+                     """.format(ACS_TABLE, ',\n'.join('{} {}'.format(name, types[name])
+                                                      for name, _ in COLUMNS)))
+    return types
+
+
+def _is_partition(curs, table):
+    schema, name = table.split('.')
+    curs.execute("""SELECT EXISTS (
+                        SELECT 1
+                          FROM pg_inherits i
+                          JOIN pg_class c ON c.oid = i.inhrelid
+                          JOIN pg_namespace n ON n.oid = c.relnamespace
+                         WHERE n.nspname = %s AND c.relname = %s);
+                 """, (schema, name))
+    return curs.fetchone()[0]
+
+
+def build_year(postgres_config, year, types, built=None, full=False):
+    """
+    Build the partition of one year next to the live one and swap it in,
+    unless its source tables and query are the same as at its last build.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+    year: int
+       year of the acs<year>_5yr schema
+    types: dict
+       column types of lookup_acs.all_years, as returned by ensure_acs_table
+    built: dict
+       fingerprints of the last builds, keyed by partition
+    full: bool
+       build the year even if it did not change
+
+    Return
+    ------
+    rebuilt: bool
+       whether the year was built
+    """
+    started = time.time()
+    partition = '{}.acs{}_5yr'.format(ACS_SCHEMA, year)
+    source = 'acs{}_5yr'.format(year)
+    query = year_query(year, types)
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        inputs = [(table, _input_fingerprint(curs, '{}.{}'.format(source, table)))
+                  for table, _ in SOURCE_TABLES]
+        fingerprint = hashlib.sha256(json.dumps([query, inputs]).encode('utf-8')).hexdigest()
+        if not full and (built or {}).get(partition) == fingerprint \
+                and _is_partition(curs, partition):
+            print("{}: unchanged".format(partition))
+            return False
+
+        curs.execute("DROP TABLE IF EXISTS {}{}".format(partition, NEW_SUFFIX))
+        curs.execute("CREATE TABLE {}{} AS\n{}".format(partition, NEW_SUFFIX, query))
+        # Lets ATTACH PARTITION skip the scan that checks the partition bound
+        curs.execute("""ALTER TABLE {}{}
+                          ADD CONSTRAINT {}_knowledge_date
+                              CHECK (knowledge_date = DATE '{}');
+                     """.format(partition, NEW_SUFFIX, partition.split('.')[1],
+                                knowledge_date(year)))
+        conn.commit()
+
+        # Swaps run one at a time, holding the lock on all_years briefly
+        curs.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(ACS_TABLE))
+        if _is_partition(curs, partition):
+            curs.execute("ALTER TABLE {} DETACH PARTITION {}".format(ACS_TABLE, partition))
+        curs.execute("DROP TABLE IF EXISTS {}".format(partition))
+        curs.execute("ALTER TABLE {}{} RENAME TO {}".format(
+            partition, NEW_SUFFIX, partition.split('.')[1]))
+        curs.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN (DATE '{}')".format(
+            ACS_TABLE, partition, knowledge_date(year)))
+    record_fingerprint(postgres_config, ACS_SCHEMA, partition, fingerprint)
+    print("{}: built in {:.1f}s".format(partition, time.time() - started))
+    return True
+
+
+def _timed_build_year(postgres_config, year, types, built, full):
+    with stage('acs {}'.format(year)):
+        return build_year(postgres_config, year, types, built, full)
+
+
+def build_acs_tables(postgres_config, years=YEARS, workers=None, full=False):
+    """
+    Build the partitions of lookup_acs.all_years of the years that
+    changed, all at the same time unless workers is given.
+
+    Return
+    ------
+    failures: dict
+       exceptions of the years that could not be built, keyed by year
+    """
+    types = ensure_acs_table(postgres_config, years[0])
+    ensure_build_manifest(postgres_config, ACS_SCHEMA)
+    built = get_fingerprints(postgres_config, ACS_SCHEMA)
+    workers = workers or len(years)
+    postgres_config.open_pool(workers)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(_timed_build_year, postgres_config, year, types,
+                                        built, full), year)
+                       for year in years)
+        for future in as_completed(futures):
+            year = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures[year] = e
+                print("acs {} FAILED: {}".format(year, e))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=None,
+                        help='yaml file with the database connection')
+    parser.add_argument('--years', type=int, nargs='+', default=YEARS)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of years built at the same time (default: all)')
+    parser.add_argument('--full', action='store_true',
+                        help='build every year, even if it did not change')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory of the JSON-lines timing records and '
+                             'of the runs summary')
+    parser.add_argument('--explain-slowest', type=int, default=0,
+                        help='capture EXPLAIN (ANALYZE, BUFFERS) of this many '
+                             'of the slowest statements; their queries are run again')
+    args = parser.parse_args()
+
+    with recorded_run('acs', args.profile_dir, args.explain_slowest):
+        failures = build_acs_tables(db.get_postgres_config(args.config), args.years,
+                                    workers=args.workers, full=args.full)
+    if failures:
+        print("{} of {} years failed: {}".format(
+            len(failures), len(args.years), ', '.join(str(year) for year in sorted(failures))))
+        sys.exit(1)
@@ -0,0 +1,103 @@
+-- Micro-benchmark of the aggregates in sql_userdefined_aggregate_functions.sql
+-- against the array-based definitions they replace, which are restored
+-- here as legacy_dsapp_mode and legacy_count_distinct. Both are timed on
+-- the same input:
+--
+--     legacy_dsapp_mode(x)       against  dsapp_mode(x ORDER BY x)
+--     legacy_count_distinct(x)   against  count(DISTINCT x)
+--
+-- Run with psql -f after loading the definitions. Needs Postgres 14 or
+-- later, where array_append takes anycompatible arguments. The synthetic
+-- tables and the legacy aggregates are dropped at the end.
+
+DROP AGGREGATE IF EXISTS legacy_dsapp_mode(anycompatible);
+DROP AGGREGATE IF EXISTS legacy_count_distinct(anycompatible);
+
+CREATE OR REPLACE FUNCTION _legacy_final_mode(anycompatiblearray)
+  RETURNS anycompatible AS
+$BODY$
+    SELECT a
+    FROM unnest($1) a
+    GROUP BY 1
+    ORDER BY COUNT(1) DESC, 1
+    LIMIT 1;
+$BODY$
+LANGUAGE sql IMMUTABLE;
+
+CREATE AGGREGATE legacy_dsapp_mode(anycompatible) (
+  SFUNC=array_append,
+  STYPE=anycompatiblearray,
+  FINALFUNC=_legacy_final_mode,
+  INITCOND='{}'
+);
+
+CREATE OR REPLACE FUNCTION _legacy_final_count_distinct(anycompatiblearray)
+  RETURNS bigint AS
+$BODY$
+    SELECT COUNT(DISTINCT a)
+    FROM unnest($1) a;
+$BODY$
+LANGUAGE sql IMMUTABLE;
+
+CREATE AGGREGATE legacy_count_distinct(anycompatible) (
+  SFUNC=array_append,
+  STYPE=anycompatiblearray,
+  FINALFUNC=_legacy_final_count_distinct,
+  INITCOND='{}'
+);
+
+-- Synthetic groups: few large groups with many distinct values, and many
+-- small groups, with some nulls and ties
+DROP TABLE IF EXISTS bench_large, bench_small;
+CREATE UNLOGGED TABLE bench_large AS
+       (select (i % 20) as group_id,
+               case when i % 97 = 0 then NULL else (random() * 5000)::int end as value
+        from generate_series(1, 1000000) as i);
+CREATE UNLOGGED TABLE bench_small AS
+       (select (i % 100000) as group_id,
+               case when i % 97 = 0 then NULL else (random() * 5)::int end as value
+        from generate_series(1, 1000000) as i);
+ANALYZE bench_large;
+ANALYZE bench_small;
+
+\timing on
+
+\echo 'large groups: legacy, then current'
+select count(*) from (select group_id, legacy_dsapp_mode(value), legacy_count_distinct(value)
+                      from bench_large group by 1) as t;
+select count(*) from (select group_id, dsapp_mode(value order by value), count(distinct value)
+                      from bench_large group by 1) as t;
+
+\echo 'small groups: legacy, then current'
+select count(*) from (select group_id, legacy_dsapp_mode(value), legacy_count_distinct(value)
+                      from bench_small group by 1) as t;
+select count(*) from (select group_id, dsapp_mode(value order by value), count(distinct value)
+                      from bench_small group by 1) as t;
+
+\echo 'providers per entity in events_ucm.events: legacy, then current'
+select count(*) from (select entity_id, legacy_dsapp_mode(provider_id),
+                             legacy_count_distinct(provider_id)
+                      from events_ucm.events where event_type = 'visit' group by 1) as t;
+select count(*) from (select entity_id, dsapp_mode(provider_id order by provider_id),
+                             count(distinct provider_id)
+                      from events_ucm.events where event_type = 'visit' group by 1) as t;
+
+\timing off
+
+\echo 'groups where the legacy and current distinct counts differ (expect 0)'
+select count(*)
+from (select group_id, legacy_count_distinct(value) as n from bench_large group by 1
+      except all
+      select group_id, count(distinct value) from bench_large group by 1) as differences;
+
+\echo 'groups where the legacy and current modes differ, nulls included (expect 0)'
+select count(*)
+from (select group_id, legacy_dsapp_mode(value) as mode from bench_small group by 1
+      except all
+      select group_id, dsapp_mode(value order by value) from bench_small group by 1) as differences;
+
+DROP TABLE bench_large, bench_small;
+DROP AGGREGATE legacy_dsapp_mode(anycompatible);
+DROP AGGREGATE legacy_count_distinct(anycompatible);
+DROP FUNCTION _legacy_final_mode(anycompatiblearray);
+DROP FUNCTION _legacy_final_count_distinct(anycompatiblearray);
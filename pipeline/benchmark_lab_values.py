@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Compare the lab_test_value CASE expressions the lab features used to
+evaluate on every lab row with the join against lookup_ucm.lab_values,
+and check that the Python parsers give the same values as the CASE
+expressions.
+"""
+import argparse
+import time
+
+from build_features import get_postgres_config
+from lab_values import (LAB_VALUES_TABLE, parse_cell_count, parse_viral_load,
+                        update_lab_values)
+
+LEGACY_VIRAL_LOAD = """
+        case
+		when lab_test_value ilike '%credited%' or lab_test_value ilike '%NAT HIV REACTIV%' then NULL
+                when lab_test_value ilike '%none detected%'  then 0
+                when trim(lab_test_value) = 'No HIV-1 RNA detected' then 0
+                when lab_test_value ilike '%less than 20%'  or lab_test_value ilike '%<20%'  then 0
+                when replace(lab_test_value, ' ', '') like '%<50%'  then 50
+                when replace(lab_test_value, ' ', '') like '%<5O%'  then 50 -- too account for a typo
+                when replace(lab_test_value, ' ', '') like '%<75%'  then 75
+                when replace(lab_test_value, ' ', '') = '<136'  then 136
+                when replace(lab_test_value, ' ', '') like '%<250%'  then 250
+  	        when replace(lab_test_value, ' ', '') like '%>10000%'  then 10000
+		when replace(replace(lab_test_value, ' ', ''), ',', '') like '%>500000%'  then 500000
+		when replace(lab_test_value, ',', '') ilike '%greater than 5000000%'  then 5000000
+		when replace(lab_test_value, ',', '') like '%>10000000%'  then 10000000
+                when (regexp_split_to_array(lab_test_value, 'Reference'))[1] ilike '%No HIV-1 RNA detected%'  then 0
+		when replace(lab_test_value, ' ', '') = '' then 0
+                else replace((regexp_split_to_array(replace(lower(lab_test_value), ' ', ''), 'copies'))[1], ',', '')::int
+        end"""
+
+LEGACY_CELL_COUNT = """
+	       case
+                   when lab_test_value ilike '%credited%' then NULL
+                   else lab_test_value::float
+	       end"""
+
+LAB_ROWS = """
+        from events_ucm.events
+        left join lookup_ucm.test_types
+             on lab_test_type_cd = test_type_id
+        {join}
+        where event_type = 'lab'
+              and {test_filter}"""
+
+VIRAL_LOAD_FILTER = "trim(lower(test_type))='hiv-1 viral load hiv-rna level:'"
+CELL_COUNT_FILTER = "(test_type like '%cd4%' or test_type like '%cd8%')"
+LOOKUP_JOIN = """left join lookup_ucm.lab_values
+             on lab_values.lab_test_value = events.lab_test_value"""
+
+
+def time_query(curs, query, repeat):
+    """Best time in seconds of running query repeat times"""
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        curs.execute(query)
+        curs.fetchall()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def legacy_values(curs, expression, test_filter):
+    """
+    Evaluate a legacy CASE expression on every distinct value of the lab
+    rows it applies to. Values the expression fails on map to an error
+    string, as they made the whole legacy statement fail.
+    """
+    curs.execute("select distinct lab_test_value" + LAB_ROWS.format(
+        join='', test_filter=test_filter))
+    values = [row[0] for row in curs.fetchall()]
+    results = {}
+    for value in values:
+        curs.execute("savepoint legacy")
+        try:
+            curs.execute("select {} from (select %s::text as lab_test_value) v".format(
+                expression), (value,))
+            results[value] = curs.fetchone()[0]
+        except Exception as e:
+            curs.execute("rollback to savepoint legacy")
+            results[value] = 'error: {}'.format(str(e).strip().splitlines()[0])
+    return results
+
+
+def check_parity(curs, expression, test_filter, parse):
+    """Values where the Python parser and the legacy CASE expression differ"""
+    mismatches = []
+    for value, expected in sorted(legacy_values(curs, expression, test_filter).items(),
+                                  key=lambda item: str(item[0])):
+        parsed = parse(value)
+        if isinstance(expected, str) and expected.startswith('error'):
+            if parsed is not None:
+                mismatches.append((value, expected, parsed))
+        elif parsed != expected:
+            mismatches.append((value, expected, parsed))
+    return mismatches
+
+
+def main(postgres_config, repeat=3):
+    started = time.time()
+    parsed = update_lab_values(postgres_config)
+    parse_time = time.time() - started
+
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("select count(*) from {}".format(LAB_VALUES_TABLE))
+        distinct_values = curs.fetchone()[0]
+        print("{} distinct lab values, {} parsed in this run ({:.2f}s)".format(
+            distinct_values, parsed, parse_time))
+
+        queries = [
+            ('viral load, CASE', 'select ' + LEGACY_VIRAL_LOAD + LAB_ROWS.format(
+                join='', test_filter=VIRAL_LOAD_FILTER)),
+            ('viral load, lookup', 'select lab_values.viral_load' + LAB_ROWS.format(
+                join=LOOKUP_JOIN, test_filter=VIRAL_LOAD_FILTER)),
+            # The legacy cast fails on any non-numeric CD4/CD8 value, so the
+            # CASE is timed on the values it can parse.
+            ('cd4/cd8, CASE', 'select ' + LEGACY_CELL_COUNT + LAB_ROWS.format(
+                join=LOOKUP_JOIN, test_filter=CELL_COUNT_FILTER + " and "
+                "(lab_values.cell_count is not null or lab_test_value ilike '%credited%')")),
+            ('cd4/cd8, lookup', 'select lab_values.cell_count' + LAB_ROWS.format(
+                join=LOOKUP_JOIN, test_filter=CELL_COUNT_FILTER)),
+        ]
+        for name, query in queries:
+            print("{:20s} {:8.3f}s".format(name, time_query(curs, query, repeat)))
+
+        for name, expression, test_filter, parse in [
+                ('viral load', LEGACY_VIRAL_LOAD, VIRAL_LOAD_FILTER, parse_viral_load),
+                ('cd4/cd8', LEGACY_CELL_COUNT, CELL_COUNT_FILTER, parse_cell_count)]:
+            mismatches = check_parity(curs, expression, test_filter, parse)
+            print("{}: {} values differ from the CASE expression".format(
+                name, len(mismatches)))
+            for value, expected, parsed in mismatches[:20]:
+                print("  {!r}: CASE {!r}, parser {!r}".format(value, expected, parsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=None,
+                        help='yaml file with the database connection')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every query; the best time is reported')
+    args = parser.parse_args()
+    main(get_postgres_config(args.config), repeat=args.repeat)
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+"""
+Build the feature tables from the SQL scripts in features/, running
+scripts that do not touch the same tables in parallel and, for feature
+tables that only depend on the events of their own entity, recomputing
+just the entities with events added since the last build.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'etl'))
+import db
+from config import _does_table_exist
+from instrumentation import recorded_run, stage
+from sql_executor import (DROP_INDEX_PATTERN, DROP_PATTERN, NAME, Statement, analyze,
+                          execute_statements)
+from lab_values import LAB_VALUES_TABLE, PARSER_VERSION, update_lab_values
+
+EVENTS_TABLE = 'events_ucm.events'
+# Count of the statements that updated or deleted events, kept by the
+# triggers of etl/schemas/create_tables/05_create_visits_events_tables.sql
+EVENTS_CHANGES_TABLE = 'events_ucm.events_changes'
+# Tables a feature table may read, besides the events, and still be
+# built incrementally
+LOOKUP_SCHEMAS = ('lookup_ucm',)
+FEATURE_MANIFEST_TABLE = 'build_manifest'
+
+CREATE_AS_PATTERN = re.compile(r'^\s*create\s+table\s+' + NAME + r'\s+as\s*(.*)$',
+                               re.IGNORECASE | re.DOTALL)
+CREATE_INDEX_PATTERN = re.compile(r'^\s*create\s+(?:unique\s+)?index\b', re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r'\blimit\b', re.IGNORECASE)
+# A reference to the events table, with its alias if it has one
+EVENTS_REFERENCE = re.compile(
+    r'(?<![\w$."]){}\s*\.\s*{}(?![\w$"])'.format(*map(re.escape, EVENTS_TABLE.split('.'))) +
+    r'(?:\s+(?:as\s+)?(?!(?:as|where|join|inner|left|right|full|cross|natural|on|using|'
+    r'group|order|having|window|limit|union|except|intersect|lateral|tablesample)\b)'
+    r'([a-z_][\w$]*))?', re.IGNORECASE)
+# Joins that keep rows of other tables than the events when an entity has
+# no events; their rows would not be limited to the recomputed entities
+OUTER_JOIN_PATTERN = re.compile(
+    r'\b(?:right|full)\s+(?:outer\s+)?join\b|\bleft\s+(?:outer\s+)?join\s+' +
+    re.escape(EVENTS_TABLE) + r'(?![\w$])', re.IGNORECASE)
+
+
+class FeatureScript(object):
+    """
+    A feature script with its statements and the tables they read and
+    write, taken together.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r') as f:
+            self.statements = analyze(f.read())
+        self.reads = set()
+        self.writes = set()
+        for statement in self.statements:
+            self.reads.update(statement.reads)
+            self.writes.update(statement.writes)
+        self.dependencies = set()
+
+    def conflicts_with(self, other):
+        return bool(self.writes & (other.reads | other.writes)
+                    or self.reads & other.writes)
+
+    def incremental_tables(self):
+        """
+        The tables of the script that can be built incrementally, with the
+        SELECT that fills them: tables that are only dropped, created from
+        a SELECT on the events and lookup tables that returns entity_id,
+        and indexed. Such a SELECT is assumed to compute the rows of an
+        entity from the events of that entity only.
+
+        Return
+        ------
+        tables: dict
+           the SELECT of every incremental table, keyed by table name
+        """
+        tables = {}
+        rejected = set()
+        for statement in self.statements:
+            lowered = statement.sql.lower()
+            create = CREATE_AS_PATTERN.match(statement.sql)
+            for table in statement.writes:
+                if create and EVENTS_TABLE in statement.reads \
+                        and all(name == EVENTS_TABLE or name.split('.')[0] in LOOKUP_SCHEMAS
+                                for name in statement.reads) \
+                        and re.search(r'\bentity_id\b', lowered) \
+                        and not LIMIT_PATTERN.search(lowered) \
+                        and not OUTER_JOIN_PATTERN.search(lowered) \
+                        and not statement.uses_temp_table:
+                    tables[table] = create.group(2).strip()
+                elif not (DROP_PATTERN.match(lowered)
+                          or DROP_INDEX_PATTERN.match(lowered)
+                          or CREATE_INDEX_PATTERN.match(lowered)):
+                    rejected.add(table)
+        return {table: select for table, select in tables.items()
+                if table not in rejected}
+
+
+def build_features(postgres_config, paths, workers=1, full=False):
+    """
+    Run the feature scripts, up to workers at a time. A script waits for
+    the earlier scripts that write a table it reads or writes, so the
+    result is the same as running them one after the other in order.
+    New lab_test_values are parsed into lookup_ucm.lab_values first if a
+    script reads it.
+
+    Parameter
+    ---------
+    postgres_config: PostgresConfig
+       database holding the events and the feature tables
+    paths: list
+       feature scripts, in the order they would run one after the other
+    workers: int
+       maximum number of scripts running at once
+    full: bool
+       rebuild every table from scratch, ignoring the high-water marks
+
+    Return
+    ------
+    failures: dict
+       exceptions of the scripts that could not be run, keyed by path
+    """
+    postgres_config.open_pool(workers)
+    scripts = [FeatureScript(path) for path in paths]
+    for i, script in enumerate(scripts):
+        script.dependencies = set(j for j in range(i) if script.conflicts_with(scripts[j]))
+    for schema in set(table.split('.')[0] for script in scripts
+                      for table in script.incremental_tables()):
+        ensure_feature_manifest(postgres_config, schema)
+    if any(LAB_VALUES_TABLE in script.reads for script in scripts):
+        with stage('lab values'):
+            update_lab_values(postgres_config)
+
+    pending = dict(enumerate(scripts))
+    done = set()
+    running = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for i in sorted(pending):
+                if pending[i].dependencies <= done and len(running) < workers:
+                    running[executor.submit(_timed_build_script, postgres_config,
+                                            pending[i], full)] = i
+                    del pending[i]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                done.add(i)
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[scripts[i].path] = e
+                    print("{} FAILED: {}".format(scripts[i].path, e))
+    return failures
+
+
+def _timed_build_script(postgres_config, script, full=False):
+    with stage('features {}'.format(os.path.basename(script.path))):
+        return build_script(postgres_config, script, full)
+
+
+def build_script(postgres_config, script, full=False):
+    """
+    Run a feature script on a connection of its own. Incremental tables
+    that were built before by the same statement are not dropped; the rows
+    of the entities with events added since their high-water mark are
+    deleted and computed again in a single transaction. A table is built
+    in full instead when the events table was recreated or truncated, or
+    had rows updated or deleted, since its last build, or when that cannot
+    be told.
+    """
+    started = time.time()
+    incremental = script.incremental_tables()
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute('SELECT coalesce(max(event_id), 0) FROM {};'.format(EVENTS_TABLE))
+        high_water_mark = curs.fetchone()[0]
+        identity = events_identity(curs)
+        if identity is None and incremental and not full:
+            print("{} does not exist, so updated or deleted events cannot be told "
+                  "apart; building every table in full".format(EVENTS_CHANGES_TABLE))
+        built = {}
+        for table, select in incremental.items():
+            schema, name = table.split('.')
+            entry = get_entry(curs, schema, name, os.path.basename(script.path))
+            if full or identity is None or entry is None \
+                    or entry['statement_hash'] != _statement_hash(script, select) \
+                    or not _does_table_exist(curs, name, schema):
+                continue
+            if entry['events_identity'] != identity \
+                    or entry['high_water_mark'] > high_water_mark:
+                print("{}: {} was recreated, truncated, updated or deleted from "
+                      "since the last build; rebuilding it in full".format(table, EVENTS_TABLE))
+                continue
+            built[table] = entry['high_water_mark']
+
+    statements = []
+    for statement in script.statements:
+        tables = statement.writes & set(built)
+        if not tables:
+            statements.append(statement)
+            continue
+        table = tables.pop()
+        if not CREATE_AS_PATTERN.match(statement.sql):
+            continue
+        if built[table] == high_water_mark:
+            print("{}: no new events since the last build".format(table))
+            continue
+        print("{}: recomputing entities with events after event_id {}".format(
+            table, built[table]))
+        new_entities = ('SELECT entity_id FROM {} WHERE event_id > {} AND event_id <= {}'
+                        .format(EVENTS_TABLE, built[table], high_water_mark))
+        # Both statements are sent at once, so they run in one transaction.
+        statements.append(Statement(
+            statement.position,
+            'DELETE FROM {table} WHERE entity_id IN ({entities});\n'
+            'INSERT INTO {table} {select}'.format(
+                table=table, entities=new_entities,
+                select=restrict_to_entities(incremental[table], new_entities)),
+            {}))
+
+    timings = execute_statements(postgres_config, statements, label=script.path)
+    failed = set(table for _, statement, error in timings if error is not None
+                 for table in statement.writes)
+    for table in set(incremental) - failed:
+        schema, name = table.split('.')
+        record_build(postgres_config, schema, name, os.path.basename(script.path),
+                     _statement_hash(script, incremental[table]), high_water_mark,
+                     identity)
+    print("{} done in {:.1f}s".format(script.path, time.time() - started))
+
+
+def restrict_to_entities(select, entities):
+    """
+    Make a feature SELECT read only the events of some entities, by
+    replacing every scan of the events table with a scan of the events
+    of those entities, under the same alias. The rows of an incremental
+    table come from the events of their own entity, so the SELECT then
+    returns the rows of those entities only, computed from their events.
+
+    Parameter
+    ---------
+    select: str
+       SELECT of an incremental table
+    entities: str
+       SELECT of the entity_ids to recompute
+
+    Return
+    ------
+    select: str
+    """
+    def restrict(match):
+        return '(SELECT * FROM {} WHERE entity_id IN ({})) AS {}'.format(
+            EVENTS_TABLE, entities, match.group(1) or EVENTS_TABLE.split('.')[1])
+    return EVENTS_REFERENCE.sub(restrict, select)
+
+
+def events_identity(curs):
+    """
+    Identity of the events table and of its partitions: their oids and
+    data files, which change when a table is recreated or truncated, and
+    the count of statements that updated or deleted events. New events
+    leave it as is. None if the events are not tracked by the triggers
+    that keep that count.
+    """
+    curs.execute('SELECT to_regclass(%s);', (EVENTS_CHANGES_TABLE,))
+    if curs.fetchone()[0] is None:
+        return None
+    curs.execute("""SELECT string_agg(concat_ws(':', c.oid, c.relfilenode), ','
+                                      ORDER BY c.oid)
+                           || ';' || (SELECT max(changes) FROM {})
+                      FROM (SELECT relid FROM pg_partition_tree(%s::regclass)
+                             UNION
+                            SELECT %s::regclass) AS t
+                      JOIN pg_class c ON c.oid = t.relid;
+                 """.format(EVENTS_CHANGES_TABLE), (EVENTS_TABLE, EVENTS_TABLE))
+    return curs.fetchone()[0]
+
+
+def _hash(select):
+    return hashlib.sha256(' '.join(select.split()).encode('utf-8')).hexdigest()
+
+
+def _statement_hash(script, select):
+    """
+    Hash of the SELECT of an incremental table, which also changes with
+    the version of the lab value parsers if the script reads their
+    results, so the table is built in full again after they change.
+    """
+    if LAB_VALUES_TABLE in script.reads:
+        select = '{}\n-- {} parser version {}'.format(select, LAB_VALUES_TABLE, PARSER_VERSION)
+    return _hash(select)
+
+
+def ensure_feature_manifest(postgres_config, schema):
+    """Create the table of high-water marks in schema if it does not exist yet"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+        curs.execute("""CREATE TABLE IF NOT EXISTS "{}"."{}" (
+                          table_name text,
+                          script text,
+                          statement_hash text,
+                          high_water_mark bigint,
+                          events_identity text,
+                          built_at timestamp DEFAULT now(),
+                          PRIMARY KEY (table_name, script));
+                     """.format(schema, FEATURE_MANIFEST_TABLE))
+        curs.execute('ALTER TABLE "{}"."{}" ADD COLUMN IF NOT EXISTS events_identity text;'
+                     .format(schema, FEATURE_MANIFEST_TABLE))
+
+
+def get_entry(curs, schema, table_name, script):
+    """
+    Return the statement hash, high-water mark and events table identity
+    of the last build of a table by a script, or None if it was not
+    recorded
+    """
+    curs.execute("""SELECT statement_hash, high_water_mark, events_identity
+                      FROM "{}"."{}"
+                     WHERE table_name = %s
+                       AND script = %s;
+                 """.format(schema, FEATURE_MANIFEST_TABLE), (table_name, script))
+    row = curs.fetchone()
+    if row is None:
+        return None
+    return dict(zip(['statement_hash', 'high_water_mark', 'events_identity'], row))
+
+
+def record_build(postgres_config, schema, table_name, script, statement_hash,
+                 high_water_mark, events_identity):
+    """Insert or replace the high-water mark of a table built by a script"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""INSERT INTO "{}"."{}"
+                            (table_name, script, statement_hash, high_water_mark,
+                             events_identity, built_at)
+                        VALUES (%s, %s, %s, %s, %s, now())
+                        ON CONFLICT (table_name, script) DO UPDATE
+                           SET statement_hash = EXCLUDED.statement_hash,
+                               high_water_mark = EXCLUDED.high_water_mark,
+                               events_identity = EXCLUDED.events_identity,
+                               built_at = EXCLUDED.built_at;
+                     """.format(schema, FEATURE_MANIFEST_TABLE),
+                     (table_name, script, statement_hash, high_water_mark,
+                      events_identity))
+
+
+def get_postgres_config(config_file=None):
+    """
+    Connection settings from a yaml file, either flat or under a postgres
+    key; without a file, the PG* environment variables are used, as psql
+    does.
+    """
+    return db.get_postgres_config(config_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*',
+                        help='feature scripts, all of features/*.sql by default')
+    parser.add_argument('--config', default=None,
+                        help='yaml file with the database connection')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of feature scripts run at the same time')
+    parser.add_argument('--full', action='store_true',
+                        help='rebuild every feature table from scratch')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory of the JSON-lines timing records and '
+                             'of the runs summary')
+    parser.add_argument('--explain-slowest', type=int, default=0,
+                        help='capture EXPLAIN (ANALYZE, BUFFERS) of this many '
+                             'of the slowest statements; their queries are run again')
+    args = parser.parse_args()
+    files = args.files or sorted(glob.glob(os.path.join('features', '*.sql')))
+
+    with recorded_run('features', args.profile_dir, args.explain_slowest):
+        failures = build_features(get_postgres_config(args.config), files,
+                                  workers=args.workers, full=args.full)
+    if failures:
+        print("{} of {} scripts failed: {}".format(
+            len(failures), len(files), ', '.join(sorted(failures))))
+        sys.exit(1)
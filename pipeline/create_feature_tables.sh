@@ -1,9 +1,37 @@
 #!/bin/bash
 # TODO: need to change permissions on this
 
-./create_acs_tables.sh
-
-for f in `ls features/*sql`; do
-    echo $f
-    psql -f $f
+# Pass --workers N to build N ACS years and run N feature scripts at once,
+# --full to rebuild every ACS year and feature table from scratch.
+# --config, --workers, --full, --profile-dir and --explain-slowest go to
+# both scripts; --years goes to acs_tables.py only.
+common_args=()
+acs_args=()
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --full)
+            common_args+=("$1")
+            shift
+            ;;
+        --config|--workers|--profile-dir|--explain-slowest)
+            common_args+=("$1" "$2")
+            shift 2
+            ;;
+        --years)
+            acs_args+=("$1")
+            shift
+            while [ $# -gt 0 ] && [ "${1#-}" = "$1" ]; do
+                acs_args+=("$1")
+                shift
+            done
+            ;;
+        *)
+            echo "Unknown option $1" >&2
+            exit 2
+            ;;
+    esac
 done
+
+python acs_tables.py "${common_args[@]}" "${acs_args[@]}"
+
+python build_features.py features/*.sql "${common_args[@]}"
@@ -0,0 +1,98 @@
+"""
+Assemble the experiment config from the main config and the feature
+aggregations in features/*.yaml, in a deterministic order and cached
+under a hash of the input files.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import yaml
+
+# The C loader is much faster; fall back to the pure Python one
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+CACHE_DIRECTORY = '.config_cache'
+
+
+def load_yaml(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def feature_files(features_directory):
+    """The feature config files of a directory, sorted by name"""
+    return sorted(os.path.join(features_directory, filename)
+                  for filename in os.listdir(features_directory)
+                  if filename.endswith('.yaml'))
+
+
+def content_hash(paths):
+    """sha256 of the names and contents of files"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _aggregation_key(aggregation):
+    return (aggregation.get('prefix', ''),
+            json.dumps(aggregation, sort_keys=True, default=str))
+
+
+def merge_feature_aggregations(paths):
+    """
+    All feature aggregations of the files, sorted by prefix (and by their
+    content for equal prefixes), so the merged config does not depend on
+    the order of the files or of the aggregations within them.
+    """
+    aggregations = []
+    for path in paths:
+        aggregations.extend(load_yaml(path)['feature_aggregations'])
+    return sorted(aggregations, key=_aggregation_key)
+
+
+def assemble_experiment_config(config_file, features_directory,
+                               cache_directory=None):
+    """
+    Load the experiment config and set its feature_aggregations to the
+    aggregations of every features/*.yaml file.
+
+    The merged config is pickled under the hash of the input files, so
+    it is only parsed again when one of them changes, and a cached config
+    has the same types as a parsed one (dates stay dates, integer keys
+    stay integers). As the
+    aggregations are always in the same order, the same files give the
+    same config, and so the same experiment hash in Triage, which reuses
+    the matrices and models it already has.
+
+    In:
+        config_file: path to the main experiment config
+        features_directory: directory with the feature configs
+        cache_directory: where merged configs are cached, by default
+            .config_cache in features_directory
+    Out:
+        (experiment config dict, content hash of the input files)
+    """
+    paths = [config_file] + feature_files(features_directory)
+    config_hash = content_hash(paths)
+    cache_directory = cache_directory or os.path.join(features_directory, CACHE_DIRECTORY)
+    cache_path = os.path.join(cache_directory, config_hash + '.pickle')
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f), config_hash
+
+    experiment_config = load_yaml(config_file)
+    experiment_config['feature_aggregations'] = merge_feature_aggregations(paths[1:])
+
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+    temporary_path = cache_path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(experiment_config, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_path, cache_path)
+    return experiment_config, config_hash
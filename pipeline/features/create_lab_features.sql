@@ -2,31 +2,17 @@
 -- Note: We might want to do some of this in the data cleaning rather than here?
 
 drop table if exists features_cs.viral_load;
+-- lab_test_value is parsed once per distinct value by pipeline/lab_values.py
 create table features_cs.viral_load as
        (select
 	distinct entity_id,
 	lab_result_date as date_col,
-        case
-		when lab_test_value ilike '%credited%' or lab_test_value ilike '%NAT HIV REACTIV%' then NULL
-                when lab_test_value ilike '%none detected%'  then 0
-                when trim(lab_test_value) = 'No HIV-1 RNA detected' then 0
-                when lab_test_value ilike '%less than 20%'  or lab_test_value ilike '%<20%'  then 0
-                when replace(lab_test_value, ' ', '') like '%<50%'  then 50
-                when replace(lab_test_value, ' ', '') like '%<5O%'  then 50 -- too account for a typo
-                when replace(lab_test_value, ' ', '') like '%<75%'  then 75
-                when replace(lab_test_value, ' ', '') = '<136'  then 136
-                when replace(lab_test_value, ' ', '') like '%<250%'  then 250
-  	        when replace(lab_test_value, ' ', '') like '%>10000%'  then 10000
-		when replace(replace(lab_test_value, ' ', ''), ',', '') like '%>500000%'  then 500000
-		when replace(lab_test_value, ',', '') ilike '%greater than 5000000%'  then 5000000
-		when replace(lab_test_value, ',', '') like '%>10000000%'  then 10000000
-                when (regexp_split_to_array(lab_test_value, 'Reference'))[1] ilike '%No HIV-1 RNA detected%'  then 0
-		when replace(lab_test_value, ' ', '') = '' then 0
-                else replace((regexp_split_to_array(replace(lower(lab_test_value), ' ', ''), 'copies'))[1], ',', '')::int
-        end as lab_result
+        lab_values.viral_load as lab_result
 	from events_ucm.events
         left join lookup_ucm.test_types
              on lab_test_type_cd = test_type_id
+        left join lookup_ucm.lab_values
+             on lab_values.lab_test_value = events.lab_test_value
         where event_type = 'lab'
               and trim(lower(test_type))='hiv-1 viral load hiv-rna level:'
 	);
@@ -40,13 +26,12 @@ create temp table cd8 as
                distinct entity_id,
        	       lab_result_date as date_col,
 	       test_type,
-	       case
-                   when lab_test_value ilike '%credited%' then NULL
-                   else lab_test_value::float
-	       end as cd8
+	       lab_values.cell_count as cd8
         from events_ucm.events
         left join lookup_ucm.test_types
              on lab_test_type_cd = test_type_id
+        left join lookup_ucm.lab_values
+             on lab_values.lab_test_value = events.lab_test_value
         where event_type = 'lab'  and test_type like '%cd8%'
         );
 drop table cd4;
@@ -55,13 +40,12 @@ create temp table cd4 as
                distinct entity_id,
                lab_result_date as date_col,
                test_type,
-               case
-                   when lab_test_value ilike '%credited%' then NULL
-                   else lab_test_value::float
-               end as cd4
+               lab_values.cell_count as cd4
         from events_ucm.events
         left join lookup_ucm.test_types
              on lab_test_type_cd = test_type_id
+        left join lookup_ucm.lab_values
+             on lab_values.lab_test_value = events.lab_test_value
         where event_type = 'lab'  and test_type like '%cd4%'
         );
 
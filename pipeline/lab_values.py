@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Parse every distinct raw lab_test_value once and keep the results in
+lookup_ucm.lab_values, which the lab feature tables join against instead
+of parsing the value of every lab row.
+"""
+import argparse
+import re
+import time
+
+from psycopg2.extras import execute_values
+
+LAB_VALUES_TABLE = 'lookup_ucm.lab_values'
+# Values parsed by an older version of the parsers are parsed again
+PARSER_VERSION = 1
+
+INT_PATTERN = re.compile(r'^\s*[+-]?\d+\s*$')
+FLOAT_PATTERN = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)(e[+-]?\d+)?\s*$|'
+                           r'^\s*[+-]?(nan|inf|infinity)\s*$', re.IGNORECASE)
+INT_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+# Conditions on lookup_ucm.test_types.test_type of the lab rows whose
+# values create_lab_features.sql reads as viral loads and as cell counts
+VIRAL_LOAD_TEST = "trim(lower(test_type)) = 'hiv-1 viral load hiv-rna level:'"
+CELL_COUNT_TEST = "test_type like '%cd4%' or test_type like '%cd8%'"
+
+
+def parse_viral_load(value, failures=None):
+    """
+    Viral load in copies/ml of a raw lab_test_value, following the CASE
+    expression create_lab_features.sql used to apply to every lab row.
+
+    In:
+        value: raw lab_test_value (or None)
+        failures: list that gets the values that could not be parsed
+    Out: int, or None for null, credited or unparsable values
+    """
+    if value is None:
+        return None
+    lowered = value.lower()
+    no_spaces = value.replace(' ', '')
+    if 'credited' in lowered or 'nat hiv reactiv' in lowered:
+        return None
+    if 'none detected' in lowered:
+        return 0
+    if value.strip(' ') == 'No HIV-1 RNA detected':
+        return 0
+    if 'less than 20' in lowered or '<20' in lowered:
+        return 0
+    if '<50' in no_spaces or '<5O' in no_spaces:
+        return 50
+    if '<75' in no_spaces:
+        return 75
+    if no_spaces == '<136':
+        return 136
+    if '<250' in no_spaces:
+        return 250
+    if '>10000' in no_spaces:
+        return 10000
+    if '>500000' in no_spaces.replace(',', ''):
+        return 500000
+    if 'greater than 5000000' in lowered.replace(',', ''):
+        return 5000000
+    if '>10000000' in value.replace(',', ''):
+        return 10000000
+    if 'no hiv-1 rna detected' in value.split('Reference')[0].lower():
+        return 0
+    if no_spaces == '':
+        return 0
+    number = lowered.replace(' ', '').split('copies')[0].replace(',', '')
+    if INT_PATTERN.match(number) and INT_RANGE[0] <= int(number) <= INT_RANGE[1]:
+        return int(number)
+    if failures is not None:
+        failures.append(value)
+    return None
+
+
+def parse_cell_count(value, failures=None):
+    """
+    CD4 or CD8 count of a raw lab_test_value.
+
+    In:
+        value: raw lab_test_value (or None)
+        failures: list that gets the values that could not be parsed
+    Out: float, or None for null, credited or unparsable values
+    """
+    if value is None or 'credited' in value.lower():
+        return None
+    if not FLOAT_PATTERN.match(value):
+        if failures is not None:
+            failures.append(value)
+        return None
+    return float(value)
+
+
+def ensure_lab_values(postgres_config):
+    """Create the lookup table if it does not exist yet"""
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""CREATE TABLE IF NOT EXISTS {} (
+                          lab_test_value text PRIMARY KEY,
+                          viral_load int,
+                          cell_count float,
+                          parser_version int,
+                          parsed_at timestamp DEFAULT now());
+                     """.format(LAB_VALUES_TABLE))
+
+
+def update_lab_values(postgres_config, page_size=1000):
+    """
+    Parse the lab_test_values of events_ucm.events that are not in the
+    lookup table yet, or were parsed by an older parser version, and
+    store them. The values that could not be parsed are stored as nulls
+    and counted for each test they are a result of, with an example.
+
+    In:
+        postgres_config: PostgresConfig
+        page_size: rows sent per INSERT
+    Out:
+        number of values parsed
+    """
+    started = time.time()
+    ensure_lab_values(postgres_config)
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute("""SELECT e.lab_test_value,
+                               coalesce(bool_or({viral_load_test}), false),
+                               coalesce(bool_or({cell_count_test}), false)
+                          FROM events_ucm.events e
+                          LEFT JOIN lookup_ucm.test_types
+                               ON lab_test_type_cd = test_type_id
+                         WHERE event_type = 'lab'
+                           AND e.lab_test_value IS NOT NULL
+                           AND NOT EXISTS (
+                               SELECT 1
+                                 FROM {table} l
+                                WHERE l.lab_test_value = e.lab_test_value
+                                  AND l.parser_version = %s)
+                         GROUP BY 1;
+                     """.format(table=LAB_VALUES_TABLE,
+                                viral_load_test=VIRAL_LOAD_TEST.replace('%', '%%'),
+                                cell_count_test=CELL_COUNT_TEST.replace('%', '%%')),
+                     (PARSER_VERSION,))
+        rows = []
+        failures = {'viral load': [], 'cell count': []}
+        for value, viral_load_test, cell_count_test in curs.fetchall():
+            rows.append((value,
+                         parse_viral_load(value, failures['viral load'] if viral_load_test
+                                          else None),
+                         parse_cell_count(value, failures['cell count'] if cell_count_test
+                                          else None),
+                         PARSER_VERSION))
+        execute_values(curs,
+                       """INSERT INTO {} (lab_test_value, viral_load, cell_count,
+                                          parser_version)
+                          VALUES %s
+                          ON CONFLICT (lab_test_value) DO UPDATE
+                             SET viral_load = EXCLUDED.viral_load,
+                                 cell_count = EXCLUDED.cell_count,
+                                 parser_version = EXCLUDED.parser_version,
+                                 parsed_at = now();
+                       """.format(LAB_VALUES_TABLE),
+                       rows, page_size=page_size)
+    print("{}: parsed {} new lab values in {:.1f}s".format(
+        LAB_VALUES_TABLE, len(rows), time.time() - started))
+    for test, values in sorted(failures.items()):
+        if values:
+            print("{}: {} distinct {} values could not be parsed and are null, "
+                  "e.g. {}".format(LAB_VALUES_TABLE, len(values), test,
+                                   ', '.join(repr(value) for value in sorted(values)[:3])))
+    return len(rows)
+
+
+if __name__ == '__main__':
+    from build_features import get_postgres_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=None,
+                        help='yaml file with the database connection')
+    args = parser.parse_args()
+    update_lab_values(get_postgres_config(args.config))
@@ -0,0 +1,165 @@
+"""
+Matrix store that keeps a columnar Arrow copy of every matrix CSV next to
+it, memory-maps that copy instead of parsing the CSV again, and keeps the
+most recently used matrices in a size-bounded LRU cache.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from catwalk.storage import MettaCSVMatrixStore
+
+from sparse_features import compact_matrix
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+ARROW_SUFFIX = '.arrow'
+COMPACT_ARROW_SUFFIX = '.compact.arrow'
+DEFAULT_CACHE_BYTES = 8 * 1024 ** 3
+
+
+class MatrixCache(object):
+    """
+    Least recently used matrices of this process, up to max_bytes in
+    total. A matrix larger than max_bytes is returned but not kept.
+
+    The cached matrices are read-only. They are returned as shallow
+    copies: a caller may add, drop or rename columns without changing the
+    matrix other callers get, but the column values are those of the
+    cache, so they must not be changed in place (df.loc[...] = ...,
+    fillna(inplace=True), ...); copy the matrix or the column first.
+    With pandas copy-on-write, the default from pandas 3, such a change
+    copies the column by itself, and the columns memory-mapped from an
+    Arrow file cannot be written to in any version.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.matrices = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.matrices:
+                return None
+            self.matrices.move_to_end(key)
+            return self.matrices[key][0].copy(deep=False)
+
+    def put(self, key, matrix, nbytes):
+        with self.lock:
+            if key in self.matrices:
+                self.size -= self.matrices.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.matrices and self.size + nbytes > self.max_bytes:
+                self.size -= self.matrices.popitem(last=False)[1][1]
+            self.matrices[key] = (matrix, nbytes)
+            self.size += nbytes
+
+
+MATRIX_CACHE = MatrixCache()
+
+
+def write_arrow(matrix, path, compression=None):
+    """
+    Write a matrix, with its index, as an Arrow IPC file. Uncompressed
+    files can be memory-mapped without copying; compression ('zstd' or
+    'lz4') makes them smaller but has to be undone on every read.
+    """
+    table = pyarrow.Table.from_pandas(matrix, preserve_index=True)
+    # A temporary file of its own, so processes writing the same matrix
+    # at the same time do not write into each other's file
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or os.curdir, prefix=os.path.basename(path) + '.',
+        suffix='.tmp')
+    os.close(descriptor)
+    try:
+        options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+        with pyarrow.OSFile(temporary_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def read_arrow(path):
+    """
+    Memory-map an Arrow IPC file into a DataFrame. Numeric columns
+    without nulls of uncompressed files are NumPy views over the mapped
+    file, so the pages are shared between processes by the OS.
+    """
+    source = pyarrow.memory_map(path, 'r')
+    table = pyarrow.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+class ArrowMatrixStore(MettaCSVMatrixStore):
+    """
+    MettaCSVMatrixStore reading matrices from their Arrow copy. The copy
+    is written the first time a matrix is loaded and rewritten whenever
+    the CSV is newer. Loaded matrices are shared through MATRIX_CACHE, so
+    every model of a grid trained or tested on the same matrix uses a
+    single load; they are read-only, as described in MatrixCache. With compact set, the features are downcast to the
+    smallest dtypes that hold them before the copy is written.
+    """
+    compression = None
+    compact = False
+
+    def __init__(self, *args, **kwargs):
+        if pyarrow is None:
+            raise ImportError("The pyarrow package is needed to store matrices as Arrow")
+        super(ArrowMatrixStore, self).__init__(*args, **kwargs)
+
+    @property
+    def arrow_path(self):
+        return os.path.splitext(self.matrix_path)[0] + (
+            COMPACT_ARROW_SUFFIX if self.compact else ARROW_SUFFIX)
+
+    def _load(self):
+        matrix = MATRIX_CACHE.get(self.arrow_path)
+        if matrix is None:
+            if not os.path.isfile(self.arrow_path) \
+                    or os.path.getmtime(self.arrow_path) < os.path.getmtime(self.matrix_path):
+                super(ArrowMatrixStore, self)._load()
+                if self.compact:
+                    compact_matrix(self._matrix, exclude=[self.metadata.get('label_name')])
+                write_arrow(self._matrix, self.arrow_path, self.compression)
+            matrix = read_arrow(self.arrow_path)
+            MATRIX_CACHE.put(self.arrow_path, matrix,
+                             int(matrix.memory_usage(index=True).sum()))
+            matrix = matrix.copy(deep=False)
+        self._matrix = matrix
+
+    def __getstate__(self):
+        # Send the path, not the matrix, to other processes; they map the
+        # same file.
+        state = self.__dict__.copy()
+        state['_matrix'] = None
+        return state
+
+
+def use_arrow_matrix_store(experiment, max_bytes=DEFAULT_CACHE_BYTES,
+                           compression=None, compact=False):
+    """
+    Make an experiment read its matrices through ArrowMatrixStore, with
+    a cache of max_bytes per process.
+    """
+    MATRIX_CACHE.max_bytes = max_bytes
+    ArrowMatrixStore.compression = compression
+    ArrowMatrixStore.compact = compact
+    matrix_store = experiment.matrix_store
+
+    def arrow_matrix_store(matrix_uuid):
+        store = matrix_store(matrix_uuid)
+        return ArrowMatrixStore(matrix_path=store.matrix_path,
+                                metadata_path=store.metadata_path)
+
+    experiment.matrix_store = arrow_matrix_store
+    return experiment
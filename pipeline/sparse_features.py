@@ -0,0 +1,183 @@
+"""
+Compact matrices for the wide, mostly-zero feature families (regex note
+features and diagnosis categories): small integer and float32 dtypes in
+the stored matrices, and CSR input for the models of the grid when the
+matrix is mostly zero.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+# Feature prefixes whose columns go into the sparse part of the model input
+SPARSE_PREFIXES = ('diag', 'ancillarydata', 'infectiousdata')
+# A column is only stored sparse when at most this fraction is non-zero
+MAX_DENSITY = 0.1
+
+
+def compact_dtype(values):
+    """
+    Smallest dtype that holds every value of a numeric column: uint8 or
+    uint16 for non-negative integer columns such as indicators and counts,
+    float32 otherwise.
+    """
+    if values.isna().any():
+        return np.float32
+    if (values % 1 == 0).all() and values.min() >= 0:
+        if values.max() <= np.iinfo(np.uint8).max:
+            return np.uint8
+        if values.max() <= np.iinfo(np.uint16).max:
+            return np.uint16
+    return np.float32
+
+
+def compact_matrix(matrix, exclude=()):
+    """
+    Downcast the float64 and int64 columns of a matrix in place. Columns
+    in exclude, such as the label, keep their dtype.
+
+    In:
+        matrix: DataFrame of a Triage matrix
+        exclude: column names to leave as they are
+    Out:
+        the compacted matrix
+    """
+    for column in matrix.columns:
+        if column in exclude or matrix[column].dtype not in (np.float64, np.int64):
+            continue
+        if matrix[column].empty:
+            continue
+        matrix[column] = matrix[column].astype(compact_dtype(matrix[column]))
+    return matrix
+
+
+def sparse_columns(matrix, prefixes=SPARSE_PREFIXES, max_density=MAX_DENSITY):
+    """Columns of the sparse feature families that are mostly zero"""
+    columns = []
+    for column in matrix.columns:
+        if not str(column).startswith(tuple(prefix + '_' for prefix in prefixes)):
+            continue
+        values = matrix[column]
+        if len(values) and (values != 0).mean() <= max_density:
+            columns.append(column)
+    return columns
+
+
+class ModelInputCache(object):
+    """
+    Model inputs of the last max_entries matrices. A matrix is recognised
+    by its columns, length and the memory of its column arrays, so the
+    shallow copies of a matrix handed out by the matrix store share one
+    entry; the arrays are kept referenced while their entry is cached, so
+    their memory is not reused by another matrix. A matrix changed in
+    place keeps its stale entry.
+    """
+    def __init__(self, max_entries=2):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(X):
+        arrays = [X[column].to_numpy() for column in X.columns]
+        return (tuple(X.columns), len(X),
+                tuple((a.__array_interface__['data'][0], a.strides, a.dtype.str)
+                      for a in arrays)), arrays
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+
+    def put(self, key, arrays, model_input):
+        with self.lock:
+            self.entries[key] = (arrays, model_input)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+MODEL_INPUT_CACHE = ModelInputCache()
+
+
+def to_model_input(X, prefixes=SPARSE_PREFIXES, max_density=MAX_DENSITY):
+    """
+    float32 model input of the features, in the columns' order: a CSR
+    matrix when at most max_density of the whole matrix is non-zero, a
+    dense array otherwise, since a CSR matrix of mostly non-zero values
+    takes more memory than the dense array. The mostly-zero columns of the
+    sparse families are built as sparse columns, without ever being
+    expanded to dense, and the other columns are converted as one array.
+    The input of the last matrices is cached in MODEL_INPUT_CACHE, so
+    fitting and predicting on the same matrix converts it once. Inputs
+    that are not DataFrames, and matrices without mostly-zero columns of
+    the sparse families, are returned as they are.
+    """
+    if not isinstance(X, pd.DataFrame):
+        return X
+    key, arrays = ModelInputCache.key(X)
+    model_input = MODEL_INPUT_CACHE.get(key)
+    if model_input is not None:
+        return model_input
+    sparse = set(sparse_columns(X, prefixes, max_density))
+    if not sparse:
+        return X
+    dense = [column for column in X.columns if column not in sparse]
+    sparse = [column for column in X.columns if column in sparse]
+    dense_values = X[dense].to_numpy(dtype=np.float32)
+    rows = []
+    data = []
+    for column in sparse:
+        values = X[column].to_numpy(dtype=np.float32)
+        nonzero = np.flatnonzero(values)
+        rows.append(nonzero)
+        data.append(values[nonzero])
+    nonzero = np.count_nonzero(dense_values) + sum(len(r) for r in rows)
+    if nonzero > max_density * X.shape[0] * X.shape[1]:
+        model_input = X.to_numpy(dtype=np.float32)
+    else:
+        indptr = np.concatenate([[0], np.cumsum([len(r) for r in rows])])
+        blocks = [scipy.sparse.csc_matrix(dense_values),
+                  scipy.sparse.csc_matrix((np.concatenate(data), np.concatenate(rows), indptr),
+                                          shape=(len(X), len(sparse)))]
+        # Back to the order of the columns, which the feature importances follow
+        position = dict((column, i) for i, column in enumerate(dense + sparse))
+        model_input = scipy.sparse.hstack(blocks, format='csc', dtype=np.float32)[
+            :, [position[column] for column in X.columns]].tocsr()
+    MODEL_INPUT_CACHE.put(key, arrays, model_input)
+    return model_input
+
+
+class SparseInputMixin(object):
+    """
+    Convert DataFrames with to_model_input before fitting and predicting,
+    so the sparse feature families stay sparse. The Sparse* classifiers
+    are used in the grid_config of parameters_config.yaml.
+    """
+    def fit(self, X, y, *args, **kwargs):
+        return super(SparseInputMixin, self).fit(to_model_input(X), y, *args, **kwargs)
+
+    def predict(self, X):
+        return super(SparseInputMixin, self).predict(to_model_input(X))
+
+    def predict_proba(self, X):
+        return super(SparseInputMixin, self).predict_proba(to_model_input(X))
+
+
+class SparseLogisticRegression(SparseInputMixin, LogisticRegression):
+    pass
+
+
+class SparseDecisionTreeClassifier(SparseInputMixin, DecisionTreeClassifier):
+    pass
+
+
+class SparseRandomForestClassifier(SparseInputMixin, RandomForestClassifier):
+    pass
@@ -1,35 +1,88 @@
-CREATE OR REPLACE FUNCTION _final_mode(anyarray)
-  RETURNS anyelement AS
+-- dsapp_mode reads its input in ascending order, which the feature
+-- configs give it with an ORDER BY in the quantity:
+--
+--     dsapp_mode(provider_id ORDER BY provider_id)
+--
+-- so equal values arrive one after the other and the state only holds
+-- the current value, the length of its run and the longest run so far,
+-- whatever the size of the group. Values are compared with the equality
+-- of their type (1.0 and 1.00 are the same numeric). Input that is not
+-- in order raises an error instead of giving a wrong mode.
+--
+-- Distinct counts use the built-in count(DISTINCT x); the feature configs
+-- ask for it with the metric count of the quantity 'distinct x'.
+--
+-- Needs Postgres 9.6 or later (FINALFUNC_EXTRA).
+DROP AGGREGATE IF EXISTS dsapp_mode(anyelement);
+DROP AGGREGATE IF EXISTS count_distinct(anyelement);
+DROP AGGREGATE IF EXISTS dsapp_mode(anycompatible);
+DROP AGGREGATE IF EXISTS count_distinct(anycompatible);
+DROP FUNCTION IF EXISTS _mode_add(jsonb, anyelement);
+DROP FUNCTION IF EXISTS _mode_combine(jsonb, jsonb);
+DROP FUNCTION IF EXISTS _final_mode(jsonb, anyelement);
+DROP FUNCTION IF EXISTS _final_mode(anyarray);
+DROP FUNCTION IF EXISTS _final_mode(anycompatiblearray);
+DROP FUNCTION IF EXISTS _count_distinct_add(anyarray, anyelement);
+DROP FUNCTION IF EXISTS _count_distinct_combine(anyarray, anyarray);
+DROP FUNCTION IF EXISTS _final_count_distinct(anyarray);
+DROP FUNCTION IF EXISTS _final_count_distinct(anycompatiblearray);
+
+-- State: {"value": <current value>, "run": <rows of the current value>,
+--         "best": <value of the longest run before it>, "best_run": <its rows>}
+CREATE OR REPLACE FUNCTION _mode_add(state jsonb, element anyelement)
+  RETURNS jsonb AS
 $BODY$
-    SELECT a
-    FROM unnest($1) a
-    GROUP BY 1 
-    ORDER BY COUNT(1) DESC, 1
-    LIMIT 1;
+DECLARE
+    previous element%TYPE;
+BEGIN
+    IF state->'run' IS NULL THEN
+        RETURN jsonb_build_object('value', element, 'run', 1, 'best', NULL, 'best_run', 0);
+    END IF;
+    previous := state->>'value';
+    IF element IS NOT DISTINCT FROM previous THEN
+        RETURN jsonb_set(state, '{run}', to_jsonb((state->>'run')::bigint + 1));
+    END IF;
+    -- Nulls sort last, so nothing may follow them
+    IF previous IS NULL OR element < previous THEN
+        RAISE EXCEPTION 'dsapp_mode needs its input in ascending order, nulls last: '
+                        'dsapp_mode(x ORDER BY x)';
+    END IF;
+    IF (state->>'run')::bigint > (state->>'best_run')::bigint THEN
+        state := state || jsonb_build_object('best', state->'value', 'best_run', state->'run');
+    END IF;
+    RETURN state || jsonb_build_object('value', element, 'run', 1);
+END;
 $BODY$
-LANGUAGE SQL IMMUTABLE;
- 
--- Tell Postgres how to use our aggregate
-CREATE AGGREGATE dsapp_mode(anyelement) (
-  SFUNC=array_append, --Function to call for each row. Just builds the array
-  STYPE=anyarray,
-  FINALFUNC=_final_mode, --Function to call after everything has been added to array
-  INITCOND='{}' --Initialize an empty array when starting
-);
+LANGUAGE plpgsql IMMUTABLE;
 
-
-DROP FUNCTION _final_count_distinct(anyarray) CASCADE;
-CREATE OR REPLACE FUNCTION _final_count_distinct(anyarray)
-  RETURNS bigint AS
+-- The extra argument only carries the input type, so the most frequent
+-- value can be cast back to it. Ties go to the smallest value, and nulls
+-- count as a value that sorts last, as in the previous array-based
+-- version.
+CREATE OR REPLACE FUNCTION _final_mode(state jsonb, element anyelement)
+  RETURNS anyelement AS
 $BODY$
-    SELECT COUNT(DISTINCT a)
-    FROM unnest($1) a;
+DECLARE
+    best element%TYPE;
+BEGIN
+    IF state->'run' IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF (state->>'run')::bigint > (state->>'best_run')::bigint THEN
+        best := state->>'value';
+    ELSE
+        best := state->>'best';
+    END IF;
+    RETURN best;
+END;
 $BODY$
-LANGUAGE SQL IMMUTABLE;
+LANGUAGE plpgsql IMMUTABLE;
 
-CREATE AGGREGATE count_distinct(anyelement) (
-  SFUNC=array_append,
-  STYPE=anyarray,
-  FINALFUNC=_final_count_distinct,
-  INITCOND='{}' 
+-- Tell Postgres how to use our aggregate
+CREATE AGGREGATE dsapp_mode(anyelement) (
+  SFUNC=_mode_add, --Function to call for each row, in order. Counts the run of the value
+  STYPE=jsonb,
+  FINALFUNC=_final_mode, --Function to call after every value has been counted
+  FINALFUNC_EXTRA,
+  INITCOND='{}'
 );
@@ -0,0 +1,74 @@
+"""
+pipeline/build_features.py: which feature tables can be built
+incrementally, and how their SELECT is limited to some entities. No
+database is needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'pipeline'))
+pytest.importorskip('psycopg2')
+pytest.importorskip('click')
+
+from build_features import FeatureScript, restrict_to_entities  # noqa: E402
+
+ENTITIES = 'SELECT 1'
+RESTRICTED = '(SELECT * FROM events_ucm.events WHERE entity_id IN (SELECT 1)) AS {}'
+
+
+@pytest.mark.parametrize('reference, alias', [
+    ('events_ucm.events e', 'e'),
+    ('events_ucm.events AS e', 'e'),
+    ('events_ucm.events', 'events'),
+    ('EVENTS_UCM.EVENTS', 'events'),
+])
+def test_restrict_to_entities_keeps_the_alias(reference, alias):
+    select = ("SELECT entity_id, count(*) FROM {} WHERE event_type = 'visit' "
+              "GROUP BY 1".format(reference))
+    assert restrict_to_entities(select, ENTITIES) == (
+        "SELECT entity_id, count(*) FROM {} WHERE event_type = 'visit' "
+        "GROUP BY 1".format(RESTRICTED.format(alias)))
+
+
+def test_restrict_to_entities_replaces_every_scan_of_the_events():
+    select = ("SELECT entity_id FROM events_ucm.events "
+              "JOIN lookup_ucm.test_types ON lab_test_type_cd = test_type_id "
+              "JOIN (SELECT entity_id FROM events_ucm.events a WHERE event_type = 'address') "
+              "AS addresses USING (entity_id)")
+    restricted = restrict_to_entities(select, ENTITIES)
+
+    assert restricted == (
+        "SELECT entity_id FROM {} "
+        "JOIN lookup_ucm.test_types ON lab_test_type_cd = test_type_id "
+        "JOIN (SELECT entity_id FROM {} WHERE event_type = 'address') "
+        "AS addresses USING (entity_id)".format(RESTRICTED.format('events'),
+                                                RESTRICTED.format('a')))
+
+
+def test_restrict_to_entities_leaves_other_tables():
+    select = 'SELECT entity_id FROM events_ucm.events_visit JOIN my_events_ucm.events USING (x)'
+    assert restrict_to_entities(select, ENTITIES) == select
+
+
+def test_incremental_tables(tmpdir):
+    path = tmpdir.join('features.sql')
+    path.write("""
+        DROP TABLE IF EXISTS features.visits;
+        CREATE TABLE features.visits AS
+               SELECT entity_id, visit_date FROM events_ucm.events WHERE event_type = 'visit';
+        CREATE INDEX ON features.visits (entity_id);
+        DROP TABLE IF EXISTS features.latest;
+        CREATE TABLE features.latest AS
+               SELECT entity_id FROM events_ucm.events ORDER BY visit_date LIMIT 10;
+        DROP TABLE IF EXISTS features.updated;
+        CREATE TABLE features.updated AS SELECT entity_id FROM events_ucm.events;
+        UPDATE features.updated SET entity_id = 0;
+        CREATE TABLE features.other AS SELECT entity_id FROM staging.visits;
+    """)
+
+    assert FeatureScript(str(path)).incremental_tables() == {
+        'features.visits': ("SELECT entity_id, visit_date FROM events_ucm.events "
+                            "WHERE event_type = 'visit'")}
@@ -0,0 +1,80 @@
+"""
+etl/indexes.py against a scratch schema of a real database. The tests run
+when TEST_POSTGRES_CONFIG names a yaml file with the connection settings
+(flat or under a postgres key) of a Postgres 12+ database:
+
+    TEST_POSTGRES_CONFIG=local.yaml python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'etl'))
+pytest.importorskip('psycopg2')
+pytest.importorskip('click')
+
+import db  # noqa: E402
+import indexes  # noqa: E402
+
+SCHEMA = 'test_indexes'
+INDEX_FILE = """
+CREATE INDEX IF NOT EXISTS plain_entity_id_idx ON test_indexes.plain (entity_id);
+CREATE INDEX IF NOT EXISTS idx_entity_id ON test_indexes.events (entity_id);
+CREATE INDEX IF NOT EXISTS idx_visit_date ON test_indexes.events_visit USING brin (visit_date);
+CREATE INDEX IF NOT EXISTS idx_visit_status
+       ON test_indexes.events_visit (visit_status_id) WHERE (id_provider_flag = 1);
+"""
+
+
+@pytest.fixture
+def postgres_config():
+    config_file = os.environ.get('TEST_POSTGRES_CONFIG')
+    if not config_file:
+        pytest.skip('TEST_POSTGRES_CONFIG is not set')
+    postgres_config = db.get_postgres_config(config_file)
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(SCHEMA))
+        curs.execute("""
+            CREATE TABLE {0}.plain (entity_id int);
+            CREATE TABLE {0}.events (entity_id int, event_type text, visit_date date,
+                                     visit_status_id int, id_provider_flag int)
+                PARTITION BY LIST (event_type);
+            CREATE TABLE {0}.events_visit PARTITION OF {0}.events
+                FOR VALUES IN ('visit') PARTITION BY RANGE (visit_date);
+            CREATE TABLE {0}.events_visit_2010 PARTITION OF {0}.events_visit
+                FOR VALUES FROM ('2010-01-01') TO ('2011-01-01');
+            CREATE TABLE {0}.events_visit_default PARTITION OF {0}.events_visit DEFAULT;
+            CREATE TABLE {0}.events_other PARTITION OF {0}.events DEFAULT;
+        """.format(SCHEMA))
+    yield postgres_config
+    with postgres_config.connect() as conn, conn.cursor() as curs:
+        curs.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.format(SCHEMA))
+
+
+def _valid_indexes(postgres_config):
+    return set(name for name, valid in indexes.existing_indexes(postgres_config).items()
+               if valid and name.startswith(SCHEMA + '.'))
+
+
+def test_builds_plain_partitioned_and_subpartition_indexes(postgres_config, tmpdir):
+    path = tmpdir.join('indexes.sql')
+    path.write(INDEX_FILE)
+
+    timings = indexes.build_indexes(postgres_config, str(path), workers=2)
+
+    assert [timing for timing in timings if timing[2] is not None] == []
+    valid = _valid_indexes(postgres_config)
+    for name in ['plain_entity_id_idx', 'idx_entity_id', 'idx_visit_date', 'idx_visit_status',
+                 'events_visit_2010_idx_visit_date', 'events_visit_idx_entity_id',
+                 'events_other_idx_entity_id']:
+        assert '{}.{}'.format(SCHEMA, name) in valid
+
+
+def test_existing_indexes_are_skipped(postgres_config, tmpdir):
+    path = tmpdir.join('indexes.sql')
+    path.write(INDEX_FILE)
+    indexes.build_indexes(postgres_config, str(path), workers=2)
+
+    index_list = [indexes.Index(sql) for sql in indexes.split_statements(INDEX_FILE)]
+    assert indexes.plan_indexes(postgres_config, index_list) == []
@@ -0,0 +1,59 @@
+"""
+pipeline/lab_values.py: parsing raw lab_test_values. No database is needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'pipeline'))
+pytest.importorskip('psycopg2')
+
+from lab_values import parse_cell_count, parse_viral_load  # noqa: E402
+
+
+@pytest.mark.parametrize('value, viral_load', [
+    (None, None),
+    ('Credited', None),
+    ('NAT HIV Reactive', None),
+    ('None detected', 0),
+    ('No HIV-1 RNA detected ', 0),
+    ('Less than 20 copies/mL', 0),
+    ('<20', 0),
+    ('< 50 copies/mL', 50),
+    ('<75', 75),
+    ('<136', 136),
+    ('<250', 250),
+    ('>500,000', 500000),
+    ('', 0),
+    ('1,200 copies/mL', 1200),
+    ('  42 ', 42),
+])
+def test_parse_viral_load(value, viral_load):
+    failures = []
+    assert parse_viral_load(value, failures) == viral_load
+    assert failures == []
+
+
+@pytest.mark.parametrize('value', ['see note', '12.5 copies', '99999999999'])
+def test_unparsable_viral_loads_are_null_and_reported(value):
+    failures = []
+    assert parse_viral_load(value, failures) is None
+    assert failures == [value]
+    assert parse_viral_load(value) is None
+
+
+@pytest.mark.parametrize('value, count', [
+    (None, None), ('credited', None), ('350', 350.0), (' 1.5e2 ', 150.0), ('.5', 0.5)])
+def test_parse_cell_count(value, count):
+    failures = []
+    assert parse_cell_count(value, failures) == count
+    assert failures == []
+
+
+def test_unparsable_cell_counts_are_null_and_reported():
+    failures = []
+    assert parse_cell_count('350 cells', failures) is None
+    assert parse_cell_count('n/a', failures) is None
+    assert failures == ['350 cells', 'n/a']
@@ -0,0 +1,48 @@
+"""
+etl/profiler.py: inferring the Postgres types of the columns of a CSV
+file. No database is needed.
+"""
+import gzip
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'etl'))
+pytest.importorskip('click')
+
+from profiler import profile_csv  # noqa: E402
+
+CSV = (b'small,integer,big,real,day,moment,us_day,text,empty\n'
+       b'1,70000,3000000000,1.5,2017-01-02,2017-01-02 10:00:00,01/02/2017,a,\n'
+       b'-2,5,1,2,2017-02-03,2017-02-03 11:30:15,12/31/2016,b,\n'
+       b',,,,,,,,\n'
+       b'300,-70000,-3000000000,1e3,2016-12-31,2016-12-31 00:00:00,01/01/2016,c,\n')
+TYPES = [('small', 'smallint'), ('integer', 'integer'), ('big', 'bigint'),
+         ('real', 'double precision'), ('day', 'date'), ('moment', 'timestamp'),
+         ('us_day', 'text'), ('text', 'text'), ('empty', 'text')]
+
+
+def test_infers_the_tightest_types_across_chunks(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write_binary(CSV)
+    assert profile_csv(str(path), chunksize=2) == TYPES
+
+
+def test_reads_compressed_files(tmpdir):
+    path = str(tmpdir.join('data.csv.gz'))
+    with gzip.open(path, 'wb') as f:
+        f.write(CSV)
+    assert profile_csv(path) == TYPES
+
+
+def test_a_value_that_does_not_fit_widens_the_type(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write_binary(b'a,b\n1,2017-01-02\n1.5,2017-13-45\n')
+    assert profile_csv(str(path), chunksize=1) == [('a', 'double precision'), ('b', 'text')]
+
+
+def test_a_sample_covering_every_row_gives_the_same_types(tmpdir):
+    path = tmpdir.join('data.csv')
+    path.write_binary(CSV)
+    assert profile_csv(str(path), chunksize=2, sample_rows=10) == TYPES
@@ -0,0 +1,70 @@
+"""
+pipeline/sparse_features.py: the compact matrices and the model input of
+the mostly-zero feature families. No database is needed.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                'pipeline'))
+scipy_sparse = pytest.importorskip('scipy.sparse')
+pytest.importorskip('sklearn')
+
+from sparse_features import compact_matrix, to_model_input  # noqa: E402
+
+ROWS = 1000
+
+
+def _indicator(every):
+    return (np.arange(ROWS) % every == 0).astype(np.float64)
+
+
+def test_mostly_zero_matrices_become_csr_in_column_order():
+    X = pd.DataFrame({'diag_a': _indicator(50), 'age': _indicator(20) * 30,
+                      'diag_b': _indicator(70), 'ancillarydata_c': _indicator(90)})
+
+    model_input = to_model_input(X)
+
+    assert scipy_sparse.isspmatrix_csr(model_input)
+    assert model_input.dtype == np.float32
+    np.testing.assert_array_equal(model_input.toarray(), X.to_numpy(dtype=np.float32))
+
+
+def test_mostly_non_zero_matrices_stay_dense():
+    X = pd.DataFrame({'age': np.arange(ROWS, dtype=np.float64) + 1,
+                      'visits': np.arange(ROWS, dtype=np.float64) % 7 + 1,
+                      'diag_a': _indicator(50)})
+
+    model_input = to_model_input(X)
+
+    assert isinstance(model_input, np.ndarray)
+    assert model_input.dtype == np.float32
+    np.testing.assert_array_equal(model_input, X.to_numpy(dtype=np.float32))
+
+
+def test_matrices_without_sparse_columns_are_returned_as_they_are():
+    X = pd.DataFrame({'age': _indicator(50), 'diag_dense': np.ones(ROWS)})
+    assert to_model_input(X) is X
+    array = X.to_numpy()
+    assert to_model_input(array) is array
+
+
+def test_the_input_of_a_matrix_is_converted_once():
+    X = pd.DataFrame({'diag_a': _indicator(50), 'diag_b': _indicator(30)})
+    assert to_model_input(X) is to_model_input(X.copy(deep=False))
+    assert to_model_input(X.copy()) is not to_model_input(X)
+
+
+def test_compact_matrix_downcasts_but_keeps_excluded_columns():
+    X = pd.DataFrame({'flag': _indicator(2), 'count': np.arange(ROWS, dtype=np.int64) * 10,
+                      'large': np.arange(ROWS, dtype=np.int64) * 100,
+                      'score': np.linspace(-1, 1, ROWS), 'label': _indicator(3)})
+
+    compact_matrix(X, exclude=['label'])
+
+    assert X.dtypes.to_dict() == {'flag': np.uint8, 'count': np.uint16, 'large': np.float32,
+                                  'score': np.float32, 'label': np.float64}
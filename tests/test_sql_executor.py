@@ -0,0 +1,83 @@
+"""
+etl/sql_executor.py: splitting scripts into statements and the tables the
+statements read and write. No database is needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'etl'))
+pytest.importorskip('click')
+
+from sql_executor import analyze, split_statements  # noqa: E402
+
+
+def test_split_statements_respects_quotes_dollar_quotes_and_comments():
+    sql = """
+    -- a comment; with a semicolon
+    CREATE TABLE a AS SELECT 'x;y' AS s, "odd;name" FROM b;
+    CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql;
+    /* a block; /* nested; */ comment */ SELECT 2;;
+    """
+    assert split_statements(sql) == [
+        "CREATE TABLE a AS SELECT 'x;y' AS s, \"odd;name\" FROM b",
+        "CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$ LANGUAGE sql",
+        "SELECT 2",
+    ]
+
+
+def test_split_statements_keeps_a_last_statement_without_semicolon():
+    assert split_statements("SELECT 1; SELECT 'it''s'") == ["SELECT 1", "SELECT 'it''s'"]
+
+
+def test_analyze_finds_reads_writes_and_dependencies():
+    statements = analyze("""
+        CREATE TABLE s.a AS SELECT * FROM s.events;
+        CREATE TABLE s.b AS SELECT * FROM s.events e JOIN s.lookup l ON e.id = l.id;
+        CREATE INDEX ON s.a (entity_id);
+        CREATE TABLE s.c AS SELECT * FROM s.a, s.b x WHERE s.a.id = x.id;
+        DROP TABLE IF EXISTS s.d, s.e;
+    """)
+
+    assert [statement.writes for statement in statements] == [
+        {'s.a'}, {'s.b'}, {'s.a'}, {'s.c'}, {'s.d', 's.e'}]
+    assert statements[0].reads == {'s.events'}
+    assert statements[1].reads == {'s.events', 's.lookup'}
+    assert statements[3].reads == {'s.a', 's.b'}
+    assert [statement.dependencies for statement in statements] == [
+        set(), set(), {0}, {0, 1, 2}, set()]
+    assert not any(statement.barrier for statement in statements)
+
+
+def test_analyze_reads_every_item_of_from_and_using_lists():
+    statements = analyze("""
+        UPDATE s.t SET x = 1 FROM s.u, s.v WHERE t.id = u.id;
+        DELETE FROM s.t USING s.u, ONLY s.w WHERE t.id = u.id;
+        SELECT * FROM s.a JOIN s.b ON a.id = b.id, s.c, LATERAL (SELECT 1) l,
+                      generate_series(1, 2) g, (SELECT * FROM s.k) k;
+    """)
+
+    assert {'s.u', 's.v'} <= statements[0].reads
+    assert {'s.u', 's.w'} <= statements[1].reads
+    assert statements[2].reads == {'s.a', 's.b', 's.c', 's.k'}
+
+
+def test_ctes_are_not_tables():
+    statement, = analyze("WITH q AS (SELECT * FROM s.z), r AS (SELECT 1) "
+                         "SELECT * FROM q, r, s.m")
+    assert statement.reads == {'s.z', 's.m'}
+
+
+def test_unknown_statements_are_barriers():
+    statements = analyze("""
+        CREATE TABLE s.a AS SELECT 1;
+        DO $$ BEGIN PERFORM 1; END $$;
+        CREATE TABLE s.b AS SELECT 1;
+        DROP TABLE s.a CASCADE;
+    """)
+
+    assert [statement.barrier for statement in statements] == [False, True, False, True]
+    assert statements[1].dependencies == {0}
+    assert statements[2].dependencies == {1}
+    assert statements[3].dependencies == {0, 1, 2}
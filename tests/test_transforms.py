@@ -0,0 +1,63 @@
+"""
+etl/transforms.py: converting the columns of a chunk with the inventory
+column_map. No database is needed.
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'etl'))
+
+from transforms import to_csv_bytes, transform_chunk  # noqa: E402
+
+
+def _chunk(**columns):
+    return pd.DataFrame(columns, dtype=object)
+
+
+def test_converts_every_type():
+    chunk = _chunk(i=['1', '-2', None], f=['1.5', '2', None],
+                   d=['2017-01-02', '2017-02-03', None],
+                   fd=['01/02/2017', '12/31/2016', None],
+                   b=['True', ' no ', None], s=['a', 'b', None], other=['x', 'y', None])
+    column_map = {'i': {'type': 'int'}, 'f': {'type': 'float'}, 'd': {'type': 'date'},
+                  'fd': {'type': 'date(%m/%d/%Y)'}, 'b': {'type': 'bool'},
+                  's': {'type': 'str'}, 'missing': {'type': 'int'}}
+
+    converted = transform_chunk(chunk, column_map)
+
+    assert converted['i'].tolist()[:2] == [1, -2] and pd.isna(converted['i'][2])
+    assert str(converted['i'].dtype) == 'Int64'
+    assert converted['f'].tolist()[:2] == [1.5, 2.0] and pd.isna(converted['f'][2])
+    assert converted['d'].tolist()[:2] == [pd.Timestamp('2017-01-02'), pd.Timestamp('2017-02-03')]
+    assert converted['fd'].tolist()[:2] == [pd.Timestamp('2017-01-02'), pd.Timestamp('2016-12-31')]
+    assert converted['b'].tolist()[:2] == [True, False] and pd.isna(converted['b'][2])
+    assert converted['s'].tolist()[:2] == ['a', 'b']
+    assert converted['other'].tolist()[:2] == ['x', 'y']
+
+
+@pytest.mark.parametrize('new_type, value', [
+    ('int', '1.5'), ('int', 'one'), ('float', 'x'), ('date', 'not a date'),
+    ('date(%Y%m%d)', '2017-01-02'), ('bool', 'maybe')])
+def test_invalid_values_raise(new_type, value):
+    with pytest.raises(ValueError) as error:
+        transform_chunk(_chunk(c=['1', value]), {'c': {'type': new_type}})
+    assert 'coerce: true' in str(error.value)
+
+
+def test_coerced_values_are_nulls_and_counted():
+    coerced = {'c': 1}
+    converted = transform_chunk(_chunk(c=['1', 'x', 'y', None]),
+                                {'c': {'type': 'int', 'coerce': True}}, coerced)
+
+    assert converted['c'][0] == 1
+    assert converted['c'][1:].isna().all()
+    assert coerced == {'c': 3}
+
+
+def test_to_csv_bytes_writes_nulls_as_empty_fields():
+    converted = transform_chunk(_chunk(i=['1', None], d=['2017-01-02', None]),
+                                {'i': {'type': 'int'}, 'd': {'type': 'date'}})
+    assert to_csv_bytes(converted) == b'1,2017-01-02 00:00:00\n,\n'